@@ -0,0 +1,82 @@
+#!/usr/bin/python
+""" Import time benchmark for owlspec.
+
+Measures the time of "import owlspec" followed by one owlspec.util.psd_voigt
+call in fresh interpreters and compares it to "import numpy" alone. Fails
+(exit code 1) if the fast path imports any of the heavy dependencies or is
+more than <budget> seconds slower than importing numpy.
+
+Usage: python benchmarks/import_time.py [--repeat 5] [--budget 0.1]
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+heavy_modules = ["scipy", "pyplas", "roman", "mendeleev", "astroquery", "astropy",
+                 "requests", "platformdirs", "owlspec.emission_line", "owlspec.stark",
+                 "owlspec.vdW", "owlspec.emitter", "owlspec.spectrum", "owlspec.nist_cache"]
+
+fast_path = """
+import sys, time
+start = time.perf_counter()
+import owlspec
+import numpy as np
+owlspec.util.psd_voigt(np.linspace(-1, 1, 11), 0, 0.1, 0.5)
+duration = time.perf_counter() - start
+print(json.dumps({"time": duration, "modules": sorted(sys.modules)}))
+"""
+
+baseline = """
+import sys, time
+start = time.perf_counter()
+import numpy
+duration = time.perf_counter() - start
+print(json.dumps({"time": duration, "modules": sorted(sys.modules)}))
+"""
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(code):
+    out = subprocess.run([sys.executable, "-c", "import json\n" + code],
+                         cwd=root, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout)
+
+
+def loaded_heavy_modules(modules):
+    return [heavy for heavy in heavy_modules if heavy in modules]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=0.1,
+                        help="allowed time in s on top of importing numpy")
+    args = parser.parse_args()
+
+    fast = [run(fast_path) for i in range(args.repeat)]
+    base = [run(baseline) for i in range(args.repeat)]
+    fast_time = min(r["time"] for r in fast)
+    base_time = min(r["time"] for r in base)
+    print("import numpy:                   {:.1f} ms".format(1e3*base_time))
+    print("import owlspec + util.psd_voigt: {:.1f} ms".format(1e3*fast_time))
+
+    failed = False
+    heavy = loaded_heavy_modules(fast[0]["modules"])
+    if heavy:
+        print("FAIL: fast path imports " + ", ".join(heavy))
+        failed = True
+    if fast_time - base_time > args.budget:
+        print("FAIL: fast path is {:.1f} ms slower than numpy, budget {:.1f} ms".format(
+            1e3*(fast_time - base_time), 1e3*args.budget))
+        failed = True
+    if not failed:
+        print("OK")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
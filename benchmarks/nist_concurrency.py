@@ -0,0 +1,117 @@
+#!/usr/bin/python
+""" Concurrency check of the NIST cache against a local stand-in for NIST.
+
+Starts a local HTTP server that answers level queries slowly, points the
+NIST levels query to it and prefetches a list of species with duplicates
+through owlspec.nist_cache. Fails (exit code 1) if a species is requested
+more than once (single-flight), if more than max_connections requests run
+at the same time, if the requests do not run in parallel at all, or if
+the shared astroquery session is modified.
+
+Usage: python benchmarks/nist_concurrency.py [--connections 2] [--delay 0.2]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+species = ["Ar I", "Ar II", "Fe I", "Fe II", "O I", "N I"]
+
+response = """<html><body><PRE>
+ Configuration | Term | J | Level (eV) |
+ 3p6           | 1S   | 0 | 0.0        |
+ 3p5.4s        | 2[3/2]o | 2 | 11.548  |
+</PRE></body></html>"""
+
+
+class stub_nist():
+    "Local HTTP server that counts the requests and the parallel ones."
+    def __init__(self, delay):
+        self.delay = delay
+        self.requests = {}
+        self.active = self.max_active = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                name = parse_qs(urlparse(self.path).query).get("spectrum", ["?"])[0]
+                with stub.lock:
+                    stub.requests[name] = stub.requests.get(name, 0) + 1
+                    stub.active += 1
+                    stub.max_active = max(stub.max_active, stub.active)
+                time.sleep(stub.delay)
+                with stub.lock:
+                    stub.active -= 1
+                body = response.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.url = "http://127.0.0.1:{}/".format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--connections", type=int, default=2)
+    parser.add_argument("--delay", type=float, default=0.2,
+                        help="response time of the local server in s")
+    args = parser.parse_args()
+
+    from owlspec import nist_cache
+    from owlspec.nist_levels import NistLevelsClass
+    from astroquery.nist import Nist, NistClass
+    stub = stub_nist(args.delay)
+    NistLevelsClass.URL = stub.url
+    nist_cache.configure(folder=tempfile.mkdtemp(), offline=False, refresh=False,
+                         max_connections=args.connections)
+    shared_adapters = dict(Nist._session.adapters)
+
+    start = time.perf_counter()
+    errors = nist_cache.prefetch(levels=species + species[:3] + species,
+                                 max_workers=3*args.connections)
+    duration = time.perf_counter() - start
+    pooled = nist_cache._pooled(NistClass)
+    stub.server.shutdown()
+    print("{} species, {} requests in {:.2f} s, at most {} in parallel".format(
+        len(species), sum(stub.requests.values()), duration, stub.max_active))
+
+    failed = False
+    if errors:
+        print("FAIL: " + ", ".join(repr(e) for e in errors))
+        failed = True
+    if sorted(stub.requests) != sorted(species) or max(stub.requests.values()) > 1:
+        print("FAIL: requests per species " + repr(stub.requests))
+        failed = True
+    if stub.max_active > args.connections:
+        print("FAIL: more than {} parallel requests".format(args.connections))
+        failed = True
+    if args.connections > 1 and stub.max_active < 2:
+        print("FAIL: the requests did not run in parallel")
+        failed = True
+    if dict(Nist._session.adapters) != shared_adapters or pooled is Nist or \
+            pooled._session.get_adapter("https://")._pool_maxsize != args.connections:
+        print("FAIL: the shared astroquery session was changed")
+        failed = True
+    if not failed:
+        print("OK")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
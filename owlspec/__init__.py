@@ -1,10 +1,62 @@
 #!/usr/bin/python
-from . import emitter
+""" Submodules and the classes exported here are only imported when they
+are used for the first time (for startup performance). Importing owlspec
+and using owlspec.util only needs numpy. """
+import sys
+import types
+from importlib import import_module
 from .util import *
-from .emission_line import *
-from .spectrum import *
-from .stark import gigosos_loader, gigosos_he_loader
+from .util import __all__ as _util_all
+
+_submodules = ["emitter", "nist_cache", "bundle", "emission_line", "spectrum",
+               "stark", "vdW", "lte", "line_table", "synthesis", "nist_levels",
+               "elements", "grid"]
+
+# exported name: submodule it is taken from
+_exports = {
+    "emission_line": ".emission_line",
+    "spectrum": ".spectrum",
+    "composite_spectrum": ".spectrum",
+    "species": ".emitter.species",
+    "perturber": ".emitter.species",
+    "gigosos_loader": ".stark",
+    "gigosos_he_loader": ".stark",
+}
+
+__all__ = _util_all + ["emission_line", "spectrum", "composite_spectrum",
+                       "download_stark_tables", "emitter", "species", "perturber",
+                       "stark", "vdW", "gigosos_loader", "gigosos_he_loader"]
+
+
+class _package(types.ModuleType):
+    def __setattr__(self, name, value):
+        # The import system sets imported submodules as package attributes.
+        # The submodules emission_line and spectrum must not hide the classes
+        # of the same name.
+        if name in _exports and isinstance(value, types.ModuleType) \
+                and value.__name__ == __name__ + _exports[name]:
+            value = getattr(value, name)
+        super().__setattr__(name, value)
+
+sys.modules[__name__].__class__ = _package
+
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(import_module(_exports[name], __name__), name)
+    elif name in _submodules:
+        value = import_module("." + name, __name__)
+    else:
+        raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
+    setattr(sys.modules[__name__], name, value)
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_submodules) | set(_exports))
+
 
 def download_stark_tables(redownload=False):
+    from .stark import gigosos_loader, gigosos_he_loader
     gigosos_loader.download_profiles(redownload)
     gigosos_he_loader.download_profiles(redownload)
@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+""" Offline bundles of NIST line and level data.
+
+build_bundle() fetches the line and level data for a list of species and
+writes it into a single SQLite file. A bundle object serves that file as
+a data backend for nist_cache, so spectrum, transition and level read from
+it instead of querying NIST:
+
+    owlspec.bundle.build_bundle("atoms.sqlite", ["H I", "He I", "Ar I"])
+    owlspec.nist_cache.use_bundle("atoms.sqlite")
+
+The bundle is only read, so many processes can share the same file. Set
+the environment variable OWL_BUNDLE to the path of a bundle to use it
+automatically. Can also be run as a script:
+
+    python -m owlspec.bundle atoms.sqlite "H I" "He I" "Ar I" "Ar II"
+"""
+
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+import numpy as np
+from . import nist_cache
+
+default_species = ["H I", "He I", "Ar I", "Ar II", "O I", "N I", "N II",
+                   "Fe I", "Fe II"]
+level_columns = ['E', 'J', 'g', 'G', 'conf', 'term']
+format_version = "1"
+
+
+def _normalize(name):
+    return " ".join(name.split())
+
+
+def _row_wavelength(row, names, non_decimal=re.compile(r'[^\d.]+')):
+    """ Observed wavelength of a table row or Ritz wavelength if there is
+    no observed one. None for rows without wavelength (e.g. headings). """
+    for name in ('Observed', 'Ritz'):
+        if name in names and not np.ma.is_masked(row[name]):
+            try:
+                return float(non_decimal.sub('', str(row[name])))
+            except ValueError:
+                pass
+    return None
+
+
+def build_bundle(path, species=default_species, wl_range=(0, 99999),
+                 overwrite=False):
+    """ Fetch line and level data for all <species> (list of names in
+    spectroscopic notation) and store it in the SQLite file <path>.
+    Data is taken from the NIST cache where possible. """
+    if os.path.exists(path):
+        if not overwrite:
+            raise FileExistsError(path + " already exists.")
+        os.remove(path)
+
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.executescript("""
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE line_columns (spec_name TEXT PRIMARY KEY, names TEXT);
+            CREATE TABLE lines (spec_name TEXT, wl REAL, cells TEXT);
+            CREATE TABLE levels (spec_name TEXT, energy REAL, J REAL,
+                                 weight REAL, lande REAL, conf TEXT, term TEXT);
+        """)
+        connection.executemany("INSERT INTO meta VALUES (?, ?)", [
+            ("format", format_version), ("created", str(time.time())),
+            ("wl_low", str(float(wl_range[0]))),
+            ("wl_high", str(float(wl_range[-1])))])
+
+        for name in species:
+            name = _normalize(name)
+            print("Adding " + name + " to bundle.")
+            nist_lines = nist_cache.query_lines(wl_range[0], wl_range[-1], name,
+                                                wavelength_type='vac+air')
+            names = list(nist_lines.colnames)
+            rows = []
+            for row in nist_lines:
+                wl = _row_wavelength(row, names)
+                if wl is None:
+                    continue
+                cells = [None if np.ma.is_masked(row[n]) else str(row[n])
+                         for n in names]
+                rows.append((name, wl, json.dumps(cells)))
+            connection.execute("INSERT INTO line_columns VALUES (?, ?)",
+                               (name, json.dumps(names)))
+            connection.executemany("INSERT INTO lines VALUES (?, ?, ?)", rows)
+
+            levels = nist_cache.query_levels(name)
+            connection.executemany(
+                "INSERT INTO levels VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(name, *[levels[c][i].item() for c in level_columns])
+                 for i in range(len(levels['E']))])
+
+        connection.execute("CREATE INDEX lines_idx ON lines (spec_name, wl)")
+        connection.execute("CREATE INDEX levels_idx ON levels (spec_name)")
+    connection.close()
+    return bundle(path)
+
+
+def _restore_column(values):
+    """ Convert the text cells of a column back to int, float or str, the
+    same way astropy's ascii reader does it. """
+    mask = [v is None for v in values]
+    for kind, fill in ((int, 0), (float, np.nan)):
+        try:
+            data = [fill if v is None else kind(v) for v in values]
+            return np.ma.MaskedArray(data, mask=mask, dtype=kind)
+        except ValueError:
+            continue
+    data = ['' if v is None else v for v in values]
+    return np.ma.MaskedArray(data, mask=mask, dtype=str)
+
+
+class bundle():
+    """ Read-only NIST data backend on top of a file written by
+    build_bundle(). Species that are not in the bundle are passed on to
+    the cache/NIST by returning None. """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        meta = dict(self._query("SELECT key, value FROM meta"))
+        if meta.get("format") != format_version:
+            raise ValueError(path + " is not a compatible owlspec bundle.")
+        self.wl_range = (float(meta["wl_low"]), float(meta["wl_high"]))
+        self.columns = {name: json.loads(names) for name, names in
+                        self._query("SELECT spec_name, names FROM line_columns")}
+        self.species = sorted(self.columns)
+        # identifies the data, see nist_cache.levels_source
+        self.source = os.path.abspath(path) + " " + repr(os.path.getmtime(path))
+
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            # connections must not be shared with forked worker processes
+            if self._connection is None or self._pid != os.getpid():
+                uri = "file:" + os.path.abspath(self.path) + "?mode=ro"
+                self._connection = sqlite3.connect(uri, uri=True,
+                                                   check_same_thread=False)
+                self._pid = os.getpid()
+            return self._connection.execute(sql, params).fetchall()
+
+
+    def lines(self, linename, wl_low, wl_high, wavelength_type="vac+air"):
+        """ Lines of <linename> between <wl_low> and <wl_high> (nm) as an
+        astropy table like astroquery.nist.Nist.query returns it. """
+        linename = _normalize(linename)
+        if linename not in self.columns or wavelength_type != "vac+air" \
+                or wl_low < self.wl_range[0] or wl_high > self.wl_range[1]:
+            return None
+        from astropy.table import Table
+        rows = self._query("SELECT cells FROM lines WHERE spec_name = ? AND "
+                           "wl >= ? AND wl <= ? ORDER BY rowid",
+                           (linename, wl_low, wl_high))
+        names = self.columns[linename]
+        cells = list(zip(*[json.loads(row[0]) for row in rows]))
+        if not cells:
+            cells = [[] for name in names]
+        return Table([_restore_column(list(c)) for c in cells], names=names,
+                     masked=True)
+
+
+    def levels(self, linename, energy_level_unit="eV"):
+        """ Levels of <linename> as numpy columns like
+        owlspec.nist_levels.parse_levels returns them. """
+        linename = _normalize(linename)
+        if linename not in self.columns or energy_level_unit != "eV":
+            return None
+        rows = self._query("SELECT energy, J, weight, lande, conf, term FROM levels "
+                           "WHERE spec_name = ? ORDER BY rowid", (linename,))
+        columns = list(zip(*rows)) if rows else [()] * len(level_columns)
+        levels = {}
+        for name, values in zip(level_columns, columns):
+            if name in ('conf', 'term'):
+                levels[name] = np.array(values, dtype=str)
+            else:
+                levels[name] = np.array(values, dtype=float) # NULL -> nan
+        return levels
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Build an offline bundle of NIST line and level data.")
+    parser.add_argument("path", help="SQLite file to write")
+    parser.add_argument("species", nargs="*", default=default_species,
+                        help='species in spectroscopic notation, e.g. "Ar I"')
+    parser.add_argument("--wl-range", nargs=2, type=float, default=(0, 99999),
+                        metavar=("LOW", "HIGH"), help="wavelength range in nm")
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+    build_bundle(args.path, args.species, args.wl_range, args.overwrite)
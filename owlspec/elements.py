@@ -0,0 +1,114 @@
+#!/bin/python3
+""" Process wide cache of the element properties owl needs (symbol, mass,
+ionization energies, dipole polarizability).
+
+Each element is loaded only once per process and shared by all spectra,
+levels, transitions and species. The properties are read from the snapshot
+table shipped with owlspec (data/elements.json), so mendeleev is only
+needed if the snapshot is disabled or does not contain the element. The
+snapshot can be recreated from mendeleev with build_snapshot(). """
+
+import os
+import json
+import threading
+
+__all__ = ["element_data", "get_element", "use_snapshot", "build_snapshot"]
+
+snapshot_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "data", "elements.json")
+settings = {"snapshot": True}
+_elements = {}
+_snapshot = {}
+_lock = threading.Lock()
+
+
+class element_data():
+    """ Properties of one element, with the attribute names of mendeleev
+    elements. The objects are shared, do not modify them.
+    <symbol>: e.g. "Ar"
+    <name>: e.g. "Argon"
+    <atomic_number>
+    <mass>: in amu
+    <ionenergies>: Dictionary {1: first ionization energy, ...} in eV
+    <dipole_polarizability>: in atomic units (Bohr radius^3), None if unknown
+    """
+
+    def __init__(self, symbol, name, atomic_number, mass, ionenergies,
+                 dipole_polarizability):
+        self.symbol = symbol
+        self.name = name
+        self.atomic_number = atomic_number
+        self.mass = mass
+        self.ionenergies = dict(ionenergies)
+        self.dipole_polarizability = dipole_polarizability
+
+    def __repr__(self):
+        return "element_data(" + self.symbol + ")"
+
+    def to_dict(self):
+        return {"symbol": self.symbol, "name": self.name,
+                "atomic_number": self.atomic_number, "mass": self.mass,
+                "ionenergies": {str(k): v for k, v in self.ionenergies.items()},
+                "dipole_polarizability": self.dipole_polarizability}
+
+    @staticmethod
+    def from_dict(data):
+        return element_data(data["symbol"], data["name"], data["atomic_number"],
+                            data["mass"], {int(k): v for k, v in data["ionenergies"].items()},
+                            data["dipole_polarizability"])
+
+    @staticmethod
+    def from_mendeleev(symbol):
+        from mendeleev import element # import here for startup performance
+        ele = element(symbol)
+        return element_data(ele.symbol, ele.name, ele.atomic_number, ele.mass,
+                            ele.ionenergies, ele.dipole_polarizability)
+
+
+def use_snapshot(enabled=True):
+    """ Read the element properties from the bundled snapshot table (default)
+    or always from mendeleev (<enabled> = False). Clears the cache. """
+    with _lock:
+        settings["snapshot"] = enabled
+        _elements.clear()
+
+
+def _load_snapshot():
+    if not _snapshot:
+        try:
+            with open(snapshot_file, "r", encoding="utf-8") as f:
+                for data in json.load(f):
+                    _snapshot[data["symbol"]] = data
+        except (OSError, ValueError):
+            print("WARNING: could not read element snapshot, using mendeleev")
+            settings["snapshot"] = False
+    return _snapshot
+
+
+def get_element(symbol):
+    """ Return the element_data of the element <symbol> (e.g. "Ar" or "ar").
+    All calls with the same symbol return the same object. """
+    symbol = symbol.strip().title()
+    ele = _elements.get(symbol)
+    if ele is not None:
+        return ele
+    with _lock:
+        if symbol not in _elements:
+            snapshot = _load_snapshot() if settings["snapshot"] else {}
+            if symbol in snapshot:
+                _elements[symbol] = element_data.from_dict(snapshot[symbol])
+            else:
+                _elements[symbol] = element_data.from_mendeleev(symbol)
+        return _elements[symbol]
+
+
+def build_snapshot(path=None):
+    """ Write the properties of all elements from mendeleev to the snapshot
+    table <path> (defaults to the file shipped with owlspec). """
+    from mendeleev.fetch import fetch_table
+    symbols = list(fetch_table("elements")["symbol"])
+    data = [element_data.from_mendeleev(s).to_dict() for s in symbols]
+    path = snapshot_file if path is None else path
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[\n" + ",\n".join(json.dumps(d) for d in data) + "\n]\n")
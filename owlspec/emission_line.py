@@ -1,21 +1,87 @@
 #!/bin/python3
+import time
 import numpy as np
-from scipy.signal import fftconvolve as convolve
 from scipy import constants as const
-from scipy import interpolate
 from .util import zeeman, parse_spectroscopic_name, \
-                        doppler_maxwell, gauss_function, psd_voigt
+                        doppler_maxwell, gauss_function, psd_voigt, \
+                        lorentz_function, voigt_function, zeeman_components, \
+                        voigt_derivatives, psd_voigt_derivatives, \
+                        gauss_transform, lorentz_transform
 from . import stark
 from . import vdW
+from .grid import grid, estimate_fwhm, plan_grid
+from .memo import lru, quantize
 from .emitter.species import species, perturber
 from .util import parse_spectroscopic_name, get_spectroscopic_name
 from copy import copy
 
+# The line intensity is normalized as if the profile was calculated on a 50x
+# finer axis (the fixed oversampling of earlier versions), independent of
+# the oversampling that is actually used.
+reference_oversampling = 50
+
+# Maximum number of Fourier coefficients that get_profiles() holds at once,
+# larger batches are calculated in blocks.
+max_batch_points = 2**22
+
+# Profiles and Fourier transforms of the line components, keyed by the 
+# (rounded) parameters they depend on and the grid.
+component_cache = {name: lru(16) for name in 
+                   ['Doppler', 'Stark', 'Zeeman', 'vdW', 'instrument']}
+
+# Parameters that get_profile() can calculate derivatives for.
+derivative_parameters = ("A", "wl", "T", "B", "ne", "Te", "ng", "w", "mu")
+
+
+def cache_info():
+    """ Hit/miss statistics of the component caches. """
+    return {name: cache.info() for name, cache in component_cache.items()}
+
+
+def clear_cache():
+    for cache in component_cache.values():
+        cache.clear()
+
+
+def set_cache_size(maxsize):
+    """ Set the maximum number of entries of each component cache. """
+    for cache in component_cache.values():
+        cache.resize(maxsize)
+
+
+class component_profiles(dict):
+    """ The profiles of the line components (self.profiles). Values that
+    are functions are only calculated when they are read, e.g. the 
+    instrumental profile, which the convolution does not need. """
+
+    def __getitem__(self, name):
+        value = super().__getitem__(name)
+        if callable(value):
+            value = value()
+            self[name] = value
+        return value
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def values(self):
+        return [self[name] for name in self]
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+
+def normalized_derivative(A, y, dy, resolution):
+    """ Derivative of A*y/sum(y)/resolution (the intensity normalization
+    of the line profile), from the derivative <dy> of y. """
+    S = np.sum(y)
+    return A/resolution * (dy/S - y*np.sum(dy)/S**2)
+
 class emission_line():
     def __init__(self, transition, wl, plasma=None, instr_func = None, w = None, mu = 0.0,
                  T = None, B = None, ne = None, Te = None, ng = None, pert = None, 
                  Instr_on='auto', Doppler_on='auto', Stark_on='auto', Zeeman_on='auto', 
-                 vdW_on='auto'):
+                 vdW_on='auto', analytic=True, tolerance=1e-3):
         
         """  Class to calculate the shape of an emission line based on the 
         physical situation. Providing information on densities and temperatures
@@ -23,8 +89,9 @@ class emission_line():
 
         Supported broadening mechanisms: Doppler, Stark, Zeeman, van der Waals
         and instrumental broadening. Stark broadening is only supported for
-        some transitions: H-alpha to gamma, He 447.1 nm, He 492.2 nm, O 777 nm,
-        Ar 810.369 nm and Ar 738.398 nm.
+        the transitions of owlspec.stark.registry: H-alpha and beta, He 447.1
+        nm, He 492.2 nm, O 777 nm, Ar 810.369 nm and Ar 738.398 nm, more 
+        can be added with owlspec.stark.registry.load_lines().
 
         <transition>: An owl.emitter.transition object for the specific line.
         <wl>: Center wavelength in nm. Does not need to be the theoretical wl
@@ -67,6 +134,16 @@ class emission_line():
         One of True, False 'auto'.
         Turns claculation of respective broadening mechanism on or off. Defaults
         to 'auto' which automatically enables calculation if possible.
+        <analytic>: If True (default), lines where all components are Gaussians
+        or Lorentzians (Doppler, Griem Stark widths, vdW, psd_voigt instrument)
+        are calculated directly as Voigt profiles on the x axis instead of
+        convolving upsampled profiles. Tabulated Stark profiles, Zeeman 
+        patterns and custom instrumental functions always use convolution.
+        <tolerance>: Relative accuracy of the convolution. The oversampling of
+        the x axis is chosen according to the narrowest component, the axis
+        is extended if the wings of the widest component reach beyond it.
+        After get_profile(), the used factor and extension (in points of x 
+        on each side) are stored in self.oversampling and self.padding.
         """
 
         self.transition = transition
@@ -82,8 +159,13 @@ class emission_line():
         self.pert = pert
         self.Instr_on, self.Doppler_on = Instr_on, Doppler_on
         self.Zeeman_on, self.vdW_on, self.Stark_on = Zeeman_on, vdW_on, Stark_on
+        self.analytic = analytic
+        self.tolerance = tolerance
+        self.stark_line = stark.registry.find(transition) # None if not supported
+        self.oversampling = self.padding = None
 
-        self.profiles = dict.fromkeys(['Doppler', 'Zeeman', 'Stark', 'vdW', 'instrument'])
+        self.profiles = component_profiles.fromkeys(['Doppler', 'Zeeman', 'Stark', 'vdW', 'instrument'])
+        self.derivatives = None
 
 
         if pert:    
@@ -101,16 +183,18 @@ class emission_line():
 
 
     def get_profile(self, x, A = 1,  wl=None, plasma=None, instr_func = None, 
-                    w = None, mu = 0.0, T = None, B = None, ne = None, 
+                    w = None, mu = None, T = None, B = None, ne = None, 
                     Te = None, ng = None, pert = None,
                  Instr_on=None, Doppler_on=None, Stark_on=None, Zeeman_on=None, 
-                 vdW_on=None):
+                 vdW_on=None, analytic=None, tolerance=None, derivatives=None):
 
         """  Return emission line profile for the physical situation speciefied
         here or in the emission_line object. Values set here superseed object
         variables.
 
-        <x>: numpy array with the wavelength axis in nm.
+        <x>: numpy array with the wavelength axis in nm, or an owlspec.grid.grid
+             object. Create the grid once with grid(x) to reuse the fine
+             axis in repeated calls (e.g. when fitting).
         <A>: Line intensity (= line area). Defaults to 1.
         <wl>: Center wavelength in nm. Does not need to be the theoretical wl
               of the transition. Use to move simulation relative to measurement.
@@ -152,8 +236,25 @@ class emission_line():
         One of True, False 'auto'.
         Turns claculation of respective broadening mechanism on or off. Defaults
         to 'auto' which automatically enables calculation if possible.
+        <analytic>: Use the analytic Voigt profile if possible, see
+        emission_line.
+        <tolerance>: Relative accuracy of the convolution, see emission_line.
+        <derivatives>: Names of parameters (see derivative_parameters) to
+        calculate the derivatives of the profile for. They are stored in 
+        self.derivatives as {name: array on x}, see also get_jacobian().
+        The derivatives are analytic (derivatives of the Fourier transforms
+        or Voigt profiles of the components, and of the interpolation 
+        weights of tabulated Stark profiles) and belong to the fine grid of
+        this call. Perturber temperatures count as T if they are set from T.
         """
 
+        derivatives = tuple(derivatives or ())
+        unknown = [name for name in derivatives if name not in derivative_parameters]
+        if unknown:
+            raise ValueError("No derivatives for " + ", ".join(unknown) + 
+                             ". Parameters are " + ", ".join(derivative_parameters))
+        self.derivatives = None
+
         if wl == None and self.wl:
             wl = self.wl
         if plasma == None and self.plasma:
@@ -162,7 +263,7 @@ class emission_line():
             instr_func = self.instr
         if w == None and self.w:
             w = self.w
-        if mu == None and self.mu:
+        if mu == None:
             mu = self.mu
         if T == None and self.T:
             T = self.T
@@ -184,7 +285,14 @@ class emission_line():
             Zeeman_on = self.Zeeman_on   
         if vdW_on == None and self.vdW_on:
             vdW_on = self.vdW_on   
+        if analytic == None:
+            analytic = self.analytic
+        if tolerance == None:
+            tolerance = self.tolerance
 
+        # perturber attributes that are set from the parameters of this
+        # call, {(id(perturber), attribute): parameter}, for the derivatives
+        tied = {}
         if pert == None and self.pert:
             pert = self.pert
         elif pert:
@@ -193,6 +301,7 @@ class emission_line():
                 pert = species(name, charge*const.e)
                 if T:
                     pert.T = T
+                    tied[id(pert), 'T'] = 'T'
 
             elif isinstance(pert, species) or isinstance(pert, perturber):
                 pert = pert
@@ -204,11 +313,13 @@ class emission_line():
             vdW_pert = self.transition.particle
             vdW_pert.T = T
             vdW_pert.n = ng
+            tied[id(vdW_pert), 'T'], tied[id(vdW_pert), 'n'] = 'T', 'ng'
         
         if not pert and ne and T:
             Stark_pert = self.transition.particle
             Stark_pert.T = T
             Stark_pert.n = ne
+            tied[id(Stark_pert), 'T'], tied[id(Stark_pert), 'n'] = 'T', 'ne'
 
         if plasma:
             if plasma.ions:
@@ -221,14 +332,18 @@ class emission_line():
         if T and ng:
             if T and not vdW_pert.T:
                 vdW_pert.T = T
+                tied[id(vdW_pert), 'T'] = 'T'
             if ng:
                 vdW_pert.n = ng
+                tied[id(vdW_pert), 'n'] = 'ng'
 
         if T and ne:
             if T and not Stark_pert.T:
                 Stark_pert.T = T
+                tied[id(Stark_pert), 'T'] = 'T'
             if ne and not Stark_pert.n:
                 Stark_pert.n = ne
+                tied[id(Stark_pert), 'n'] = 'ne'
 
         if plasma:
             if plasma.ne and not ne:
@@ -245,70 +360,809 @@ class emission_line():
             if not B:
                 B = plasma.B
         
+        coarse = x if isinstance(x, grid) else grid(x)
+        x = coarse.x
+        # parameters that the perturber density and temperature are set from
+        vdW_tied = (tied.get((id(vdW_pert), 'n')), tied.get((id(vdW_pert), 'T')))
+        Stark_T = tied.get((id(Stark_pert), 'T'))
 
-        self.profiles = dict.fromkeys(['x', 'y', 'Doppler', 'Zeeman', 'Stark', 'vdW', 'instrument'])
-        orig_x = np.copy(x)
+        if analytic:
+            y = self.analytic_profile(x, A, wl, instr_func, w, mu, T, B, ne, Te,
+                                      Stark_pert, vdW_pert, Instr_on, Doppler_on,
+                                      Stark_on, Zeeman_on, vdW_on, derivatives,
+                                      vdW_tied)
+            if y is not None:
+                return y
+
+        self.profiles = component_profiles.fromkeys(['x', 'y', 'Doppler', 'Zeeman', 'Stark', 'vdW', 'instrument'])
+        orig_x = x
         s = 0 # lineshift in nm
-        fine_x = interpolate.make_interp_spline(np.linspace(0,1,len(x)), x)
-        x = fine_x(np.linspace(0,1,len(x)*50)) # upsample x axis
+        widths = self.component_widths(x, wl+s, instr_func, w, mu, T, B, ne, Te,
+                                       Stark_pert, vdW_pert, Instr_on, Doppler_on,
+                                       Stark_on, Zeeman_on, vdW_on)
+        fine = coarse.plan(*widths[:2], tolerance, *widths[2:]) # upsampled x axis
+        self.oversampling, self.padding = fine.factor, fine.pad
+        x = fine.x
         self.profiles['x'] = x
 
-        resolution = abs((x[-1]-x[0])/(len(x)-1))
-        middle_wl = x[int(len(x)/2)-1]
-        components = []
+        resolution = fine.resolution
+        norm_resolution = abs((orig_x[-1]-orig_x[0])/(len(orig_x)*reference_oversampling-1))
+        middle_wl = fine.middle
+        # Components are combined in the Fourier domain. Gaussian, Lorentzian
+        # and Zeeman components use their analytic transforms, tabulated
+        # profiles are transformed numerically. Each component is cached 
+        # with its parameters (see component_cache).
+        t = self.transition
+        line_key = quantize(t.spec_name, t.wl, self.m)
+        use_doppler = (Doppler_on=='auto' and T) or Doppler_on==True
+        use_stark = ((Stark_on=='auto' and ne) or Stark_on==True) and \
+            self.stark_supported(Stark_on)
+        use_zeeman = (Zeeman_on=='auto' and B) or Zeeman_on==True
+        use_vdW = (vdW_on=='auto' and vdW_pert) or vdW_on==True
+        if use_vdW and not (vdW_pert.T and vdW_pert.n):
+            if vdW_on==True:
+                print('Missing perturber/neutral density and temperature for van der Waals broadening. Skipping.')
+            use_vdW = False
+        if use_stark:
+            this_stark = stark.stark(self.transition, line=self.stark_line)
+            wS = this_stark.get_width(ne, Te, Stark_pert)
+        # The instrumental profile and the numerically transformed components
+        # set the FFT length, which must be long enough to avoid wrap around.
+        nk = 1 + int(use_stark and wS is None) + int(use_vdW and t.emitter.symbol == "H")
+        f = fine.frequencies(nk)
+        H = np.ones(len(f))
+        # For the derivatives: the transform of each component and the
+        # derivatives of the transforms, {parameter: [(component, dF)]}
+        factors = {}
+        terms = {name: [] for name in derivatives}
 
-        if (Doppler_on=='auto' and T) or Doppler_on==True:
-            maxwell = doppler_maxwell(x, middle_wl, T, self.m)
-            self.profiles['Doppler'] = maxwell/np.max(maxwell)
-            components.append(maxwell)
+        if use_doppler:
+            def doppler():
+                maxwell = doppler_maxwell(x, middle_wl, T, self.m)
+                wD = middle_wl/const.c * np.sqrt(8 * const.k * T * np.log(2) / self.m)
+                return maxwell/np.max(maxwell), gauss_transform(f, wD)
+            factors['Doppler'] = self.cached_component('Doppler', doppler, fine.key, nk, T, self.m)
+            H = H * factors['Doppler']
+            if 'T' in terms:
+                wD = middle_wl/const.c * np.sqrt(8 * const.k * T * np.log(2) / self.m)
+                terms['T'].append(('Doppler', factors['Doppler'] * 
+                                   -np.pi**2*f**2*wD**2/(4*np.log(2)*T)))
 
-        if (Stark_on=='auto' and ne) or Stark_on==True:
-            this_stark = stark.stark(self.transition)
-            stark_profile = this_stark.get_profile(x, ne, Te, Stark_pert)
-            self.profiles['Stark'] = stark_profile/np.max(stark_profile)
-            components.append(stark_profile)
+        if use_stark:
+            def stark_component():
+                if wS is not None:
+                    stark_profile = lorentz_function(x, middle_wl, wS)
+                    return stark_profile/np.max(stark_profile), lorentz_transform(f, wS)
+                stark_profile = this_stark.get_profile(fine, ne, Te, Stark_pert)
+                return stark_profile/np.max(stark_profile), fine.kernel_transform(stark_profile, nk)
+            pert_key = quantize(Stark_pert.m, Stark_pert.T) if Stark_pert else None
+            factors['Stark'] = self.cached_component('Stark', stark_component, fine.key, nk,
+                                                     line_key, ne, Te, pert_key, this_stark.fast)
+            H = H * factors['Stark']
+            names = ['ne', 'Te', Stark_T]
+            if any(name in terms for name in names):
+                if wS is not None:
+                    dw = this_stark.get_width_derivatives(ne, Te, Stark_pert)
+                    dF = [-np.pi*np.abs(f)*d*factors['Stark'] for d in dw]
+                else:
+                    dF = [fine.kernel_transform(d, nk) for d in 
+                          this_stark.get_profile_derivatives(fine, ne, Te, Stark_pert)]
+                for name, d in zip(names, dF):
+                    if name in terms:
+                        terms[name].append(('Stark', d))
 
-        if (Zeeman_on=='auto' and B) or Zeeman_on==True:
+        if use_zeeman:
             if not (B):
                 print('Missing magnetic field strength for Zeeman splitting. Skipping.')
-            else:
-                t = self.transition
-                if t.upperJ and t.lowerJ and t.upperG and t.lowerG:
+            elif t.upperJ and t.lowerJ and t.upperG and t.lowerG:
+                def zeeman_component():
                     zeeman_pattern = zeeman(x, middle_wl, B, t.upperJ, t.lowerJ, t.upperG, t.lowerG)/resolution
-                    self.profiles['Zeeman'] = zeeman_pattern/np.max(zeeman_pattern)
-                    components.append(zeeman_pattern)
-                else:
-                    print('Missing quantum numbers (J) or Lande G values for Zeeman splitting. Skipping.')
-
-        if (vdW_on=='auto' and vdW_pert) or vdW_on==True:
-            if not (vdW_pert.T and vdW_pert.n):
-                if vdW_on==True:
-                    print('Missing perturber/neutral density and temperature for van der Waals broadening. Skipping.')
+                    wls, intensities = zeeman_components(middle_wl, B, t.upperJ, t.lowerJ, t.upperG, t.lowerG)
+                    transfer = np.sum(intensities[:,None] * 
+                                      np.exp(-2j*np.pi*np.outer(wls-middle_wl, f)), axis=0)
+                    return zeeman_pattern/np.max(zeeman_pattern), transfer
+                factors['Zeeman'] = self.cached_component('Zeeman', zeeman_component, fine.key, nk, 
+                                                          line_key, B, t.upperJ, t.lowerJ, 
+                                                          t.upperG, t.lowerG)
+                H = H * factors['Zeeman']
+                if 'B' in terms: # the splitting is proportional to B
+                    wls, intensities = zeeman_components(middle_wl, B, t.upperJ, t.lowerJ, t.upperG, t.lowerG)
+                    phase = -2j*np.pi*np.outer(wls-middle_wl, f)
+                    terms['B'].append(('Zeeman', np.sum(intensities[:,None] * 
+                                                        phase/B * np.exp(phase), axis=0)))
             else:
-                this_vdW = vdW.vdW(self.transition, pert=vdW_pert)
-                vdW_profile = this_vdW.get_profile(x, vdW_pert.n, vdW_pert.T)
-                self.profiles['vdW'] = vdW_profile/np.max(vdW_profile)
-                components.append(vdW_profile)
-                # s = s + this_vdW.get_shift(x, vdW_pert.n, vdW_pert.T)
+                print('Missing quantum numbers (J) or Lande G values for Zeeman splitting. Skipping.')
+
+        if use_vdW:
+            this_vdW = vdW.vdW(self.transition, pert=vdW_pert)
+            def vdW_component():
+                vdW_profile = this_vdW.get_profile(fine, vdW_pert.n, vdW_pert.T)
+                if t.emitter.symbol == "H": # fine structure components
+                    return vdW_profile, fine.kernel_transform(vdW_profile, nk)
+                wV = this_vdW.get_width(self.transition, vdW_pert.n, vdW_pert.T)
+                return vdW_profile, lorentz_transform(f, wV)
+            factors['vdW'] = self.cached_component('vdW', vdW_component, fine.key, nk, line_key,
+                                                   vdW_pert.n, vdW_pert.T, vdW_pert.m,
+                                                   vdW_pert.element.dipole_polarizability)
+            H = H * factors['vdW']
+            names = list(vdW_tied)
+            if any(name in terms for name in names):
+                if t.emitter.symbol == "H":
+                    dF = [fine.kernel_transform(d, nk) for d in 
+                          this_vdW.get_profile_derivatives(fine, vdW_pert.n, vdW_pert.T)]
+                else: # width proportional to n*T^0.3
+                    wV = this_vdW.get_width(self.transition, vdW_pert.n, vdW_pert.T)
+                    dF = [-np.pi*np.abs(f)*wV*factors['vdW']/vdW_pert.n,
+                          -np.pi*np.abs(f)*0.3*wV*factors['vdW']/vdW_pert.T]
+                for name, d in zip(names, dF):
+                    if name in terms:
+                        terms[name].append(('vdW', d))
+            # s = s + this_vdW.get_shift(x, vdW_pert.n, vdW_pert.T)
 
         # We let the instrumental profile determine center position.
         # ALL other components are shifted to the middle!
         if instr_func and (Instr_on=='auto' or Instr_on==True):
             instrumental_profile = instr_func(x, wl+s)
-        elif w and (Instr_on=='auto' or Instr_on==True):   
-            instrumental_profile = psd_voigt(x, wl+s, w, mu)
+            self.profiles['instrument'] = instrumental_profile/np.max(instrumental_profile)
+            factors['instrument'] = fine.transform(instrumental_profile, nk)
+            H = H * factors['instrument']
+            if 'wl' in terms: # instr_func(x, xc) is shifted with xc
+                terms['wl'].append(('instrument', -2j*np.pi*f*factors['instrument']))
         else:
-            instrumental_profile = gauss_function(x, wl+s, x[1]-x[0])
-        
-        self.profiles['instrument'] = instrumental_profile/np.max(instrumental_profile)
+            use_w = w and (Instr_on=='auto' or Instr_on==True)
+            if use_w:
+                wI, muI = w, mu
+            else:
+                # narrow Gaussian as delta function, two points wide so that 
+                # its position is not rounded to the grid
+                wI, muI = 2*resolution, 0
+            def instrumental_profile(x=x, xc=wl+s, wI=wI, muI=muI):
+                profile = psd_voigt(x, xc, wI, muI)
+                return profile/np.max(profile)
+            self.profiles['instrument'] = instrumental_profile # when it is read
+            # sampled on the grid and centered on the origin, placed at the
+            # line position by the phase factor below
+            instrument = lambda: (None, fine.kernel_transform(psd_voigt(x, middle_wl, wI, muI), nk))
+            if use_w or not (use_doppler or use_stark or use_vdW):
+                factors['instrument'] = self.cached_component('instrument', instrument, 
+                                                              fine.key, nk, wI, muI)
+                H = H * factors['instrument']
+            # else: the phase factor alone is an exact delta function and
+            # the broadened line is smooth on the grid
+            if use_w and ('w' in terms or 'mu' in terms):
+                dw, dmu = psd_voigt_derivatives(x, middle_wl, wI, muI)
+                for name, d in (('w', dw), ('mu', dmu)):
+                    if name in terms:
+                        terms[name].append(('instrument', fine.kernel_transform(d, nk)))
+            factors['shift'] = fine.shift(wl+s, nk)
+            H = H * factors['shift']
+            if 'wl' in terms:
+                terms['wl'].append(('shift', -2j*np.pi*f*factors['shift']))
 
-        profile = instrumental_profile
-        for component in components:
-            profile = convolve(profile, component, mode='same') * resolution
+        profile = fine.inverse(H, nk)
 
         y = A*profile
         self.profiles['y'] = y
-        lowres_y = np.interp(orig_x, x, y)
+        lowres_y = fine.downsample(y) # the points of orig_x
+        # normalize intensity to A
+        y = A*lowres_y/np.sum(lowres_y)/norm_resolution
+        if derivatives:
+            self.derivatives = self.line_derivatives(fine, nk, A, fine.downsample(profile),
+                                                     factors, terms, norm_resolution)
+        return y
+
+
+    def get_jacobian(self, x, params=("A", "wl"), **kwargs):
+        """ Return the line profile and its derivatives with respect to the
+        parameters <params> (see derivative_parameters), as array with one
+        column per parameter. All other keyword arguments are passed to 
+        get_profile(). """
+        y = self.get_profile(x, derivatives=params, **kwargs)
+        return y, np.array([self.derivatives[name] for name in params]).T
+
+
+    def get_profiles(self, x, A = 1, wl = None, T = None, B = None, ne = None,
+                     Te = None, ng = None, instr_func = None, w = None, mu = None,
+                     pert = None, Instr_on=None, Doppler_on=None, Stark_on=None,
+                     Zeeman_on=None, vdW_on=None, analytic=None, tolerance=None):
+
+        """ Return the emission line profiles for many sets of parameters at
+        once, e.g. for parameter scans or imaging spectroscopy. 
+        
+        <A>, <wl>, <T>, <B>, <ne>, <Te>, <ng>: Numbers or arrays, which are
+        broadcast against each other. Values that are None are taken from
+        the emission_line object.
+        All other parameters are the same for all profiles, see get_profile().
+        pyplas plasma objects are not supported here.
+
+        Returns an array with the shape of the broadcast parameters plus 
+        one axis for x, i.e. one profile per row for 1D parameter arrays.
+        The profiles are the same as from get_profile() (to the tolerance of
+        the convolution). All profiles share one fine grid and their 
+        components and FFTs are calculated as 2D arrays. self.profiles is 
+        not updated.
+        """
+
+        values = [A, wl, T, B, ne, Te, ng]
+        defaults = [1, self.wl, self.T, self.B, self.ne, self.Te, self.ng]
+        values = [d if v is None else v for v, d in zip(values, defaults)]
+        values = np.broadcast_arrays(*[np.atleast_1d(np.asarray(
+            0.0 if v is None else v, dtype=float)) for v in values])
+        shape = values[0].shape
+        A, wl, T, B, ne, Te, ng = [v.ravel() for v in values]
+        n = len(A)
+
+        if instr_func == None and self.instr:
+            instr_func = self.instr
+        if w == None and self.w:
+            w = self.w
+        if mu == None:
+            mu = self.mu
+        if Instr_on == None:
+            Instr_on = self.Instr_on
+        if Doppler_on == None:
+            Doppler_on = self.Doppler_on
+        if Stark_on == None:
+            Stark_on = self.Stark_on
+        if Zeeman_on == None:
+            Zeeman_on = self.Zeeman_on
+        if vdW_on == None:
+            vdW_on = self.vdW_on
+        if analytic == None:
+            analytic = self.analytic
+        if tolerance == None:
+            tolerance = self.tolerance
+
+        if pert == None:
+            pert = self.pert
+        elif isinstance(pert, str):
+            name, charge = parse_spectroscopic_name(pert)
+            pert = species(name, charge*const.e)
+        if pert:
+            pert_T = np.full(n, float(pert.T)) if pert.T else T
+        else:
+            # the emitters themselves, as in get_profile()
+            pert = copy(self.transition.particle)
+            pert_T = T
+
+        t = self.transition
+        coarse = x if isinstance(x, grid) else grid(x)
+        x = coarse.x
+        xc = coarse.middle
+
+        # which components are needed for at least one profile
+        on = lambda flag, value: (flag=='auto' and np.any(value)) or flag==True
+        use_doppler = on(Doppler_on, T)
+        use_stark = on(Stark_on, ne) and self.stark_supported(Stark_on)
+        use_zeeman = on(Zeeman_on, B)
+        use_vdW = on(vdW_on, ng)
+        use_instr = Instr_on=='auto' or Instr_on==True
+        if use_vdW and not np.any(pert_T*ng):
+            if vdW_on==True:
+                print('Missing perturber/neutral density and temperature for van der Waals broadening. Skipping.')
+            use_vdW = False
+        if use_zeeman and not (t.upperJ and t.lowerJ and t.upperG and t.lowerG):
+            print('Missing quantum numbers (J) or Lande G values for Zeeman splitting. Skipping.')
+            use_zeeman = False
+
+        # FWHM of the components for each profile, 0 if not present
+        vD = np.zeros(n) # Doppler, relative to the wavelength
+        wL = np.zeros(n) # sum of the Lorentzian components
+        tabulated = np.zeros(n, dtype=bool) # tabulated Stark profiles
+        if use_doppler:
+            vD = np.sqrt(8 * const.k * T * np.log(2) / self.m) / const.c
+        if use_stark:
+            this_stark = stark.stark(t, line=self.stark_line)
+            rows = ne > 0
+            for group, te in ((rows & (Te > 0), Te), (rows & ~(Te > 0), None)):
+                if np.any(group):
+                    wS = this_stark.get_width(ne[group], None if te is None else te[group], pert)
+                    if wS is None:
+                        tabulated[group] = True
+                    else:
+                        wL[group] = wL[group] + wS
+        hydrogen_vdW = use_vdW and t.emitter.symbol == "H" # fine structure components
+        if use_vdW:
+            this_vdW = vdW.vdW(t, pert=pert)
+            vdW_rows = (ng > 0) & (pert_T > 0)
+            if not hydrogen_vdW:
+                wV = this_vdW.get_width(t, ng[vdW_rows], pert_T[vdW_rows])
+                wL[vdW_rows] = wL[vdW_rows] + wV
+
+        if analytic and not (use_zeeman or np.any(tabulated) or hydrogen_vdW or
+                             (instr_func and use_instr)):
+            # all components are Gaussians or Lorentzians: Voigt profiles
+            # like analytic_profile()
+            resolution = abs((x[-1]-x[0])/(len(x)*reference_oversampling-1))
+            wG2 = (vD*wl)**2
+            if w and use_instr:
+                parts = [(1-mu, np.sqrt(wG2 + w**2), wL), (mu, np.sqrt(wG2), wL + w)]
+            else:
+                wG = np.where((wG2 > 0) | (wL > 0), np.sqrt(wG2), resolution)
+                parts = [(1, wG, wL)]
+            y = np.zeros((n, len(x)))
+            for weight, wG, wL in parts:
+                if weight:
+                    y = y + weight*voigt_function(x, wl[:,None], wG[:,None], wL[:,None])
+            y = A[:,None]*y/np.sum(y, axis=1, keepdims=True)/resolution
+            return y.reshape(shape + (len(x),))
+
+        # Widths of the components of each profile (one column per profile)
+        # to plan the fine grids. Profiles with the same fine grid are
+        # calculated together.
+        gaussian, lorentzian, sampled = [vD*xc], [wL], [np.zeros(n)]
+        if np.any(tabulated):
+            estimate = stark.stark(t, line=self.stark_line)
+            estimate.fast = True # Lorentzian estimate of the tabulated profile
+            wS = estimate.get_width(ne[tabulated], None, pert)
+            if wS is not None:
+                lorentzian.append(np.zeros(n))
+                lorentzian[-1][tabulated] = sampled[0][tabulated] = wS
+        splitting = np.zeros(n)
+        if use_zeeman:
+            bm = const.physical_constants['Bohr magneton'][0]
+            splitting = xc * bm * B / (const.h * const.c / (xc * 1e-9))
+        if hydrogen_vdW:
+            lorentzian.append(np.zeros(n))
+            lorentzian[-1][vdW_rows] = this_vdW.get_width(t, ng[vdW_rows], pert_T[vdW_rows])
+            sampled.append(lorentzian[-1])
+        if instr_func and use_instr:
+            lorentzian.append(np.full(n, estimate_fwhm(instr_func, x, xc)))
+            sampled.append(lorentzian[-1])
+        elif w and use_instr:
+            (lorentzian if mu > 0 else gaussian).append(np.full(n, w))
+            sampled.append(np.full(n, w))
+        gaussian, lorentzian = np.transpose(gaussian), np.transpose(lorentzian)
+        sampled = np.transpose(sampled)
+        plans = {}
+        for i in range(n):
+            plan = plan_grid(x, gaussian[i], lorentzian[i], tolerance, 
+                             sampled[i], splitting[i])
+            plans.setdefault(plan, []).append(i)
+
+        norm_resolution = abs((x[-1]-x[0])/(len(x)*reference_oversampling-1))
+        nk = 1 + int(np.any(tabulated)) + int(hydrogen_vdW)
+        broadened = (vD > 0) | (wL > 0) | tabulated
+        if hydrogen_vdW:
+            broadened = broadened | vdW_rows
+        y = np.zeros((n, len(x)))
+        for plan, group in plans.items():
+            fine = coarse.refine(*plan)
+            self.oversampling, self.padding = fine.factor, fine.pad
+            middle_wl = fine.middle
+            f = fine.frequencies(nk)
+            if use_zeeman:
+                # the splitting is proportional to B
+                wls, intensities = zeeman_components(middle_wl, 1, t.upperJ, t.lowerJ, t.upperG, t.lowerG)
+                offsets, index = np.unique(np.round(wls - middle_wl, 12), return_inverse=True)
+                intensities = np.bincount(index, intensities)
+                # symmetric patterns have a real transform, sum of cosines
+                symmetric = np.allclose(offsets, -offsets[::-1]) and \
+                    np.allclose(intensities, intensities[::-1])
+                if symmetric:
+                    intensities = np.where(offsets > 0, 2, 1)*intensities
+                    offsets, intensities = offsets[offsets >= 0], intensities[offsets >= 0]
+            if w and use_instr and not instr_func:
+                instrument = lambda: (None, fine.kernel_transform(psd_voigt(fine.x, middle_wl, w, mu), nk))
+                instrument = self.cached_component('instrument', instrument, fine.key, nk, w, mu)
+            else:
+                # delta function, see get_profile(). Only needed for profiles
+                # without any broadening.
+                instrument = gauss_transform(f, 2*fine.resolution)
+
+            block = max(1, max_batch_points // len(f))
+            for start in range(0, len(group), block):
+                rows = np.array(group[start:start+block])
+                H = np.ones((len(rows), len(f)))
+                if use_doppler:
+                    H = H * gauss_transform(f, middle_wl*vD[rows,None])
+                if np.any(wL[rows]):
+                    H = H * lorentz_transform(f, wL[rows,None])
+                if use_zeeman:
+                    fields, index = np.unique(B[rows], return_inverse=True)
+                    phase = 2*np.pi*f*fields[:,None]
+                    Z = np.zeros(phase.shape, dtype=float if symmetric else complex)
+                    for d, I in zip(offsets, intensities):
+                        if I:
+                            Z += I*np.cos(d*phase)
+                            if not symmetric:
+                                Z -= 1j*I*np.sin(d*phase)
+                    H = H * Z[index]
+                if np.any(tabulated[rows]) or hydrogen_vdW:
+                    H = H.astype(complex)
+                kernels = None
+                if np.any(tabulated[rows]):
+                    # all tabulated profiles of the block in one step
+                    tab = rows[tabulated[rows]]
+                    kernels = this_stark.get_profiles(fine, ne[tab], Te[tab], pert, pert_T[tab])
+                    if kernels is not None:
+                        H[tabulated[rows]] = H[tabulated[rows]] * fine.kernel_transform(kernels, nk)
+                for j, i in enumerate(rows):
+                    if tabulated[i] and kernels is None:
+                        stark_pert = None
+                        if pert_T[i]:
+                            stark_pert = copy(pert)
+                            stark_pert.T = pert_T[i]
+                        kernel = this_stark.get_profile(fine, ne[i], Te[i], stark_pert)
+                        H[j] = H[j] * fine.kernel_transform(kernel, nk)
+                    if hydrogen_vdW and vdW_rows[i]:
+                        kernel = this_vdW.get_profile(fine, ng[i], pert_T[i])
+                        H[j] = H[j] * fine.kernel_transform(kernel, nk)
+                if instr_func and use_instr:
+                    centers, index = np.unique(wl[rows], return_inverse=True)
+                    H = H * fine.transform([instr_func(fine.x, c) for c in centers], nk)[index]
+                else:
+                    if not (w and use_instr):
+                        H[~broadened[rows]] = H[~broadened[rows]] * instrument
+                    else:
+                        H = H * instrument
+                    centers, index = np.unique(wl[rows], return_inverse=True)
+                    H = H * fine.shift(centers, nk)[index]
+                lowres_y = fine.downsample(fine.inverse(H, nk))
+                y[rows] = A[rows,None]*lowres_y/np.sum(lowres_y, axis=1, keepdims=True)/norm_resolution
+        return y.reshape(shape + (len(x),))
+
+
+    def fit(self, x, y, free=("A", "wl"), p0=None, bounds=None, sigma=None,
+            max_replan=3, jacobian=True, **kwargs):
+
+        """ Fit the line profile to a measured spectrum by least squares.
+
+        <x>: Wavelength axis in nm (array or owlspec.grid.grid).
+        <y>: Measured intensities on x.
+        <free>: Names of the fitted parameters, any of A, wl, T, B, ne, Te, 
+                ng, w and mu. All other parameters are fixed.
+        <p0>: Dictionary with start values (and values of fixed parameters).
+              Defaults to the values of the emission_line object, A defaults
+              to the area of y.
+        <bounds>: Dictionary {name: (lower, upper)} for the free parameters.
+                  Defaults to positive values, 0 to 1 for mu, and no limits 
+                  for wl.
+        <sigma>: Uncertainty of y (number or array), used as weights.
+        <max_replan>: The fine grid of the convolution is kept fixed during
+                      the fit, so that the profile changes smoothly with the
+                      parameters. If the result needs a different grid, the
+                      fit is continued on the new one, at most max_replan 
+                      times.
+        <jacobian>: Use the analytic derivatives of the profile (see 
+                    get_jacobian), otherwise finite differences with one 
+                    extra profile per free parameter.
+        Parameters can also be given as keyword arguments like in 
+        get_profile() (e.g. w=0.02), as start or fixed values; p0 takes 
+        precedence. All other keyword arguments are passed to get_profile()
+        (e.g. instr_func, pert, tolerance).
+
+        Returns a dictionary with
+        "params": All parameters (fitted and fixed),
+        "errors": Standard errors of the free parameters, from the 
+                  covariance matrix of the fit,
+        "y": The fitted profile on x,
+        "success", "message": From scipy.optimize.least_squares,
+        "chi2": Sum of the squared (weighted) residuals,
+        "stats": Number of profile evaluations, total time and time per 
+                 evaluation in s, and the component cache hits/misses.
+        The emission_line object is not changed.
+        """
+        from scipy.optimize import least_squares # import here for startup performance
+        start_time = time.perf_counter()
+        coarse = x if isinstance(x, grid) else grid(x)
+        y = np.asarray(y, dtype=float)
+        sigma = np.ones(len(y)) if sigma is None else np.broadcast_to(sigma, y.shape)
+
+        values = {"A": None, "wl": self.wl, "T": self.T, "B": self.B, "ne": self.ne,
+                  "Te": self.Te, "ng": self.ng, "w": self.w, "mu": self.mu}
+        unknown = [name for name in list(free) + list(p0 or {}) if name not in values]
+        if unknown:
+            raise ValueError("Can not fit " + ", ".join(unknown) + 
+                             ". Parameters are " + ", ".join(values))
+        # fixed values given like in get_profile(), p0 takes precedence
+        values.update({name: kwargs.pop(name) for name in list(kwargs) if name in values})
+        values.update(p0 or {})
+        if values["A"] is None:
+            x = coarse.x
+            values["A"] = abs(np.sum(y) * (x[-1]-x[0])/(len(x)*reference_oversampling-1))
+        for name in free:
+            if values[name] is None:
+                raise ValueError("Need a start value for " + name)
+        limits = {name: (0, np.inf) for name in values}
+        limits["wl"] = (-np.inf, np.inf)
+        limits["mu"] = (0, 1)
+        limits.update(bounds or {})
+
+        # the free parameters are fitted relative to their start values, or
+        # to the width of their bounds (or 1) if they start at 0
+        free = list(free)
+        def typical(name):
+            if values[name]:
+                return abs(values[name])
+            width = limits[name][1] - limits[name][0]
+            return width if np.isfinite(width) and width > 0 else 1.0
+        scale = np.array([typical(name) for name in free], dtype=float)
+        lower = np.array([limits[name][0] for name in free])/scale
+        upper = np.array([limits[name][1] for name in free])/scale
+        p = np.clip(np.array([values[name] for name in free])/scale, lower, upper)
+
+        evaluations = [0]
+        def parameters(p):
+            params = dict(values)
+            params.update(zip(free, p*scale))
+            return params
+
+        def residuals(p):
+            evaluations[0] += 1
+            return (self.get_profile(coarse, **parameters(p), **kwargs) - y)/sigma
+
+        def jac(p):
+            evaluations[0] += 1
+            _, J = self.get_jacobian(coarse, free, **parameters(p), **kwargs)
+            return J*scale/sigma[:,None]
+
+        self_state = self.oversampling, self.padding, self.profiles, self.derivatives
+        cache_before = cache_info()
+        try:
+            for i in range(max_replan + 1):
+                residuals(p) # plans the fine grid for the current parameters
+                plan = self.oversampling, self.padding
+                coarse.freeze(None if plan[0] is None else coarse.refine(*plan))
+                result = least_squares(residuals, p, jac=jac if jacobian else '2-point',
+                                       bounds=(lower, upper), x_scale=1.0)
+                p = result.x
+                coarse.freeze(None)
+                residuals(p)
+                if (self.oversampling, self.padding) == plan:
+                    break
+            params = parameters(p)
+            fitted = self.get_profile(coarse, **params, **kwargs)
+        finally:
+            coarse.freeze(None)
+            self.oversampling, self.padding, self.profiles, self.derivatives = self_state
+
+        # covariance from the Jacobian at the solution
+        dof = max(1, len(y) - len(free))
+        chi2 = np.sum(result.fun**2)
+        covariance = np.linalg.pinv(result.jac.T @ result.jac) * chi2/dof
+        errors = dict(zip(free, np.sqrt(np.diag(covariance))*scale))
+
+        duration = time.perf_counter() - start_time
+        cache_after = cache_info()
+        stats = {"evaluations": evaluations[0], "time": duration,
+                 "time_per_evaluation": duration/evaluations[0],
+                 "cache_hits": sum(cache_after[n]["hits"] - cache_before[n]["hits"] for n in cache_after),
+                 "cache_misses": sum(cache_after[n]["misses"] - cache_before[n]["misses"] for n in cache_after)}
+        return {"params": params, "errors": errors, 
+                "y": fitted,
+                "success": result.success, "message": result.message, 
+                "chi2": chi2, "stats": stats}
+
+
+    def ne_from_width(self, width, Te=None, T=None, w=None, mu=None, pert=None):
+        """ Electron density (m^-3) from the measured FWHM <width> (nm) of a
+        line with tabulated Stark profiles (H alpha, H beta, He 447.1 nm,
+        He 492.2 nm). Interpolated from precalculated widths of the Stark
+        profiles convolved with the Doppler profile (emitter temperature
+        <T>) and the psd_voigt instrumental function (<w>, <mu>), see
+        stark.ne_from_width. The table for a new combination of T, w and
+        mu is calculated on first use (seconds) and saved, see 
+        stark.widths. Zeeman and van der Waals broadening are not
+        included. <width> and <Te> can be arrays (e.g. time series), T is
+        a single value. All parameters default to the values of the line.
+        NaN for widths outside of the tables, None if the line has no 
+        tabulated profiles. """
+        Te = self.Te if Te is None else Te
+        T = self.T if T is None else T
+        w = self.w if w is None else w
+        mu = self.mu if mu is None else mu
+        if pert == None:
+            pert = self.pert
+        elif isinstance(pert, str):
+            name, charge = parse_spectroscopic_name(pert)
+            pert = species(name, charge*const.e)
+        if self.instr is not None:
+            print("WARNING: ne_from_width does not include custom instrumental functions")
+        T_pert = None
+        if not pert:
+            # the emitters themselves, as in get_profile()
+            pert = copy(self.transition.particle)
+            T_pert = T or 0
+        elif not pert.T:
+            T_pert = T or 0
+        doppler = 0
+        if T:
+            doppler = self.wl*np.sqrt(8*const.k*T*np.log(2)/self.m)/const.c
+        return stark.stark(self.transition, line=self.stark_line).ne_from_width(
+            width, Te, pert, T_pert, doppler, (w, mu) if w else None)
+
+
+    def line_derivatives(self, fine, nk, A, y, factors, terms, resolution):
+        """ Derivatives of the normalized line profile from the transforms
+        of the components <factors> {component: transform} and their 
+        derivatives <terms> {parameter: [(component, derivative)]}. <y> is
+        the profile before normalization, on the points of the parent axis.
+        Each parameter needs one inverse FFT. """
+        derivatives = {}
+        for name, parts in terms.items():
+            dH = np.zeros(len(fine.frequencies(nk)), dtype=complex)
+            for component, dF in parts: # product rule
+                for other, F in factors.items():
+                    if other != component:
+                        dF = dF * F
+                dH = dH + dF
+            dy = fine.downsample(fine.inverse(dH, nk)) if parts else np.zeros(len(y))
+            derivatives[name] = normalized_derivative(A, y, dy, resolution)
+        if 'A' in terms:
+            derivatives['A'] = y/np.sum(y)/resolution
+        return derivatives
+
+
+    def cached_component(self, name, compute, *params):
+        """ Fourier transform of the component <name>, from the cache if it
+        was calculated with the same <params> before. compute() returns the
+        profile for self.profiles and the transform. """
+        profile, transform = component_cache[name].get(
+            (name,) + quantize(*params), compute)
+        if profile is not None:
+            self.profiles[name] = profile
+        return transform
+
+
+    def stark_supported(self, Stark_on):
+        """ True if Stark broadening data is registered for the line (see
+        owlspec.stark.registry). Prints a note if <Stark_on> is True and
+        the line is not supported. """
+        if self.stark_line is None:
+            if Stark_on==True:
+                print('Stark broadening not available for this line. Skipping.')
+            return False
+        return True
+
+
+    def component_widths(self, x, xc, instr_func, w, mu, T, B, ne, Te,
+                         Stark_pert, vdW_pert, Instr_on, Doppler_on, Stark_on,
+                         Zeeman_on, vdW_on):
+        """ Estimated FWHM (nm) of the active components, as lists of widths
+        with Gaussian and with Lorentzian wings and of the components that
+        are sampled on the fine grid, and the Zeeman splitting (nm). Used
+        to plan the fine grid, see grid.plan_grid. 
+        Parameters are resolved by get_profile(). """
+        gaussian, lorentzian, sampled, splitting = [], [], [], 0
+        if (Doppler_on=='auto' and T) or Doppler_on==True:
+            gaussian.append(xc/const.c * np.sqrt(8 * const.k * T * np.log(2) / self.m))
+
+        if ((Stark_on=='auto' and ne) or Stark_on==True) and self.stark_line is not None:
+            this_stark = stark.stark(self.transition, line=self.stark_line)
+            wS = this_stark.get_width(ne, Te, Stark_pert)
+            if wS is None and self.transition.emitter.symbol == "H":
+                this_stark.fast = True # Lorentzian estimate of the tabulated profile
+                wS = this_stark.get_width(ne, Te, Stark_pert)
+                sampled.append(wS)
+            lorentzian.append(wS)
+
+        if ((Zeeman_on=='auto' and B) or Zeeman_on==True) and B:
+            bm = const.physical_constants['Bohr magneton'][0]
+            E0 = const.h * const.c / (xc * 1e-9)
+            splitting = xc * bm * B / E0 # for g = 1
+
+        if ((vdW_on=='auto' and vdW_pert) or vdW_on==True) and \
+                vdW_pert.T and vdW_pert.n:
+            this_vdW = vdW.vdW(self.transition, pert=vdW_pert)
+            lorentzian.append(this_vdW.get_width(self.transition, vdW_pert.n, vdW_pert.T))
+            if self.transition.emitter.symbol == "H":
+                sampled.append(lorentzian[-1])
+
+        if instr_func and (Instr_on=='auto' or Instr_on==True):
+            lorentzian.append(estimate_fwhm(instr_func, x, xc))
+            sampled.append(lorentzian[-1])
+        elif w and (Instr_on=='auto' or Instr_on==True):
+            if mu > 0:
+                lorentzian.append(w)
+            else:
+                gaussian.append(w)
+            sampled.append(w)
+        return gaussian, lorentzian, sampled, splitting
+
+
+    def analytic_profile(self, x, A, wl, instr_func, w, mu, T, B, ne, Te,
+                         Stark_pert, vdW_pert, Instr_on, Doppler_on, Stark_on,
+                         Zeeman_on, vdW_on, derivatives=(), vdW_tied=(None, None)):
+        """ Line profile as sum of Voigt profiles, evaluated directly on x.
+        Gaussian widths (Doppler, instrument) add in quadrature, Lorentzian
+        widths (Stark, vdW, instrument) add linearly. A psd_voigt instrument
+        is a mix of a Gaussian and a Lorentzian with the same width, so its
+        convolution with a Voigt profile are two Voigt profiles.
+        Returns None if any active component has no closed form (tabulated
+        Stark profile, Zeeman pattern or custom instrumental function). 
+        The <derivatives> follow from the derivatives of the Voigt profiles
+        with respect to their position and widths. <vdW_tied> are the names
+        of the parameters that the density and temperature of the vdW
+        perturbers are set from (or None).
+        Parameters are resolved by get_profile(). """
+        if (Zeeman_on=='auto' and B) or Zeeman_on==True:
+            return None
+        if instr_func and (Instr_on=='auto' or Instr_on==True):
+            return None
+
+        s = 0 # lineshift in nm
+        # same normalization as the convolution
+        resolution = abs((x[-1]-x[0])/(len(x)*reference_oversampling-1))
+        middle_wl = x[int(len(x)/2)-1]
+        wG2 = 0 # squared Gaussian FWHM
+        wL = 0 # Lorentzian FWHM
+        dG2, dL = {}, {} # derivatives of wG2 and wL
+        profiles = component_profiles.fromkeys(['x', 'y', 'Doppler', 'Zeeman', 'Stark', 'vdW', 'instrument'])
+        profiles['x'] = x
+
+        if (Doppler_on=='auto' and T) or Doppler_on==True:
+            wD = (wl+s)/const.c * np.sqrt(8 * const.k * T * np.log(2) / self.m)
+            wG2 = wG2 + wD**2
+            dG2['T'], dG2['wl'] = wD**2/T, 2*wD**2/(wl+s)
+            profiles['Doppler'] = np.exp(-4*np.log(2)*(x-middle_wl)**2/wD**2)
+
+        if ((Stark_on=='auto' and ne) or Stark_on==True) and self.stark_supported(Stark_on):
+            this_stark = stark.stark(self.transition, line=self.stark_line)
+            wS = this_stark.get_width(ne, Te, Stark_pert)
+            if wS is None:
+                return None
+            wL = wL + wS
+            if 'ne' in derivatives or 'Te' in derivatives:
+                dL['ne'], dL['Te'] = this_stark.get_width_derivatives(ne, Te, Stark_pert)
+            profiles['Stark'] = wS**2/(4*(x-middle_wl)**2 + wS**2)
+
+        if (vdW_on=='auto' and vdW_pert) or vdW_on==True:
+            if not (vdW_pert.T and vdW_pert.n):
+                if vdW_on==True:
+                    print('Missing perturber/neutral density and temperature for van der Waals broadening. Skipping.')
+            elif self.transition.emitter.symbol == "H":
+                return None # sum of fine structure components
+            else:
+                this_vdW = vdW.vdW(self.transition, pert=vdW_pert)
+                wV = this_vdW.get_width(self.transition, vdW_pert.n, vdW_pert.T)
+                wL = wL + wV
+                # the width is proportional to n*T^0.3
+                for name, dw in zip(vdW_tied, (wV/vdW_pert.n, 0.3*wV/vdW_pert.T)):
+                    if name:
+                        dL[name] = dL.get(name, 0) + dw
+                profiles['vdW'] = wV**2/(4*(x-middle_wl)**2 + wV**2)
+
+        # (weight, Gaussian FWHM, Lorentzian FWHM) of the Voigt profiles and
+        # the derivatives of the weight, wG2 and wL of the part
+        if w and (Instr_on=='auto' or Instr_on==True):
+            parts = [(1-mu, np.sqrt(wG2 + w**2), wL, {'mu': -1}, {'w': 2*w}, {}), 
+                     (mu, np.sqrt(wG2), wL + w, {'mu': 1}, {}, {'w': 1})]
+            instrument = (psd_voigt, x, wl+s, w, mu)
+        else:
+            if wG2 or wL:
+                parts = [(1, np.sqrt(wG2), wL, {}, {}, {})]
+            else:
+                parts = [(1, resolution, 0, {}, {}, {})]
+            # delta function, two points of x wide so that it is visible
+            instrument = (gauss_function, x, wl+s, 2*abs(x[1]-x[0]))
+        def instrumental_profile(function=instrument[0], args=instrument[1:]):
+            profile = function(*args)
+            return profile/np.max(profile)
+        profiles['instrument'] = instrumental_profile # when it is read
+
+        y = np.zeros(len(x))
+        dy = {name: np.zeros(len(x)) for name in derivatives}
+        for weight, wG, wL, dweight, dwG2, dwL in parts:
+            if not dy:
+                if weight:
+                    y = y + weight*voigt_function(x, wl+s, wG, wL)
+                continue
+            V, dV_dxc, dV_dwG, dV_dwL = voigt_derivatives(x, wl+s, wG, wL)
+            y = y + weight*V
+            for name in dy:
+                dV = dV_dxc if name == 'wl' else 0
+                if wG:
+                    dV = dV + dV_dwG*(dG2.get(name, 0) + dwG2.get(name, 0))/(2*wG)
+                dV = dV + dV_dwL*(dL.get(name, 0) + dwL.get(name, 0))
+                dy[name] = dy[name] + dweight.get(name, 0)*V + weight*dV
+        if dy:
+            self.derivatives = {name: normalized_derivative(A, y, d, resolution) 
+                                for name, d in dy.items()}
+            if 'A' in dy:
+                self.derivatives['A'] = y/np.sum(y)/resolution
         # normalize intensity to A
-        y = A*lowres_y/np.sum(lowres_y)/resolution
-        return y
\ No newline at end of file
+        y = A*y/np.sum(y)/resolution
+        profiles['y'] = y
+        self.profiles = profiles
+        return y
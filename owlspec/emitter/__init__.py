@@ -2,3 +2,4 @@
 from .transition import *
 from .level import *
 from .species import *
+from .graph import *
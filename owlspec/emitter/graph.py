@@ -0,0 +1,99 @@
+#!/usr/bin/python
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
+from ..util import parse_spectroscopic_name, get_spectroscopic_name
+from ..line_table import parse_line_table
+from .. import nist_cache
+
+
+class transition_graph():
+    def __init__(self, emitter_name, wl_range=(1, 99999), tolerance=1e-3):
+        """ All levels and radiative transitions of one emitter, e.g. for
+        collisional radiative models. Uses one NIST line query and one
+        level query.
+        <emitter_name>: String in spectroscopic notation, e.g. "Ar I".
+        <wl_range>: Wavelength range of the transitions in nm.
+        <tolerance>: Maximum difference in eV between the level energies
+                     given in the line list and in the level list.
+
+        Levels are sorted by energy and stored as arrays E, J, g, G and
+        conf. Transitions are stored as arrays upper, lower (level indices),
+        Aik and wl, and as sparse matrix A[upper, lower] = Aik."""
+        self.name, self.charge = parse_spectroscopic_name(emitter_name)
+        self.spec_name = get_spectroscopic_name(self.name, self.charge)
+
+        levels = nist_cache.query_levels(self.spec_name)
+        bound = np.isfinite(levels['E']) & (levels['term'] != 'Limit')
+        order = np.argsort(levels['E'][bound], kind="stable")
+        self.E = levels['E'][bound][order] # Energy in eV
+        self.J = levels['J'][bound][order]
+        self.g = levels['g'][bound][order]
+        self.G = levels['G'][bound][order]
+        self.conf = levels['conf'][bound][order]
+        n = len(self.E)
+
+        nist_lines = nist_cache.query_lines(wl_range[0], wl_range[-1],
+                                            self.spec_name, wavelength_type='vac+air')
+        lines, self.diagnostics = parse_line_table(nist_lines)
+        wl = np.where(np.isfinite(lines['wl']), lines['wl'], lines['ritz'])
+        upper = self.level_index(lines['Ek'], tolerance)
+        lower = self.level_index(lines['Ei'], tolerance)
+        known = np.isfinite(lines['Aki']) & np.isfinite(wl) & \
+            (upper >= 0) & (lower >= 0)
+
+        self.upper = upper[known]
+        self.lower = lower[known]
+        self.Aik = lines['Aki'][known]
+        self.wl = wl[known]
+        self.A = sparse.csr_matrix((self.Aik, (self.upper, self.lower)), shape=(n, n))
+
+
+    def level_index(self, energy, tolerance=1e-3):
+        """ Index of the level closest to <energy> (eV, scalar or array).
+        -1 if there is no level within <tolerance> eV. """
+        energy = np.asarray(energy, dtype=float)
+        if len(self.E) == 0:
+            return np.full(energy.shape, -1)
+        right = np.clip(np.searchsorted(self.E, energy), 0, len(self.E)-1)
+        left = np.clip(right-1, 0, len(self.E)-1)
+        idx = np.where(np.abs(energy-self.E[left]) <= np.abs(energy-self.E[right]),
+                       left, right)
+        found = np.abs(energy-self.E[idx]) <= tolerance # False for nan
+        return np.where(found, idx, -1)
+
+
+    def total_decay_rates(self):
+        "Sum of Aik of all transitions from each level in 1/s."
+        return np.asarray(self.A.sum(axis=1)).ravel()
+
+
+    def get_lifetimes(self):
+        "Radiative lifetime of each level in s, inf without known decays."
+        rates = self.total_decay_rates()
+        with np.errstate(divide="ignore"):
+            return 1/rates
+
+
+    def get_branching_ratios(self):
+        "Branching ratio of each transition (ordered as self.Aik)."
+        return self.Aik/self.total_decay_rates()[self.upper]
+
+
+    def branching_matrix(self):
+        "Sparse matrix B[upper, lower] of branching ratios."
+        rates = self.total_decay_rates()
+        scale = np.divide(1, rates, out=np.zeros(len(rates)), where=rates > 0)
+        return sparse.diags(scale) @ self.A
+
+
+    def get_cascade(self, source):
+        """ Total population rate of each level including radiative
+        cascades from higher levels, if the levels are populated directly
+        with the rates <source> (array with one entry per level).
+        Solves r = source + B^T r. """
+        n = len(self.E)
+        B = self.branching_matrix()
+        return spsolve(sparse.identity(n, format="csc") - B.T.tocsc(),
+                       np.asarray(source, dtype=float))
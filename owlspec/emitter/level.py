@@ -3,59 +3,49 @@
 import os
 import re
 from ..util import parse_spectroscopic_name
+from .. import nist_cache
+from ..elements import get_element
+from copy import copy
 import numpy as np
 
 class level():
-    def __init__(self, emitter_name, energy, debug=False):
+    def __init__(self, emitter_name, energy, debug=False, level_table=None):
+        """ Return the level of the emitter <emitter_name> (spectroscopic 
+        notation, e.g. "Ar I") closest to <energy> (in eV).
+        <level_table>: NIST level columns of the emitter as returned by
+                       owlspec.nist_cache.query_levels. Optional, only to
+                       share already loaded data between many levels. """
         self.name, self.charge = parse_spectroscopic_name(emitter_name)
         self.spec_name = emitter_name
-        from mendeleev import element
-        self.emitter = self.particle = element(self.name)
+        self.emitter = self.particle = copy(get_element(self.name))
         self.emitter.charge = self.charge
         self.emitter.m = self.emitter.mass
         self.emitter.Ei = self.emitter.ionenergies[1]
         self.charge = self.emitter.charge
         
-        from ..nist_levels import NistLevels
-        nist_levels = NistLevels.query(linename=emitter_name)
+        levels = level_table
+        if levels is None:
+            levels = nist_cache.query_levels(emitter_name)
 
-        # clean up the energy column from NIST levels (e.g. remove '[')
-        non_decimal = re.compile(r'[^\d.]+')
-        level_energies = []
-
-        for entry in nist_levels['Level (eV)']:
-            this_entry = non_decimal.sub('', str(entry))
-            try: 
-                this_entry = float(this_entry)
-            except:
-                this_entry = np.nan
-            level_energies.append(this_entry)
-        level_energies = np.array(level_energies, dtype=float)
-
-        # select upper and lower energy levels
-        level_idx = np.argmin((np.nan_to_num(level_energies)-energy)**2)
-        row = nist_levels[level_idx]
+        # select closest energy level
+        level_idx = np.argmin((np.nan_to_num(levels['E'])-energy)**2)
         
-        self.E = level_energies[level_idx] # Energy in eV
-        try:
-            self.J = float(eval(row['J'])) # Angular momentum, can be 5/2 or so...
-        except:
-            self.J = np.nan
+        self.E = float(levels['E'][level_idx]) # Energy in eV
+        self.J = float(levels['J'][level_idx]) # Angular momentum, can be 5/2 or so...
         
         try:
-            conf_end = row['Configuration'].split('.')
+            conf_end = levels['conf'][level_idx].split('.')
             if "(" in conf_end[-1]:
                 conf_end.pop()
             self.l = int(self.l_name_to_num(conf_end[-1][1]))
         except:
             self.l = np.nan
         
-        self.g = float(nist_levels[level_idx]['g']) # statistical weight
-        self.conf = row['Configuration'] # configuration and term string
+        self.g = float(levels['g'][level_idx]) # statistical weight
+        self.conf = str(levels['conf'][level_idx]) # configuration and term string
         
-        if 'Landé' in nist_levels.keys():
-            self.G = float(nist_levels[level_idx]['Landé']) #Lande g factor
-        else:
+        self.G = float(levels['G'][level_idx]) #Lande g factor
+        if np.isnan(self.G):
             self.G = None
         
 
@@ -76,16 +66,21 @@ class level():
         non_decimal = re.compile(r'[^\d.]+')
 
         # Load data tables from NIST (+- 1 nm around requested wl)
-        from astroquery.nist import Nist # import here for startup perfromance
-        import astropy.units as u
-        nist_lines = Nist.query(1*u.nm, 99999*u.nm, 
-                                linename=self.spec_name, wavelength_type='vac+air')
+        nist_lines = nist_cache.query_lines(1, 99999, self.spec_name,
+                                            wavelength_type='vac+air')
+        # all transitions share the lines and levels loaded here
+        level_table = nist_cache.query_levels(self.spec_name)
+
+        def row_transition(idx, wl):
+            return transition(self.spec_name, wl, wl_type="either",
+                              nist_lines=nist_lines[idx:idx+1],
+                              level_table=level_table)
 
         transitions_to = []
         transitions_from = []
         transitions_all = []
 
-        for entry in nist_lines:
+        for idx, entry in enumerate(nist_lines):
             if not np.ma.is_masked(entry['Ei           Ek']) \
                                     and not (np.ma.is_masked(entry['Observed']) and np.ma.is_masked(entry['Ritz']) ):
                 
@@ -101,7 +96,7 @@ class level():
                             except:
                                 break
                         if not np.isnan(wl):
-                            this_transition = transition(self.spec_name, wl, wl_type="either")
+                            this_transition = row_transition(idx, wl)
                             transitions_from.append(this_transition)                    
                             transitions_all.append(this_transition)
                     
@@ -116,7 +111,7 @@ class level():
                             except:
                                 break
                         if not np.isnan(wl):
-                            this_transition = transition(self.spec_name, wl, wl_type="either")
+                            this_transition = row_transition(idx, wl)
                             transitions_to.append(this_transition)                    
                             transitions_all.append(this_transition)
 
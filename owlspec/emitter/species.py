@@ -3,6 +3,7 @@
 import numpy as np
 import pyplas
 from scipy import constants as const
+from ..elements import get_element
 
 
 class species(pyplas.species):
@@ -15,6 +16,16 @@ class species(pyplas.species):
         self.symbol = self.name = self.element.symbol
         self.dipole_polarizability = self.element.dipole_polarizability
 
+    def element_info(self, name):
+        # same as pyplas, but with the shared element cache instead of a
+        # new mendeleev query for each species
+        self.element = get_element(name)
+        self.m = self.element.mass*const.u
+        try:
+            self.ionization_energy = self.element.ionenergies[int(round(self._q/const.e + 1, 0))]*const.eV
+        except KeyError:
+            self.ionization_energy = None
+
     @property
     def q(self):
         return self._q
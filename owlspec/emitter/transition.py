@@ -5,10 +5,12 @@ import re
 from ..util import parse_spectroscopic_name, get_spectroscopic_name
 from .level import level
 from .species import species
+from .. import nist_cache
 from scipy import constants as const
 
 class transition():
-    def __init__(self, emitter, wavelength, wl_type="Observed", debug=False):
+    def __init__(self, emitter, wavelength, wl_type="Observed", debug=False,
+                 nist_lines=None, level_table=None):
         """Return the closest transition for the specified emitter to the
         specified wavelength.
         <emitter>: String in spectroscopic notation, e.g. O I or Ar II or
@@ -18,6 +20,10 @@ class transition():
                       specify to picometer precision.
         <wl_type>: One of "Observed", "Ritz" or "either". 
                    Defaults to "Observed".
+        <nist_lines>: NIST line table to select the transition from. Only 
+                      needed to avoid a new query if it is already loaded.
+        <level_table>: NIST level columns of the emitter as returned by
+                       owlspec.nist_cache.query_levels. Optional, as above.
         
         Returns a transition object with entries: upperE, lowerE, upperl, 
         lowerl, upperg, lowerg, Aik, wl and the upper 
@@ -37,10 +43,10 @@ class transition():
         non_decimal = re.compile(r'[^\d.]+')
                 
         # Load data tables from NIST (+- 1 nm around requested wl)
-        from astroquery.nist import Nist
-        import astropy.units as u
-        nist_lines = Nist.query((wavelength-1)*u.nm, (wavelength+1)*u.nm, 
-                                linename=self.spec_name, wavelength_type='vac+air')
+        if nist_lines is None:
+            nist_lines = nist_cache.query_lines(wavelength-1, wavelength+1, 
+                                    self.spec_name, wavelength_type='vac+air')
+        self.level_table = level_table
         
         # select closest line
         if wl_type == "Observed":
@@ -99,14 +105,29 @@ class transition():
         self.upper_level, self.lower_level = self.levels()
         self.upper, self.lower = self.upper_level, self.lower_level
 
+    @staticmethod
+    def batch(emitter, wavelengths, wl_type="Observed", max_workers=None):
+        """Return a list of transitions of <emitter> closest to each of the
+        <wavelengths>. The NIST queries for all transitions are sent in 
+        parallel (see owlspec.nist_cache.prefetch) before the transitions
+        are created. Arguments as for transition()."""
+        if isinstance(emitter, str):
+            spec_name = get_spectroscopic_name(*parse_spectroscopic_name(emitter))
+        else:
+            spec_name = get_spectroscopic_name(emitter.name, emitter.charge)
+        nist_cache.prefetch(lines=[(wl-1, wl+1, spec_name, 'vac+air') 
+                                   for wl in wavelengths],
+                            levels=[spec_name], max_workers=max_workers)
+        return [transition(emitter, wl, wl_type) for wl in wavelengths]
+
     def l_name_to_num(self, name):
         chars = ["s","p","d","f","g","h","i","j"]
         num = chars.index(name)
         return num
 
     def levels(self):
-        upper_level = level(self.spec_name, self.upperE)
-        lower_level = level(self.spec_name, self.lowerE)
+        upper_level = level(self.spec_name, self.upperE, level_table=self.level_table)
+        lower_level = level(self.spec_name, self.lowerE, level_table=self.level_table)
         self.upperJ = upper_level.J
         self.upperG = upper_level.G
         self.lowerJ = lower_level.J
@@ -0,0 +1,223 @@
+#!/bin/python3
+""" Planning of the fine wavelength grid on which emission line components
+are calculated and convolved.
+
+A grid object holds a wavelength axis and caches the fine axes planned for
+it, including the points that map back to the original axis and the FFT
+length for the convolution. Create it once and pass it instead of the
+wavelength array to emission_line.get_profile() (or stark/vdW.get_profile())
+to avoid recalculating the fine axis on every call.
+
+The fine grid spacing is chosen so that the narrowest sampled component 
+(and the convolved line) is sampled with about 1/sqrt(tolerance) points per
+FWHM, which keeps the error of the linear interpolation back to the 
+original axis below ~tolerance of the line maximum. The grid is extended
+beyond the original axis if the wings of the widest component reach 
+further than the axis itself. """
+
+import hashlib
+import numpy as np
+
+__all__ = ["grid", "plan_grid", "fine_axis", "estimate_fwhm"]
+
+max_points = 2**22 # upper limit for the number of fine grid points
+max_fine_grids = 4 # fine grids cached per grid object
+
+
+class grid():
+    """ Wavelength axis <x> (nm) with cached fine axes.
+
+    Attributes:
+    <x>: The wavelength axis.
+    <resolution>: Mean point spacing in nm.
+    <middle>: Center wavelength of the axis, as used by fftconvolve with
+              mode='same'.
+    For fine grids created by refine() or plan():
+    <parent>: The grid this one was created from, None otherwise.
+    <factor>, <pad>: Oversampling factor and padding (points of the parent
+                     on each side).
+    <inner>: Slice of this axis that covers the parent axis.
+    <key>: Hashable identification of the axis, e.g. for caches. """
+
+    def __init__(self, x):
+        self.x = np.array(x, dtype=float)
+        self.resolution = abs((self.x[-1]-self.x[0])/(len(self.x)-1))
+        self.middle = self.x[int((len(self.x)-1)/2)]
+        self.parent = None
+        self.factor, self.pad, self.inner = 1, 0, slice(None)
+        self.key = hashlib.sha1(self.x.tobytes()).hexdigest()
+        self._fft_len = {}
+        self._frequencies = {}
+        self._fine = {}
+        self._frozen = None
+
+    def __len__(self):
+        return len(self.x)
+
+    def __repr__(self):
+        return "grid(" + str(len(self)) + " points, " + str(self.x[0]) + " to " + \
+            str(self.x[-1]) + " nm, factor " + str(self.factor) + ")"
+
+    def refine(self, factor, pad=0):
+        """ Return the fine grid with the oversampling <factor>, extended by
+        <pad> points on each side. Fine grids are cached. """
+        key = (int(factor), int(pad))
+        fine = self._fine.get(key)
+        if fine is None:
+            fine_x, inner = fine_axis(self.x, *key)
+            fine = grid(fine_x)
+            fine.parent = self
+            fine.factor, fine.pad, fine.inner = key[0], key[1], inner
+            fine.key = (self.key,) + key
+            if len(self._fine) >= max_fine_grids:
+                self._fine.pop(next(iter(self._fine)))
+            self._fine[key] = fine
+        return fine
+
+    def plan(self, gaussian=(), lorentzian=(), tolerance=1e-3, sampled=None,
+             splitting=0):
+        """ Return the fine grid for components with the given FWHM (nm),
+        see plan_grid, or the frozen fine grid. """
+        if self._frozen is not None:
+            return self._frozen
+        return self.refine(*plan_grid(self.x, gaussian, lorentzian, tolerance,
+                                      sampled, splitting))
+
+    def freeze(self, fine=None):
+        """ Let plan() always return the fine grid <fine>, e.g. during a 
+        fit so that the profiles change smoothly with the parameters. 
+        None to plan the fine grid again. """
+        self._frozen = fine
+
+    def downsample(self, y):
+        """ Values of <y> (on this fine grid, along the last axis) at the
+        points of the parent grid. """
+        return y[..., self.inner][..., ::self.factor]
+
+    def fft_length(self, kernels=1):
+        """ FFT length for the convolution with <kernels> arrays of the
+        length of this grid without wrap around. """
+        if kernels not in self._fft_len:
+            from scipy.fft import next_fast_len
+            n = len(self.x)
+            self._fft_len[kernels] = next_fast_len(n + kernels*(n-1), real=True)
+        return self._fft_len[kernels]
+
+    def frequencies(self, kernels=1):
+        """ Frequencies (1/nm) of the rfft with fft_length(kernels). """
+        if kernels not in self._frequencies:
+            from scipy import fft
+            step = (self.x[-1]-self.x[0])/(len(self.x)-1)
+            self._frequencies[kernels] = fft.rfftfreq(self.fft_length(kernels), step)
+        return self._frequencies[kernels]
+
+    def transform(self, a, kernels=1):
+        """ rfft of the array <a> on this grid, with fft_length(kernels).
+        2D arrays are transformed row by row. """
+        from scipy import fft
+        return fft.rfft(a, self.fft_length(kernels))
+
+    def kernel_transform(self, kernel, kernels=1):
+        """ rfft of <kernel> (array on this grid, centered on self.middle),
+        shifted to the origin and scaled by the resolution. Multiplying a 
+        transform with it convolves like fftconvolve(a, kernel, 'same') 
+        times the resolution. 2D arrays are transformed row by row. """
+        from scipy import fft
+        kernel = np.asarray(kernel)
+        n = len(self.x)
+        length = self.fft_length(kernels)
+        c = (n-1)//2
+        centered = np.zeros(kernel.shape[:-1] + (length,))
+        centered[..., :n-c] = kernel[..., c:]
+        centered[..., length-c:] = kernel[..., :c]
+        return fft.rfft(centered) * self.resolution
+
+    def shift(self, xc, kernels=1):
+        """ Fourier transform of a delta function at <xc> (nm). Moves
+        components that are centered on the origin to <xc>. One row per
+        value if <xc> is an array. """
+        xc = np.asarray(xc, dtype=float) - self.x[0]
+        return np.exp(-2j*np.pi*np.multiply.outer(xc, self.frequencies(kernels)))
+
+    def inverse(self, spectrum, kernels=1):
+        """ Inverse of transform(), on this grid. """
+        from scipy import fft
+        return fft.irfft(spectrum, self.fft_length(kernels))[..., :len(self.x)]
+
+
+def plan_grid(x, gaussian=(), lorentzian=(), tolerance=1e-3, sampled=None,
+              splitting=0):
+    """ Return the oversampling factor and the padding (in points of <x>
+    on each side) needed to calculate line components of the given widths
+    on the axis <x> to a relative accuracy of about <tolerance>.
+
+    <gaussian>: FWHM (nm) of components with Gaussian like wings.
+    <lorentzian>: FWHM (nm) of components with Lorentzian wings.
+    <sampled>: FWHM (nm) of the components that are sampled on the fine 
+               grid (numerical profiles, instrumental functions). Components
+               with analytic Fourier transforms only need to resolve the
+               convolved line. None if all components are sampled.
+    <splitting>: Distance (nm) of the outermost Zeeman component from the
+                 line center.
+    Widths that are None or not positive are ignored. """
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    span = abs(x[-1]-x[0])
+    dx = span/(n-1)
+    gaussian = [w for w in gaussian if w is not None and w > 0]
+    lorentzian = [w for w in lorentzian if w is not None and w > 0]
+    widths = gaussian + lorentzian
+    if sampled is not None:
+        wG, wL = np.sqrt(np.sum(np.square(gaussian))), np.sum(lorentzian)
+        widths = [w for w in sampled if w is not None and w > 0]
+        if wG or wL: # FWHM of the Voigt profile, Olivero 1977
+            widths.append(0.5346*wL + np.sqrt(0.2166*wL**2 + wG**2))
+    if not widths or dx == 0:
+        return 1, 0
+
+    # fine grid spacing
+    h = min(widths) * np.sqrt(tolerance)
+    factor = max(1, int(np.ceil(dx/h)))
+
+    # The components are centered on the grid, the line can be anywhere on
+    # the axis. The wings are needed up to one span away from the center.
+    tails = [3*w for w in gaussian] + [w/(np.pi*tolerance) for w in lorentzian]
+    reach = min(span, max(tails + [0]) + 2*splitting)
+    pad = int(np.ceil(max(0.0, reach - span/2)/dx))
+
+    if (n-1 + 2*pad)*factor + 1 > max_points:
+        factor = max(1, int((max_points-1)/(n-1 + 2*pad)))
+    return int(factor), int(pad)
+
+
+def estimate_fwhm(func, x, xc):
+    """ FWHM of the profile func(x, xc) (e.g. an instrumental function),
+    measured on the axis <x> or on a 50x finer axis if it is narrower than
+    three points of x. """
+    x = np.asarray(x, dtype=float)
+    dx = abs(x[-1]-x[0])/(len(x)-1)
+    y = np.asarray(func(x, xc))
+    width = np.count_nonzero(y >= np.max(y)/2) * dx
+    if width >= 3*dx:
+        return width
+    step = dx/50
+    y = np.asarray(func(xc + step*np.arange(-250, 251), xc))
+    return max(1, np.count_nonzero(y >= np.max(y)/2)) * step
+
+
+def fine_axis(x, factor, pad=0):
+    """ Upsample the axis <x> by <factor>, extended by <pad> points of <x>
+    on both sides. The points of x are part of the fine axis, non uniform
+    axes are interpolated with a spline. Returns the fine axis and the
+    slice of it that covers x. """
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    index = np.linspace(-pad, n-1+pad, (n-1+2*pad)*factor + 1)
+    dx = (x[-1]-x[0])/(n-1)
+    if np.allclose(np.diff(x), dx, rtol=1e-9, atol=0):
+        fine = x[0] + index*dx
+    else:
+        from scipy import interpolate
+        fine = interpolate.make_interp_spline(np.arange(n), x)(index)
+    inner = slice(pad*factor, pad*factor + (n-1)*factor + 1)
+    return fine, inner
@@ -0,0 +1,131 @@
+#!/bin/python3
+""" Conversion of NIST line tables (as returned by astroquery) into typed
+numpy structured arrays. The table is parsed once, afterwards all
+selections and intensity calculations are plain array operations. """
+
+import re
+import numpy as np
+
+__all__ = ["line_dtype", "parse_diagnostics", "parse_line_table", "as_line_table"]
+
+# wl: observed wavelength, ritz: Ritz wavelength (both nm), Aki in 1/s,
+# g and E (eV) of lower (i) and upper (k) level, rel: NIST relative
+# intensity. Missing or unparsable values are nan. valid marks rows that
+# are actual lines with an observed wavelength.
+line_dtype = np.dtype([("wl", float), ("ritz", float), ("Aki", float),
+                       ("gi", float), ("gk", float), ("Ei", float),
+                       ("Ek", float), ("rel", float), ("valid", bool)])
+
+non_decimal = re.compile(r'[^\d.]+')
+# left/right strips non-number chars (preserves the 'e' in 5e7)
+outer_non_decimal = re.compile(r'(^[^\d.]+)|([^\d.]+$)')
+
+
+class parse_diagnostics():
+    """ Collects the problems found while parsing a NIST line table
+    instead of printing them. Each problem is a tuple of
+    (row index, column name, message). """
+
+    def __init__(self):
+        self.problems = []
+
+    def add(self, row, column, message):
+        self.problems.append((row, column, message))
+
+    def count(self, column=None):
+        if column is None:
+            return len(self.problems)
+        return len([p for p in self.problems if p[1] == column])
+
+    def __len__(self):
+        return len(self.problems)
+
+    def __repr__(self):
+        columns = sorted(set(p[1] for p in self.problems))
+        counts = ", ".join(c + ": " + str(self.count(c)) for c in columns)
+        return "parse_diagnostics(" + str(len(self)) + " problems" + \
+            (" - " + counts if counts else "") + ")"
+
+    def report(self):
+        for row, column, message in self.problems:
+            print("row " + str(row) + ", " + column + ": " + message)
+
+
+def _text_column(nist_lines, name):
+    """ Column as list of strings, None for masked or missing entries. """
+    if name not in nist_lines.colnames:
+        return [None]*len(nist_lines)
+    column = nist_lines[name]
+    mask = np.ma.getmaskarray(column)
+    return [None if m else str(v) for v, m in zip(column, mask)]
+
+
+def _float_column(nist_lines, name, pattern, diagnostics, skip):
+    values = np.full(len(nist_lines), np.nan)
+    if name not in nist_lines.colnames:
+        return values
+    column = nist_lines[name]
+    if column.dtype.kind in "fiu": # already numeric, no parsing needed
+        values[:] = np.ma.filled(column.astype(float), np.nan)
+        return values
+    for i, text in enumerate(_text_column(nist_lines, name)):
+        if text is None or skip[i]:
+            continue
+        text = pattern.sub('', text)
+        if not text:
+            continue
+        try:
+            values[i] = float(text)
+        except ValueError as err:
+            diagnostics.add(i, name, str(err))
+    return values
+
+
+def _pair_column(nist_lines, name, diagnostics, skip):
+    """ Split columns such as 'gi   gk' ('3 - 5') into two float arrays. """
+    low = np.full(len(nist_lines), np.nan)
+    high = np.full(len(nist_lines), np.nan)
+    for i, text in enumerate(_text_column(nist_lines, name)):
+        if text is None or skip[i]:
+            continue
+        try:
+            parts = text.split('-')
+            high[i] = float(parts[1])
+            low[i] = float(parts[0])
+        except (ValueError, IndexError) as err:
+            diagnostics.add(i, name, str(err) if str(err) else "no value")
+    return low, high
+
+
+def parse_line_table(nist_lines):
+    """ Convert a NIST line table (astropy table from Nist.query) into a
+    structured array with line_dtype. Returns the array and a
+    parse_diagnostics object listing all values that could not be read. """
+    diagnostics = parse_diagnostics()
+    lines = np.zeros(len(nist_lines), dtype=line_dtype)
+    if len(nist_lines) == 0:
+        return lines, diagnostics
+
+    # astroquery does not filter out headings in the middle of the table
+    observed = _text_column(nist_lines, 'Observed')
+    skip = np.array([o is not None and ('Observed' in o or "Wavelength" in o
+                                        or "nm" in o) for o in observed])
+
+    lines["wl"] = _float_column(nist_lines, 'Observed', non_decimal, diagnostics, skip)
+    lines["ritz"] = _float_column(nist_lines, 'Ritz', non_decimal, diagnostics, skip)
+    lines["Aki"] = _float_column(nist_lines, 'Aki', outer_non_decimal, diagnostics, skip)
+    lines["rel"] = _float_column(nist_lines, 'Rel.', non_decimal, diagnostics, skip)
+    lines["gi"], lines["gk"] = _pair_column(nist_lines, 'gi   gk', diagnostics, skip)
+    lines["Ei"], lines["Ek"] = _pair_column(nist_lines, 'Ei           Ek',
+                                            diagnostics, skip)
+    lines["valid"] = ~skip & np.isfinite(lines["wl"])
+    return lines, diagnostics
+
+
+def as_line_table(nist_lines):
+    """ Return <nist_lines> as structured array, parsing it if necessary. """
+    if isinstance(nist_lines, np.ndarray) and nist_lines.dtype == line_dtype:
+        return nist_lines
+    if len(nist_lines) == 0:
+        return np.zeros(0, dtype=line_dtype)
+    return parse_line_table(nist_lines)[0]
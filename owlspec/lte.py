@@ -0,0 +1,195 @@
+#!/bin/python3
+""" Partition functions and Saha ionization balance for LTE spectra.
+All temperatures are in eV, densities in m^-3, energies in eV.
+
+Partition functions are tabulated once per species on a dense Te grid
+(Te_grid) and saved to disk, afterwards U(Te) is a fast interpolation
+that does not need the level list anymore. """
+
+import os
+import time
+import numpy as np
+from pathlib import Path
+from scipy import constants as const
+from platformdirs import user_data_dir
+from .util import parse_spectroscopic_name, get_spectroscopic_name
+from . import nist_cache
+from .elements import get_element
+
+__all__ = ["level_energies", "ionization_energy", "partition_sum", "partition_function",
+           "partition_table", "get_partition_table", "saha_fractions"]
+
+data_folder = os.path.join(user_data_dir("owl-OES", "owl-OES"), "PartitionFunctions")
+Te_grid = np.geomspace(0.01, 100, 801) # eV
+_tables = {}
+
+
+def level_energies(spec_name):
+    """ Energies (eV) and statistical weights of all bound levels of
+    <spec_name> listed by NIST. Missing weights are replaced by 2J+1. """
+    levels = nist_cache.query_levels(spec_name)
+    E = levels['E']
+    g = np.where(np.isfinite(levels['g']), levels['g'], 2*levels['J']+1)
+    bound = np.isfinite(E) & np.isfinite(g) & (levels['term'] != 'Limit')
+    limit = ionization_energy(spec_name)
+    if limit:
+        bound &= E < limit
+    return E[bound], g[bound]
+
+
+def ionization_energy(spec_name):
+    """ Ionization energy of <spec_name> in eV. Taken from the limit in the
+    NIST level list, or from the element data if NIST does not list it. 
+    None if neither is known. """
+    levels = nist_cache.query_levels(spec_name)
+    limits = levels['E'][(levels['term'] == 'Limit') & np.isfinite(levels['E'])]
+    if len(limits) > 0:
+        # NIST also lists the limits to excited terms of the ion, the 
+        # ionization energy is the limit to its ground term, the lowest one
+        return float(np.min(limits))
+    name, charge = parse_spectroscopic_name(spec_name)
+    return get_element(name).ionenergies.get(charge+1)
+
+
+def partition_sum(spec_name, Te):
+    """ Internal partition function U(Te) of <spec_name>, summed over all
+    bound levels listed by NIST. <Te> in eV, scalar or array. """
+    E, g = level_energies(spec_name)
+    Te = np.asarray(Te, dtype=float)
+    U = np.sum(g * np.exp(-E/Te[..., None]), axis=-1)
+    return U if U.ndim else float(U)
+
+
+class partition_table():
+    """ Partition function of <spec_name> tabulated on the Te grid <Te>.
+    Calling the table with Te (eV, scalar or array) interpolates log(U)
+    linearly in log(Te). Outside of the grid, the values at the edges are
+    used. Also holds the ionization energy Ei of the species in eV and the
+    <source> of the level list it was calculated from (see 
+    nist_cache.levels_source). """
+
+    def __init__(self, spec_name, Te=None, U=None, Ei=None, source=None):
+        self.spec_name = spec_name
+        if Te is None:
+            Te = Te_grid
+        if U is None:
+            U = partition_sum(spec_name, Te)
+            Ei = ionization_energy(spec_name)
+            source = nist_cache.levels_source(spec_name)
+        self.Te = np.asarray(Te, dtype=float)
+        self.U = np.asarray(U, dtype=float)
+        if not np.all(self.U > 0):
+            raise ValueError("Partition function of " + spec_name + " is zero, " +
+                             "NIST lists no bound levels below the ionization limit.")
+        self.Ei = Ei
+        self.source = source
+        self._checked, self._checked_time = None, 0 # see get_partition_table
+        self._log_Te = np.log(self.Te)
+        self._log_U = np.log(self.U)
+
+    def __call__(self, Te):
+        log_U = np.interp(np.log(Te), self._log_Te, self._log_U)
+        return np.exp(log_U) if np.ndim(log_U) else float(np.exp(log_U))
+
+    @staticmethod
+    def filename(spec_name):
+        return os.path.join(data_folder, "_".join(spec_name.split()) + ".npz")
+
+    def save(self):
+        try:
+            Path(data_folder).mkdir(parents=True, exist_ok=True)
+            np.savez(partition_table.filename(self.spec_name), Te=self.Te,
+                     U=self.U, Ei=np.nan if self.Ei is None else self.Ei,
+                     source="" if self.source is None else self.source)
+        except OSError:
+            print("WARNING: could not save partition function table to disk")
+
+    @staticmethod
+    def load(spec_name):
+        with np.load(partition_table.filename(spec_name)) as data:
+            Ei = float(data["Ei"])
+            source = str(data["source"]) if "source" in data else ""
+            return partition_table(spec_name, data["Te"], data["U"],
+                                   None if np.isnan(Ei) else Ei, source or None)
+
+
+def get_partition_table(spec_name, refresh=False):
+    """ Return the partition function table of <spec_name>. Tables are
+    kept in memory and on disk and are only calculated from the NIST level
+    list if they do not exist yet, <refresh> is True or the level list 
+    changed since (e.g. the NIST cache entry was refreshed or expired, or
+    a different bundle is used). """
+    spec_name = " ".join(spec_name.split())
+    table = _tables.get(spec_name)
+    if table is not None and not refresh and table._checked == nist_cache.generation():
+        ttl = nist_cache.settings["ttl"]
+        if ttl is None or time.time() - table._checked_time <= ttl:
+            return table
+
+    generation = nist_cache.generation()
+    source = nist_cache.levels_source(spec_name)
+    if table is None and not refresh:
+        try:
+            table = partition_table.load(spec_name)
+        except (OSError, KeyError, ValueError):
+            pass
+    if refresh or table is None or source is None or table.source != source:
+        try:
+            new_table = partition_table(spec_name)
+            new_table.save()
+            table = new_table
+            generation = nist_cache.generation() # the levels may have been fetched
+        except nist_cache.OfflineError:
+            if table is None or refresh:
+                raise
+            # the level list is not available, keep the table we have
+    table._checked, table._checked_time = generation, time.time()
+    _tables[spec_name] = table
+    return table
+
+
+def partition_function(spec_name, Te):
+    """ Internal partition function U(Te) of <spec_name>, interpolated from
+    the tabulated values. <Te> in eV, scalar or array. """
+    return get_partition_table(spec_name)(Te)
+
+
+def saha_fractions(element, Te, ne, max_charge=1, U=None, Ei=None):
+    """ Fraction of atoms of <element> (e.g. "Fe") in each charge state
+    0..<max_charge> according to the Saha equation. Higher charge states
+    are neglected. <Te> in eV, <ne> in m^-3, scalars or arrays.
+    <U>: Optional function U(spec_name, Te) for the partition functions,
+         defaults to partition_function.
+    <Ei>: Optional dictionary {spec_name: ionization energy in eV}, e.g.
+          {"Fe I": 7.902}. Other ionization energies are taken from the 
+          partition tables, or from ionization_energy() if <U> is given
+          (so that no partition table is calculated).
+    Returns an array of shape (max_charge+1, *shape of Te and ne). 
+    Raises a ValueError if the ionization energy of a lower charge state
+    is unknown. """
+    custom_U = U is not None
+    if U is None:
+        U = partition_function
+    # 2/ne * (2 pi m_e k T / h^2)^(3/2), T in K
+    thermal = 2/ne * (2*np.pi*const.m_e*const.e*Te/const.h**2)**1.5
+    log_n = [0.0] # log of n_z/n_0
+    U_low = U(get_spectroscopic_name(element, 0), Te)
+    for charge in range(max_charge):
+        spec_name = get_spectroscopic_name(element, charge)
+        if Ei is not None and spec_name in Ei:
+            E_ion = Ei[spec_name]
+        elif custom_U:
+            E_ion = ionization_energy(spec_name)
+        else:
+            E_ion = get_partition_table(spec_name).Ei
+        if E_ion is None:
+            raise ValueError("Ionization energy of " + spec_name + " unknown (no " +
+                             "limit in the NIST level list), cannot calculate " +
+                             "the fraction of " + get_spectroscopic_name(element, charge+1) +
+                             ". Use a lower max_charge or give it in Ei.")
+        U_high = U(get_spectroscopic_name(element, charge+1), Te)
+        log_n.append(log_n[-1] + np.log(thermal*U_high/U_low) - E_ion/Te)
+        U_low = U_high
+    log_n = np.array(np.broadcast_arrays(*log_n))
+    n = np.exp(log_n - np.max(log_n, axis=0))
+    return n/np.sum(n, axis=0)
@@ -0,0 +1,74 @@
+#!/bin/python3
+""" Small bounded LRU caches with hit/miss statistics, used to keep line
+profile components between calls with the same physical parameters. """
+
+import threading
+from collections import OrderedDict
+
+__all__ = ["lru", "quantize"]
+
+
+def quantize(*values, digits=12):
+    """ Hashable key from <values>, floats are rounded to <digits>
+    significant digits so that rounding errors still match (but not the
+    small steps of numerical derivatives). """
+    key = []
+    for value in values:
+        if isinstance(value, (float, int)) and not isinstance(value, bool):
+            value = float("{:.{}g}".format(value, digits))
+        elif hasattr(value, "item") and getattr(value, "ndim", 1) == 0: # numpy scalar
+            value = float("{:.{}g}".format(value.item(), digits))
+        key.append(value)
+    return tuple(key)
+
+
+class lru():
+    """ Least recently used cache with at most <maxsize> entries. Counts
+    hits and misses. """
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return "lru(hits=" + str(self.hits) + ", misses=" + str(self.misses) + \
+            ", size=" + str(len(self)) + ", maxsize=" + str(self.maxsize) + ")"
+
+    def get(self, key, compute):
+        """ Return the value stored for <key>, or store and return compute()
+        if there is none. """
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return self._data[key]
+            self.misses += 1
+        value = compute()
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self),
+                "maxsize": self.maxsize}
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self, stats=True):
+        with self._lock:
+            self._data.clear()
+            if stats:
+                self.hits = self.misses = 0
@@ -0,0 +1,353 @@
+#!/usr/bin/python3
+""" Local cache for queries to the NIST atomic spectra database.
+
+All NIST queries of owl go through query_lines() and query_levels(). Results are kept
+in memory and on disk (in the same data folder as the Stark broadening
+tables), keyed by a hash of the query parameters. Subsequent queries with
+the same parameters are served locally.
+
+A data backend, e.g. an offline bundle (see owlspec.bundle), can be set
+with set_backend() or use_bundle(). It is asked first and the cache/NIST
+are only used for data the backend does not have.
+
+Use configure(offline=True) or set the environment variable OWL_OFFLINE=1
+to never touch the network. Queries that are not in the cache then raise
+an OfflineError.
+
+The functions are thread safe. Identical queries running at the same time
+are only sent once, and at most settings["max_connections"] requests are
+sent to NIST in parallel, see prefetch().
+"""
+
+import os
+import time
+import pickle
+import hashlib
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from platformdirs import user_data_dir
+
+cache_folder = os.path.join(user_data_dir("owl-OES", "owl-OES"), "NISTcache")
+
+settings = {
+    "offline": os.environ.get("OWL_OFFLINE", "0").lower() not in ("", "0", "false", "no"),
+    "ttl": None, # maximum age of cache entries in seconds, None = forever
+    "refresh": False, # always query NIST and update the cache
+    "enabled": True,
+    "max_connections": 4, # parallel requests to NIST, be polite
+}
+
+_memory = {} # key -> (timestamp, data)
+_backend = {"backend": None, "from_env": False}
+_inflight = {} # key -> _flight of the query currently running
+_inflight_lock = threading.Lock()
+_connection_slots = {"semaphore": threading.BoundedSemaphore(settings["max_connections"])}
+_clients = {} # astroquery class -> private instance with pooled session, see _pooled
+_clients_lock = threading.Lock()
+_generation = [0] # changes whenever the data served by the queries can change
+
+
+class OfflineError(ConnectionError):
+    """ Raised when data is requested that is not cached while offline. """
+    pass
+
+
+def configure(offline=None, ttl=None, refresh=None, enabled=None, folder=None,
+              max_connections=None):
+    """ Change the cache settings for the running session.
+
+    <offline>: If True, never query NIST. Missing data raises OfflineError.
+    <ttl>: Maximum age of cached results in seconds. Older results are
+           fetched again (if not offline). Use 0 to reset to "forever".
+    <refresh>: If True, always query NIST and overwrite the cache.
+    <enabled>: If False, do not use the cache at all.
+    <folder>: Folder for the on-disk cache.
+    <max_connections>: Maximum number of parallel requests to NIST.
+    """
+    global cache_folder
+    _generation[0] += 1
+    if offline is not None:
+        settings["offline"] = bool(offline)
+    if ttl is not None:
+        settings["ttl"] = ttl if ttl > 0 else None
+    if refresh is not None:
+        settings["refresh"] = bool(refresh)
+    if enabled is not None:
+        settings["enabled"] = bool(enabled)
+    if folder is not None:
+        cache_folder = folder
+        _memory.clear()
+    if max_connections is not None:
+        settings["max_connections"] = max(1, int(max_connections))
+        _connection_slots["semaphore"] = threading.BoundedSemaphore(
+                                                settings["max_connections"])
+
+
+def set_backend(backend):
+    """ Serve queries from <backend> before using the cache or NIST.
+    The backend needs the methods lines(linename, wl_low, wl_high,
+    wavelength_type) and levels(linename, energy_level_unit), which return
+    None for data they do not have. Use None to remove the backend. """
+    _backend["backend"] = backend
+    _backend["from_env"] = True # an explicit choice overrides OWL_BUNDLE
+    _generation[0] += 1
+
+
+def use_bundle(path):
+    """ Use the offline bundle file at <path> as data backend. """
+    from .bundle import bundle
+    set_backend(bundle(path))
+
+
+def get_backend():
+    if not _backend["from_env"]:
+        _backend["from_env"] = True
+        _generation[0] += 1
+        if os.environ.get("OWL_BUNDLE"):
+            from .bundle import bundle
+            _backend["backend"] = bundle(os.environ["OWL_BUNDLE"])
+    return _backend["backend"]
+
+
+def cache_key(kind, *params):
+    """ Content address for a query of type <kind> with <params>. """
+    normalized = []
+    for param in params:
+        if isinstance(param, float):
+            param = round(param, 6)
+        normalized.append(repr(param))
+    text = kind + "|" + "|".join(normalized)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def cache_file(key):
+    return os.path.join(cache_folder, key[:2], key + ".pkl")
+
+
+def clear(disk=False):
+    """ Empty the in-memory cache. Also delete the on-disk cache if
+    <disk> is True. """
+    _memory.clear()
+    _generation[0] += 1
+    if disk and os.path.exists(cache_folder):
+        for path in Path(cache_folder).glob("*/*.pkl"):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+def _is_fresh(timestamp, ttl):
+    return ttl is None or (time.time() - timestamp) <= ttl
+
+
+def _load(key):
+    path = cache_file(key)
+    try:
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        return os.path.getmtime(path), data
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def _save(key, data):
+    path = cache_file(key)
+    try:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path + ".%d.%d.tmp" % (os.getpid(), threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path) # atomic, other processes never see half a file
+    except OSError:
+        print("WARNING: could not write NIST cache to " + path)
+
+
+class _flight():
+    "A query in progress that other threads can wait for."
+    def __init__(self):
+        self.done = threading.Event()
+        self.data = None
+        self.error = None
+
+
+def _fetch_once(key, fetch):
+    """ Call fetch() with a free connection slot, unless another thread is
+    already fetching <key>. In that case, wait for its result. """
+    with _inflight_lock:
+        flight = _inflight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _inflight[key] = _flight()
+
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.data
+
+    try:
+        with _connection_slots["semaphore"]:
+            flight.data = fetch()
+    except Exception as err:
+        flight.error = err
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+        flight.done.set()
+    return flight.data
+
+
+def _pooled(query_class):
+    """ Private instance of the astroquery class <query_class> for owl. Its
+    own session keeps enough HTTP connections open for max_connections
+    parallel requests, the shared astroquery objects (e.g. Nist) are not
+    changed. """
+    size = settings["max_connections"]
+    with _clients_lock:
+        query = _clients.get(query_class)
+        if query is None or query._owl_pool_size != size:
+            from requests.adapters import HTTPAdapter
+            query = query_class()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=size)
+            query._session.mount("https://", adapter)
+            query._session.mount("http://", adapter)
+            query._owl_pool_size = size
+            _clients[query_class] = query
+    return query
+
+
+def cached(key, fetch, offline=None, refresh=None, ttl=None):
+    """ Return the cached result for <key> or call <fetch>() to get it.
+    Results of fetch() are stored in memory and on disk. """
+    if offline is None:
+        offline = settings["offline"]
+    if refresh is None:
+        refresh = settings["refresh"]
+    if ttl is None:
+        ttl = settings["ttl"]
+
+    if not settings["enabled"]:
+        if offline:
+            raise OfflineError("NIST cache is disabled and offline mode is on.")
+        return _fetch_once(key, fetch)
+
+    stale = None
+    if not refresh or offline:
+        entry = _memory.get(key)
+        if entry is None:
+            entry = _load(key)
+            if entry is not None:
+                _memory[key] = entry
+        if entry is not None:
+            if offline or _is_fresh(entry[0], ttl):
+                return entry[1]
+            stale = entry
+
+    if offline:
+        raise OfflineError("Requested NIST data is not cached and offline mode is on.")
+
+    try:
+        data = _fetch_once(key, fetch)
+    except Exception:
+        if stale is not None:
+            print("WARNING: could not reach NIST, using outdated cached data.")
+            return stale[1]
+        raise
+
+    _memory[key] = (time.time(), data)
+    _save(key, data)
+    _generation[0] += 1
+    return data
+
+
+def query_lines(wl_low, wl_high, linename, wavelength_type="vac+air",
+                offline=None, refresh=None, ttl=None):
+    """ Cached version of astroquery.nist.Nist.query. Wavelengths in nm.
+    Returns an astropy table. The table is shared between callers and must
+    not be modified. """
+    def fetch():
+        from astroquery.nist import NistClass # import here for startup performance
+        import astropy.units as u
+        return _pooled(NistClass).query(wl_low*u.nm, wl_high*u.nm, linename=linename,
+                          wavelength_type=wavelength_type)
+
+    backend = get_backend()
+    if backend is not None:
+        nist_lines = backend.lines(linename, wl_low, wl_high, wavelength_type)
+        if nist_lines is not None:
+            return nist_lines
+
+    key = cache_key("lines", float(wl_low), float(wl_high),
+                    " ".join(linename.split()), wavelength_type)
+    return cached(key, fetch, offline, refresh, ttl)
+
+
+def query_levels(linename, energy_level_unit="eV", offline=None, refresh=None, ttl=None):
+    """ Cached and fast-parsed version of owlspec.nist_levels.NistLevels.query.
+    Returns a dict of numpy columns, see owlspec.nist_levels.parse_levels.
+    The columns are shared between callers and must not be modified. """
+    def fetch():
+        from .nist_levels import NistLevelsClass, parse_levels
+        response = _pooled(NistLevelsClass).query_async(linename=linename,
+                                          energy_level_unit=energy_level_unit)
+        return parse_levels(str(response.text))
+
+    backend = get_backend()
+    if backend is not None:
+        levels = backend.levels(linename, energy_level_unit)
+        if levels is not None:
+            return levels
+
+    key = cache_key("levels", " ".join(linename.split()), energy_level_unit)
+    return cached(key, fetch, offline, refresh, ttl)
+
+
+def generation():
+    """ Counter that changes whenever the data returned by the queries can
+    change (new results fetched, cache cleared, settings or backend 
+    changed). Results derived from the queries are up to date as long as
+    it does not change. """
+    return _generation[0]
+
+
+def levels_source(linename, energy_level_unit="eV"):
+    """ Identification of the data query_levels() returns for <linename>:
+    the backend (its <source> attribute) or the cache key and the time the
+    entry was fetched, so that results calculated from the levels can be
+    checked for being up to date. None if the levels are not cached or the
+    cached entry is outdated, i.e. query_levels() would fetch them again. """
+    backend = get_backend()
+    if backend is not None and backend.levels(linename, energy_level_unit) is not None:
+        return "backend " + str(getattr(backend, "source", type(backend).__name__))
+
+    key = cache_key("levels", " ".join(linename.split()), energy_level_unit)
+    if not settings["enabled"] or (settings["refresh"] and not settings["offline"]):
+        return None
+    try:
+        timestamp = os.path.getmtime(cache_file(key))
+    except OSError:
+        entry = _memory.get(key)
+        if entry is None:
+            return None
+        timestamp = entry[0]
+    if not (settings["offline"] or _is_fresh(timestamp, settings["ttl"])):
+        return None
+    return "nist " + key + " " + repr(round(timestamp, 3))
+
+
+def prefetch(lines=(), levels=(), max_workers=None):
+    """ Load many queries into the cache in parallel.
+    <lines>: List of argument tuples for query_lines, e.g.
+             [(750, 752, "Ar I"), (810, 812, "Ar I")].
+    <levels>: List of spectrum names for query_levels, e.g. ["Ar I"].
+    <max_workers>: Number of threads, defaults to max_connections.
+    Returns a list of the errors that occured. """
+    if max_workers is None:
+        max_workers = settings["max_connections"]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(query_lines, *args) for args in lines]
+        futures += [pool.submit(query_levels, name) for name in levels]
+    return [f.exception() for f in futures if f.exception() is not None]
@@ -19,8 +19,8 @@ class Conf(_config.ConfigNamespace):
 
 conf = Conf()
 
-from .core import NistLevels, NistLevelsClass
+from .core import NistLevels, NistLevelsClass, parse_levels
 
-__all__ = ['NistLevels', 'NistLevelsClass',
+__all__ = ['NistLevels', 'NistLevelsClass', 'parse_levels',
            'Conf', 'conf',
            ]
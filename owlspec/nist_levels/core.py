@@ -4,6 +4,8 @@
 import html
 import re
 
+import numpy as np
+
 # import astropy.io.ascii as asciitable
 from astropy.table import Table
 
@@ -12,7 +14,7 @@ from astroquery.utils import async_to_sync, prepend_docstr_nosections
 from . import conf
 from astroquery.exceptions import TableParseError
 
-__all__ = ['NistLevels', 'NistLevelsClass']
+__all__ = ['NistLevels', 'NistLevelsClass', 'parse_levels']
 
 
 def _strip_blanks(table):
@@ -37,6 +39,82 @@ def _strip_blanks(table):
     return "\n".join(table)
 
 
+_non_decimal = re.compile(r'[^\d.]+')
+_non_numeric = re.compile(r'[^\d.eE+-]+')
+
+
+def _to_float(value, pattern=_non_decimal):
+    try:
+        return float(pattern.sub('', value))
+    except ValueError:
+        return np.nan
+
+
+def _fraction_to_float(value):
+    value = value.strip()
+    try:
+        if '/' in value:
+            numerator, denominator = value.split('/')
+            return float(numerator)/float(denominator)
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+def parse_levels(content):
+    """
+    Parses the <PRE> block of a NIST levels response straight into typed
+    numpy columns, without going through `~astropy.table.Table`.
+
+    Parameters
+    ----------
+    content : str
+        The text of the HTTP response
+
+    Returns
+    -------
+    columns : dict
+        'E' (level energy, nan if missing), 'J', 'g' and 'G' (Landé g
+        factor, nan if missing) as float arrays, 'conf' and 'term' as
+        string arrays.
+    """
+    pre_re = re.compile("<PRE>(.*)</PRE>", flags=re.DOTALL)
+    links_re = re.compile(r"<\/?a[^>]*>")
+    try:
+        pre = pre_re.findall(content)[0]
+    except IndexError:
+        raise Exception("Result did not contain a table")
+    table = html.unescape(links_re.sub('', _strip_blanks(pre)))
+    lines = [line for line in table.split('\n') if '|' in line]
+    if not lines:
+        raise TableParseError("Failed to parse NIST levels, no table found.")
+
+    names = [name.strip() for name in lines[0].split('|')]
+    columns = {}
+    for name in ('Configuration', 'Term', 'J', 'g', 'Landé'):
+        columns[name] = names.index(name) if name in names else None
+    columns['Level'] = None
+    for i, name in enumerate(names):
+        if name.startswith('Level'):
+            columns['Level'] = i
+            break
+
+    rows = [line.split('|') for line in lines[1:]]
+
+    def cells(name):
+        i = columns[name]
+        return [row[i].strip() if i is not None and i < len(row) else ''
+                for row in rows]
+
+    return {'E': np.array([_to_float(v) for v in cells('Level')], dtype=float),
+            'J': np.array([_fraction_to_float(v) for v in cells('J')], dtype=float),
+            'g': np.array([_to_float(v) for v in cells('g')], dtype=float),
+            'G': np.array([_to_float(v, _non_numeric) for v in cells('Landé')],
+                          dtype=float),
+            'conf': np.array(cells('Configuration'), dtype=str),
+            'term': np.array(cells('Term'), dtype=str)}
+
+
 @async_to_sync
 class NistLevelsClass(BaseQuery):
     URL = conf.server
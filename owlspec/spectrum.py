@@ -1,8 +1,12 @@
 #!/bin/python3
 import numpy as np
 from .util import *
-import re
-import warnings
+from . import nist_cache
+from .elements import get_element
+from copy import copy
+from .line_table import line_dtype, parse_line_table, as_line_table, \
+                        parse_diagnostics
+from .synthesis import render_lines
 
 
 class spectrum():
@@ -17,8 +21,7 @@ class spectrum():
     def __init__(self, emitter_name, wl_range=None):
         self.name, self.charge = parse_spectroscopic_name(emitter_name)
         self.spec_name = get_spectroscopic_name(self.name, self.charge)
-        from mendeleev import element
-        self.emitter = self.particle = element(self.name)
+        self.emitter = self.particle = copy(get_element(self.name))
         self.emitter.charge = self.charge
         self.emitter.m = self.emitter.mass
         self.emitter.Ei = self.emitter.ionenergies[1]
@@ -26,6 +29,8 @@ class spectrum():
         
         self.wl_range = wl_range
         self.linedata = None
+        self.lines = None
+        self.diagnostics = parse_diagnostics()
 
 
     def get_linedata(self):
@@ -37,33 +42,60 @@ class spectrum():
             wl_high = 9999
             
         try:
-            from astroquery.nist import Nist
-            import astropy.units as u
-            nist_lines = Nist.query(wl_low*u.nm, wl_high*u.nm, 
-                                linename=self.spec_name, wavelength_type='vac+air')
+            nist_lines = nist_cache.query_lines(wl_low, wl_high, self.spec_name,
+                                                wavelength_type='vac+air')
         except:
             return []
 
         return nist_lines
 
 
-    def get_spectrum(self, x, width=0.02, mu=0.2, min_int=-1, min_Aik=-1):
+    def get_lines(self):
+        """ Return the NIST lines as structured array (see
+        owlspec.line_table.line_dtype). The NIST table is only parsed once,
+        problems found during parsing are listed in self.diagnostics. """
+        if self.lines is None:
+            self.linedata = self.get_linedata()
+            if len(self.linedata) > 0:
+                self.lines, self.diagnostics = parse_line_table(self.linedata)
+            else:
+                self.lines = np.zeros(0, dtype=line_dtype)
+        return self.lines
+
+
+    def get_spectrum(self, x, width=0.02, mu=0.2, min_int=-1, min_Aik=-1, cutoff=None):
         """ Return simulated spectrum. Lines are pseudo Voigt with
-        the set width (FWHM) in nm and form parameter mu (0 = Gauss)  """
-        nist_lines = self.get_linedata()
-        spectrum = self.table_to_spec_rel(x, nist_lines, width, mu, min_int, min_Aik)
+        the set width (FWHM) in nm and form parameter mu (0 = Gauss).
+        Lines with mu > 0 are evaluated on the complete x axis, Gaussian 
+        lines (mu = 0) within 5 FWHM, where they are negligible. Set e.g.
+        cutoff=50 to evaluate all lines only within cutoff*width of their
+        center (faster, the Lorentzian wings beyond are lost, 
+        ~mu/(pi*cutoff) of the area). """
+        lines = self.get_lines()
+        spectrum = self.table_to_spec_rel(x, lines, width, mu, min_int, min_Aik, cutoff)
         return spectrum
 
 
-    def get_LTE_spectrum(self, x, Te, width=0.02, mu=0.2, norm=False, min_int=-1, min_Aik=-1):
+    def get_LTE_spectrum(self, x, Te, width=0.02, mu=0.2, norm=False, min_int=-1, min_Aik=-1,
+                         cutoff=None, partition=False):
         """ Return simulated spectrum with LTE line intnsities in units 
         proportional (!) to Photons/s (NOT W/cm²s)
         Lines are pseudo Voigt with the set width (FWHM) in nm and form 
         parameter mu (0 = Gauss).
         Set norm=True to normalize the intensity to 1 for easier fitting.
+        Lines with mu > 0 are evaluated on the complete x axis, Gaussian 
+        lines (mu = 0) within 5 FWHM, where they are negligible. Set e.g.
+        cutoff=50 to evaluate all lines only within cutoff*width of their
+        center (faster, the Lorentzian wings beyond are lost, 
+        ~mu/(pi*cutoff) of the area).
+        Set partition=True to divide by the partition function U(Te), i.e.
+        to get intensities per emitter instead of per ground state emitter.
         """
-        nist_lines = self.get_linedata()
-        spectrum = self.table_to_spec_LTE(x, nist_lines, Te, width, mu, min_int, min_Aik)
+        lines = self.get_lines()
+        spectrum = self.table_to_spec_LTE(x, lines, Te, width, mu, min_int, min_Aik, cutoff)
+        if partition == True:
+            from .lte import partition_function
+            spectrum = spectrum/partition_function(self.spec_name, Te)
         if norm == True:
             spectrum = spectrum/np.max(spectrum)
         return spectrum
@@ -72,185 +104,161 @@ class spectrum():
     def get_ident_spectrum(self, min_int=-1, min_Aik=-1):
         """ Return simulated spectrum. Marks the wavelenght position
         with thin lines. """
-        nist_lines = self.get_linedata()
-        x, y = self.table_to_ident(nist_lines, min_int, min_Aik)
+        lines = self.get_lines()
+        x, y = self.table_to_ident(lines, min_int, min_Aik)
         return x,y
 
 
-    def get_ident_spectrum_LTE(self, Te, min_int=-1, min_Aik=-1):
+    def get_ident_spectrum_LTE(self, Te, min_int=-1, min_Aik=-1, partition=False):
         """ Return simulated spectrum. Marks the wavelenght position
-        with thin lines. """   
-        nist_lines = self.get_linedata()
-        x, y = self.table_to_ident_LTE(nist_lines, Te, min_int, min_Aik)
+        with thin lines. Set partition=True to divide by the partition
+        function U(Te). """   
+        lines = self.get_lines()
+        x, y = self.table_to_ident_LTE(lines, Te, min_int, min_Aik)
+        if partition == True:
+            from .lte import partition_function
+            y = y/partition_function(self.spec_name, Te)
         return x,y
-        
 
-    def table_to_spec_LTE(self, x, nist_lines, Te, width=0.1, mu=0.5, min_int=-1, min_Aik=-1):
-        spectrum = np.zeros(len(x))
-        for line in  nist_lines:   
-            c1 = str(line['Observed'])
-            # astroquery does not filter out headings in the middle of the table
-            if 'Observed' in c1 or "Wavelength" in c1 or "nm" in c1:
-                continue
-            
-            wl =  line['Observed']
-            Aik = line['Aki']
-            
-            if not np.ma.is_masked(wl) and not np.ma.is_masked(Aik):
-                
-                wl =  str(wl)
-                Aik = str(Aik)
-                wl = re.sub(r'[^\d.]+', '', wl) # removes non-number chars
-                # left/right strips non-number chars (preserves the 'e' in 5e7 
-                Aik = re.sub(r'(^[^\d.]+)|([^\d.]+$)', '', Aik) 
-                
-                if min_int > 0:
-                    with warnings.catch_warnings(): # ignore masked element warning
-                        warnings.simplefilter("ignore", category=UserWarning)
-                        rel_int = line['Rel.']
-                        rel_int = re.sub(r'[^\d.]+', '', rel_int)
-                        rel_int =  float(rel_int)
-                else:
-                    rel_int = 1
-    
-                try: # conversion to float can still fail...
-                    wl = float(wl)
-                    Aik = float(Aik)
-                    gi = line['gi   gk'].split('-')[1]
-                    Ei = line['Ei           Ek'].split('-')[1]
-                    Ei = float(Ei)
-                    gi = float(gi)
-    
-                    if rel_int > min_int and Aik > min_Aik:
-                        intensity = Aik*gi*np.exp(-Ei/Te)
-                        profile = intensity*psd_voigt_function(x, wl, width, mu)
-                        spectrum = spectrum + profile
-                except Exception as err:
-                    print(err)
-                    pass
-    
-        return spectrum
+
+    @staticmethod
+    def select_LTE(lines, min_int=-1, min_Aik=-1):
+        """ Mask of lines usable for LTE intensities: observed wavelength,
+        Aik, upper level weight and energy are known. """
+        selected = lines['valid'] & (lines['Aki'] > min_Aik) & \
+            np.isfinite(lines['gk']) & np.isfinite(lines['Ek'])
+        if min_int > 0:
+            selected &= np.nan_to_num(lines['rel']) > min_int
+        return selected
+
+
+    @staticmethod
+    def select_rel(lines, min_int=-1, min_Aik=-1):
+        """ Mask of lines with known observed wavelength and NIST relative
+        intensity. """
+        selected = lines['valid'] & (lines['rel'] > min_int)
+        if min_Aik > 0:
+            selected &= np.nan_to_num(lines['Aki']) > min_Aik
+        return selected
+
+
+    @staticmethod
+    def sticks(wl, intensities):
+        "Mark each line with a single dot between two zeros."
+        dx = 1e-6
+        x = np.stack((wl-dx, wl, wl+dx), axis=1).flatten()
+        y = np.stack((np.zeros(len(wl)), intensities, np.zeros(len(wl))), axis=1).flatten()
+        return x, y
+
+
+    def table_to_spec_LTE(self, x, nist_lines, Te, width=0.1, mu=0.5, min_int=-1, min_Aik=-1,
+                          cutoff=None):
+        lines = as_line_table(nist_lines)
+        lines = lines[self.select_LTE(lines, min_int, min_Aik)]
+        intensities = lines['Aki']*lines['gk']*np.exp(-lines['Ek']/Te)
+        return render_lines(x, lines['wl'], intensities, width, mu, cutoff)
     
     
-    def table_to_spec_rel(self, x, nist_lines, width=0.02, mu=0, min_int=-1, min_Aik=-1):
-        spectrum = np.zeros(len(x))
-        for line in  nist_lines:   
-            rel_int = line['Rel.']
-            wl =  line['Observed']
-            if not np.ma.is_masked(rel_int) and not np.ma.is_masked(wl):
-                rel_int = str(rel_int) # is byte type initally
-                wl =  str(wl)
-                rel_int = re.sub(r'[^\d.]+', '', rel_int)
-                wl = re.sub(r'[^\d.]+', '', wl) # removes non-number chars
-                try: # conversion to float can still fail...
-                    rel_int = float(rel_int)
-                    wl = float(wl)
-                    if min_Aik > 0:
-                        with warnings.catch_warnings(): # ignore masked element warning
-                            warnings.simplefilter("ignore", category=UserWarning)
-                            Aik =  float(line['Aki'])
-                    else:
-                        Aik = 1
-                        
-                    if rel_int > min_int and Aik > min_Aik:
-                        profile = rel_int*psd_voigt_function(x, wl, width, mu)
-                        spectrum = spectrum + profile
-                except Exception as err:
-                    print(err)
-                    pass
-                
-        return spectrum
+    def table_to_spec_rel(self, x, nist_lines, width=0.02, mu=0, min_int=-1, min_Aik=-1,
+                          cutoff=None):
+        lines = as_line_table(nist_lines)
+        lines = lines[self.select_rel(lines, min_int, min_Aik)]
+        return render_lines(x, lines['wl'], lines['rel'], width, mu, cutoff)
+
 
-        
     def table_to_ident(self, nist_lines, min_int=-1, min_Aik=-1):
-        x = []
-        dx = 1e-6
-        y = []
-        for line in  nist_lines:   
-            rel_int = line['Rel.']
-            wl =  line['Observed']
-            if not np.ma.is_masked(rel_int) and not np.ma.is_masked(wl):
-                rel_int = str(rel_int) # is byte type initally
-                wl =  str(wl)
-                rel_int = re.sub(r'[^\d.]+', '', rel_int)
-                wl = re.sub(r'[^\d.]+', '', wl) # removes non-number chars
-                try: # conversion to float can still fail...
-                    rel_int = str(line['Rel.'])
-                    rel_int = re.sub(r'[^\d.]+', '', rel_int)
-                    rel_int =  float(rel_int)
-                    wl = float(wl)
-                    if min_Aik > 0:
-                        with warnings.catch_warnings(): # ignore masked element warning
-                            warnings.simplefilter("ignore", category=UserWarning)
-                            Aik =  float(line['Aki'])
-                    else:
-                        Aik = 1
-                        
-                    if rel_int > min_int and Aik > min_Aik:
-                        x.append(wl-dx)
-                        x.append(wl)
-                        x.append(wl+dx)
-                        y.append(0)
-                        y.append(rel_int)
-                        y.append(0)
-                        
-                except:
-                    pass
-            
-        return np.array(x),np.array(y)  
+        lines = as_line_table(nist_lines)
+        lines = lines[self.select_rel(lines, min_int, min_Aik)]
+        return self.sticks(lines['wl'], lines['rel'])
     
         
     def table_to_ident_LTE(self, nist_lines, Te, min_int=-1, min_Aik=-1):
-        x = []
-        dx = 1e-6
-        y = []
-        for line in  nist_lines:   
-            c1 = str(line['Observed'])
-            # astroquery does not filter out headings in the middle of the table
-            if 'Observed' in c1 or "Wavelength" in c1 or "nm" in c1:
-                continue
-            
-            wl =  line['Observed']
-            Aik = line['Aki']
-            
-            if not np.ma.is_masked(wl) and not np.ma.is_masked(Aik):
-                
-                wl =  str(wl)
-                Aik = str(Aik)
-                wl = re.sub(r'[^\d.]+', '', wl) # removes non-number chars
-                # left/right strips non-number chars (preserves the 'e' in 5e7 
-                Aik = re.sub(r'(^[^\d.]+)|([^\d.]+$)', '', Aik) 
-                
-                if min_int > 0:
-                    with warnings.catch_warnings(): # ignore masked element warning
-                        warnings.simplefilter("ignore", category=UserWarning)
-                        rel_int = str(line['Rel.'])
-                        rel_int = re.sub(r'[^\d.]+', '', rel_int)
-                        if len(rel_int) > 0:
-                            rel_int = float(rel_int)
-                        else:
-                            rel_int = 0
-                else:
-                    rel_int = 1
-
-                try: # conversion to float can still fail...
-                    wl = float(wl)
-                    Aik = float(Aik)
-                    gi = line['gi   gk'].split('-')[1]
-                    Ei = line['Ei           Ek'].split('-')[1]
-                    Ei = float(Ei)
-                    gi = float(gi)
-                    if rel_int > min_int and Aik > min_Aik:
-                        intensity = Aik*gi*np.exp(-Ei/Te)
-                        x.append(wl-dx)
-                        x.append(wl)
-                        x.append(wl+dx)
-                        y.append(0)
-                        y.append(intensity)
-                        y.append(0)
-                except:
-                    pass
-
-        return np.array(x),np.array(y)  
-        
-        
+        lines = as_line_table(nist_lines)
+        lines = lines[self.select_LTE(lines, min_int, min_Aik)]
+        intensities = lines['Aki']*lines['gk']*np.exp(-lines['Ek']/Te)
+        return self.sticks(lines['wl'], intensities)
+
+
+class composite_spectrum():
+    """ Calculates the LTE emission spectrum of a mixture of species, e.g.
+    Ar I + Ar II + Fe I + Fe II, in one pass. The populations of the 
+    charge states follow the Saha equation and the excited states a
+    Boltzmann distribution normalized by the partition functions.
+
+    <species>: List of names in spectroscopic notation, e.g. 
+    ["Ar I", "Ar II", "Fe I"].
+    <abundances>: Dictionary of relative number densities of the elements,
+    e.g. {"Ar": 1, "Fe": 0.01}. Elements not listed default to 1.
+    <wl_range>: Tuple of lower and upper wavelength of the spectrum."""
+
+    def __init__(self, species, abundances=None, wl_range=None):
+        self.spectra = [spectrum(name, wl_range) for name in species]
+        self.spec_names = [s.spec_name for s in self.spectra]
+        self.abundances = abundances if abundances else {}
+        self.wl_range = wl_range
+        self.lines = None
+        self.species_idx = None # species of each line, index into self.spectra
+
+
+    def get_lines(self):
+        """ Return the lines of all species as one structured array. The
+        species of each line is stored in self.species_idx. """
+        if self.lines is None:
+            lines = [s.get_lines() for s in self.spectra]
+            self.species_idx = np.concatenate(
+                [np.full(len(l), i) for i, l in enumerate(lines)]).astype(int)
+            self.lines = np.concatenate(lines)
+        return self.lines
+
+
+    def get_populations(self, Te, ne):
+        """ Return n_z/U_z(Te) for every species, i.e. the relative density of
+        the charge state divided by its partition function. 
+        <Te> in eV, <ne> in m^-3. """
+        from . import lte
+        max_charge = {}
+        for s in self.spectra:
+            max_charge[s.name] = max(max_charge.get(s.name, 0), s.charge)
+        fractions = {name: lte.saha_fractions(name, Te, ne, charge)
+                     for name, charge in max_charge.items()}
+        populations = []
+        for s in self.spectra:
+            abundance = self.abundances.get(s.name, 1)
+            U = lte.partition_function(s.spec_name, Te)
+            populations.append(abundance * fractions[s.name][s.charge] / U)
+        return np.array(populations)
+
+
+    def get_intensities(self, Te, ne, min_int=-1, min_Aik=-1):
+        "Return selected lines and their LTE intensities."
+        lines = self.get_lines()
+        selected = spectrum.select_LTE(lines, min_int, min_Aik)
+        populations = self.get_populations(Te, ne)[self.species_idx[selected]]
+        lines = lines[selected]
+        intensities = populations*lines['Aki']*lines['gk']*np.exp(-lines['Ek']/Te)
+        return lines, intensities
+
+
+    def get_LTE_spectrum(self, x, Te, ne, width=0.02, mu=0.2, norm=False, 
+                         min_int=-1, min_Aik=-1, cutoff=None):
+        """ Return simulated spectrum of all species with LTE line 
+        intensities in units proportional (!) to Photons/s (NOT W/cm²s).
+        <Te> in eV, <ne> in m^-3.
+        Lines are pseudo Voigt with the set width (FWHM) in nm and form 
+        parameter mu (0 = Gauss).
+        Set norm=True to normalize the intensity to 1 for easier fitting.
+        <cutoff>: see spectrum.get_LTE_spectrum.
+        """
+        lines, intensities = self.get_intensities(Te, ne, min_int, min_Aik)
+        spectrum = render_lines(x, lines['wl'], intensities, width, mu, cutoff)
+        if norm == True:
+            spectrum = spectrum/np.max(spectrum)
+        return spectrum
+
+
+    def get_ident_spectrum_LTE(self, Te, ne, min_int=-1, min_Aik=-1):
+        """ Return simulated spectrum. Marks the wavelenght position
+        with thin lines. """
+        lines, intensities = self.get_intensities(Te, ne, min_int, min_Aik)
+        order = np.argsort(lines['wl'])
+        return spectrum.sticks(lines['wl'][order], intensities[order])
@@ -1,2 +1,3 @@
 #!/usr/bin/python
 from .stark import *
+from . import registry
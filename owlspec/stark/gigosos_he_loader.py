@@ -3,6 +3,8 @@
 import numpy as np
 from scipy import constants as const
 from ..util import interpol
+from .interpolator import table_interpolator
+from .widths import width_table
 import os
 import sys
 from platformdirs import user_data_dir
@@ -13,12 +15,154 @@ from io import BytesIO
 data_folder447 = os.path.join(user_data_dir("owl-OES", "owl-OES"), "Gigosos2009He")
 data_folder492 = os.path.join(user_data_dir("owl-OES", "owl-OES"), "Lara2012He")
 
+# Table values for the two lines. Not all temperatures are tabulated for 
+# all densities, see gigosos_he_loader.get_T_stock.
+ne_stocks = {447: 10**np.linspace(21,24,10), 492: 10**np.linspace(20,24,13)}
+mu_stocks = {447: np.array([0.8, 2, 4]), 492: np.array([0.8, 2, 4, 10])}
+T_axes = {447: np.array([5000, 10000, 20000, 40000]),
+          492: np.array([5000, 10000, 20000, 30000, 40000])}
+
+# The tables are converted once to a binary array, which is memory mapped
+# (see table_store). Increase if the format changes.
+store_version = 1
+_stores = {}
+
+
+class table_store():
+    """ All profiles of one line (447 or 492) in a single array of shape 
+    (ne, mu, T, points), the wavelength axes in an array of shape 
+    (ne, points), both padded with NaN. Axis metadata: the table values
+    ne, mu and T, the number of points of each table and the mask 
+    (ne, T) of the temperatures that are tabulated for each density.
+    The arrays are memory mapped, so only the used profiles are read from
+    disk and processes share them. """
+
+    def __init__(self, line):
+        self.line = line
+        filename = table_store.filename(line)
+        with np.load(filename + "_axes.npz") as axes:
+            if int(axes["version"]) != store_version:
+                raise ValueError("outdated table store He" + str(line))
+            self.ne, self.mu, self.T = axes["ne"], axes["mu"], axes["T"]
+            self.length, self.mask = axes["length"], axes["mask"]
+        self.x = np.load(filename + "_x.npy", mmap_mode="r")
+        self.profiles = np.load(filename + ".npy", mmap_mode="r")
+        self.interpolator = table_interpolator(self.ne, self.mu, self.T, self.profile,
+                                               self.mask)
+
+    @staticmethod
+    def filename(line):
+        folder = data_folder447 if line == 447 else data_folder492
+        return os.path.join(folder, "He" + str(line))
+
+    def get(self, ne, mu, T):
+        """ x and y of the tabulated profile (read only views). """
+        i = np.argmin(np.abs(np.log(self.ne/ne)))
+        j = np.argmin(np.abs(self.mu - mu))
+        k = np.argmin(np.abs(self.T - T))
+        return self.profile(i, j, k)
+
+    def profile(self, i, j, k):
+        "x and y of the profile with the table indices i, j, k"
+        n = self.length[i]
+        if n == 0 or not self.mask[i, k]:
+            raise FileNotFoundError('Error: Could not find Stark broadening data tables.')
+        return self.x[i, :n], self.profiles[i, j, k, :n]
+
+    def compute_widths(self, doppler=0, instrument=None):
+        """ Width table of the profiles, see width_table.compute. """
+        extent = np.fmax.reduce(np.abs(self.x), axis=1)
+        tabulated = np.broadcast_to((self.length > 0)[:, None, None],
+                                    (len(self.ne), len(self.mu), len(self.T)))
+        return width_table.compute(self.ne, self.mu, self.T, self.interpolator,
+                                   extent, tabulated, doppler, instrument)
+
+    def widths(self, doppler=0, instrument=None):
+        """ FWHM, shift and asymmetry of the profiles, see width_table. 
+        Saved next to the store. """
+        return width_table.open(table_store.filename(self.line) + "_widths.npz",
+                                self.compute_widths, doppler, instrument)
+
+    @staticmethod
+    def open(line):
+        """ Return the store for the line <line>, converting the tables if
+        needed. None if the tables do not exist. """
+        if line in _stores:
+            return _stores[line]
+        try:
+            store = table_store(line)
+        except (OSError, KeyError, ValueError):
+            store = table_store.convert(line)
+        _stores[line] = store
+        return store
+
+    @staticmethod
+    def convert(line):
+        """ Read all tables of <line> and save them as table store. Returns
+        the store, or None if the tables do not exist or the store could 
+        not be saved. """
+        loader = gigosos_he_loader(None)
+        loader.wl = line
+        ne_stock, mu_stock, T_axis = ne_stocks[line], mu_stocks[line], T_axes[line]
+        tables = {}
+        for i, ne in enumerate(ne_stock):
+            try:
+                tables[i] = loader.load_file(ne)
+            except SystemExit:
+                pass
+        if not tables:
+            return None
+        print("Converting Stark broadening data tables for He " + str(line) + 
+              " nm (only needed once).")
+        points = max(len(table[0]) for table in tables.values())
+        length = np.zeros(len(ne_stock), dtype=int)
+        mask = np.zeros((len(ne_stock), len(T_axis)), dtype=bool)
+        x = np.full((len(ne_stock), points), np.nan)
+        filename = table_store.filename(line)
+        try:
+            # written to temporary files first, so that other processes
+            # never see a partial store
+            data = np.lib.format.open_memmap(filename + ".tmp.npy", mode="w+", dtype=float,
+                shape=(len(ne_stock), len(mu_stock), len(T_axis), points))
+            data[:] = np.nan
+            for i, table in tables.items():
+                T_stock = loader.get_T_stock(ne_stock[i])
+                if len(table) != 1 + len(T_stock)*len(mu_stock):
+                    continue # not the expected columns
+                n = len(table[0])
+                length[i] = n
+                x[i, :n] = table[0]
+                k = np.searchsorted(T_axis, T_stock)
+                mask[i, k] = True
+                # columns: all T of the first mu, all T of the second mu, ...
+                columns = table[1:].reshape(len(mu_stock), len(T_stock), n)
+                data[i, :, k, :n] = columns.transpose(1, 0, 2)
+            data.flush()
+            del data
+            np.save(filename + ".tmp_x.npy", x)
+            with open(filename + ".tmp_axes.npz", "wb") as f:
+                np.savez(f, version=store_version, ne=ne_stock, mu=mu_stock,
+                         T=T_axis, length=length, mask=mask)
+            os.replace(filename + ".tmp.npy", filename + ".npy")
+            os.replace(filename + ".tmp_x.npy", filename + "_x.npy")
+            os.replace(filename + ".tmp_axes.npz", filename + "_axes.npz")
+        except OSError:
+            print("WARNING: could not save Stark broadening data tables for He " + 
+                  str(line) + " nm")
+            return None
+        store = table_store(line)
+        width_table.clear(filename + "_widths.npz")
+        store.compute_widths().save(filename + "_widths.npz")
+        return store
+
             
 class gigosos_he_loader():
     def __init__(self, transition):
         self.transition = transition
+        self.wl = None if transition is None else int(round(transition.wl,0))
 
 
+    @staticmethod
     def download_profiles(redownload = False):
         if os.path.exists(data_folder447+"/table06.txt") and \
            os.path.exists(data_folder492+"/table06.txt") and redownload==False:
@@ -43,9 +187,22 @@ class gigosos_he_loader():
                 zip_ref.extractall(data_folder492)
         except:
             print("ERROR: could now save helium Stark broadening tables to disk")
+        gigosos_he_loader.convert_profiles()
+
+
+    @staticmethod
+    def convert_profiles():
+        """ Convert the downloaded tables to memory mapped table stores, 
+        see table_store. """
+        for line in (447, 492):
+            _stores[line] = table_store.convert(line)
             
 
-    def load(self, ne, Te, pert):
+    def load(self, ne, Te, pert, derivatives=False):
+        """ Stark profile for <ne> and <Te>. If <derivatives>, also returns
+        the derivatives of the profile with respect to ne, Te and the 
+        perturber temperature, from the derivatives of the interpolation
+        weights. """
         if pert:
            emitter_m = self.transition.particle.m
            reduced_m = (emitter_m * pert.m)/(emitter_m + pert.m)
@@ -54,7 +211,83 @@ class gigosos_he_loader():
         else:
            mu = 1
 
-        return self.load_stark_profile(ne, mu, Te*const.eV/const.k)
+        if not derivatives:
+            return self.load_stark_profile(ne, mu, Te*const.eV/const.k)
+        x, y, (dy_dne, dy_dmu, dy_dT) = self.load_stark_profile(
+            ne, mu, Te*const.eV/const.k, True)
+        dy_dTe = dy_dT * const.eV/const.k + (dy_dmu * mu/Te if pert else 0)
+        dy_dT_pert = -dy_dmu * mu/pert.T if pert else 0*y
+        return x, y, dy_dne, dy_dTe, dy_dT_pert
+
+
+    def get_profiles(self, x, ne, Te, pert=None, T_pert=None, derivatives=False):
+        """ Stark profiles for arrays of <ne> and <Te> on the axis <x> (nm,
+        relative to the line center), one row per value, interpolated in
+        one step from the table store (see table_interpolator). 
+        <T_pert>: Perturber temperatures, defaults to pert.T. Rows with 
+                  T_pert = 0 are calculated without perturber (mu = 1).
+        If <derivatives>, also returns the derivatives of the profiles 
+        with respect to ne, Te and the perturber temperature.
+        None if the tables are not converted to a table store. """
+        store = table_store.open(self.wl)
+        if store is None:
+            return None
+        ne, Te = [np.asarray(v, dtype=float).ravel() for v in 
+                  np.broadcast_arrays(np.atleast_1d(ne), np.atleast_1d(Te))]
+        mu, T_pert = self.mass_ratio(Te, pert, T_pert)
+        result = store.interpolator(x, ne, mu, Te*const.eV/const.k, derivatives)
+        if not derivatives:
+            return result
+        y, (dy_dne, dy_dmu, dy_dT) = result
+        tied = (T_pert > 0)[:,None] # mu ~ Te/T_pert
+        dy_dTe = dy_dT * const.eV/const.k + np.where(tied, dy_dmu * (mu/Te)[:,None], 0)
+        dy_dT_pert = np.where(tied, -dy_dmu * (mu/np.where(T_pert > 0, T_pert, 1))[:,None], 0)
+        return y, dy_dne, dy_dTe, dy_dT_pert
+
+
+    def mass_ratio(self, Te, pert=None, T_pert=None):
+        """ mu = reduced mass * Te/T_pert for the array <Te> and the 
+        temperatures <T_pert> of the perturber <pert> (default pert.T). 
+        Returns mu and T_pert, mu = 1 where there is no perturber or 
+        T_pert = 0. """
+        if not pert:
+            return np.ones(len(Te)), np.zeros(len(Te))
+        emitter_m = self.transition.particle.m
+        reduced_m = (emitter_m * pert.m)/(emitter_m + pert.m)
+        reduced_m = reduced_m/const.u
+        T_pert = np.broadcast_to(pert.T if T_pert is None else T_pert, Te.shape)
+        mu = np.where(T_pert > 0, reduced_m * Te/np.where(T_pert > 0, T_pert, 1), 1)
+        return mu, T_pert
+
+
+    def characteristics(self, ne, Te, pert=None, T_pert=None, doppler=0,
+                        instrument=None):
+        """ FWHM, shift and asymmetry of the profiles for arrays of <ne> 
+        and <Te>, interpolated from the width tables, see 
+        gigosos_loader.characteristics. None if the tables are not 
+        converted to a table store. """
+        store = table_store.open(self.wl)
+        if store is None:
+            return None
+        ne, Te = [np.asarray(v, dtype=float).ravel() for v in 
+                  np.broadcast_arrays(np.atleast_1d(ne), np.atleast_1d(Te))]
+        mu, _ = self.mass_ratio(Te, pert, T_pert)
+        values = store.widths(doppler, instrument).at(ne, mu, Te*const.eV/const.k)
+        return dict(zip(("fwhm", "shift", "asymmetry"), values))
+
+
+    def ne_from_width(self, width, Te, pert=None, T_pert=None, doppler=0,
+                      instrument=None):
+        """ Electron densities for arrays of the measured FWHM <width> (nm)
+        and <Te>, see gigosos_loader.ne_from_width. None if the tables are 
+        not converted to a table store. """
+        store = table_store.open(self.wl)
+        if store is None:
+            return None
+        width, Te = [np.asarray(v, dtype=float).ravel() for v in 
+                     np.broadcast_arrays(np.atleast_1d(width), np.atleast_1d(Te))]
+        mu, _ = self.mass_ratio(Te, pert, T_pert)
+        return store.widths(doppler, instrument).invert(width, mu, Te*const.eV/const.k)
 
 
     def closest(self,val,array):
@@ -80,10 +313,7 @@ class gigosos_he_loader():
 
 
     def closest_ne(self,ne):
-        if round(self.transition.wl,0) == 447:
-            ne_stock = 10**np.linspace(21,24,10)
-        if round(self.transition.wl,0) == 492:
-            ne_stock = 10**np.linspace(20,24,13)
+        ne_stock = ne_stocks[self.wl]
         if ne in ne_stock:
             ne_low = ne_high = ne
         else:
@@ -93,10 +323,7 @@ class gigosos_he_loader():
 
 
     def closest_mu(self,mu):
-        if round(self.transition.wl,0) == 447:
-            mu_stock = np.array([0.8, 2, 4])
-        if round(self.transition.wl,0) == 492:
-            mu_stock = np.array([0.8, 2, 4, 10])
+        mu_stock = mu_stocks[self.wl]
         if mu in mu_stock:
             mu_low = mu_high = mu
         elif mu < mu_stock[0]:
@@ -110,7 +337,7 @@ class gigosos_he_loader():
 
 
     def get_T_stock(self, ne):
-        if round(self.transition.wl,0) == 447:
+        if self.wl == 447:
             ne_stock = 10**np.linspace(21,24,10) # prevent rounding errors
             if ne <= ne_stock[4]:
                 T_stock = np.array([5000, 10000, 20000, 40000])
@@ -119,7 +346,7 @@ class gigosos_he_loader():
             if ne >= ne_stock[8]:
                 T_stock = np.array([20000, 40000])
                 
-        if round(self.transition.wl,0) == 492:
+        if self.wl == 492:
             if ne <= 1e22:
                 T_stock = np.array([5000, 10000, 20000, 40000])
             if ne > 1e22 and ne <= 1e23:
@@ -147,11 +374,11 @@ class gigosos_he_loader():
 
 
     def load_file(self,ne):
-        if round(self.transition.wl,0) == 447:
+        if self.wl == 447:
             folder = data_folder447
             filename = "table"
             table_num = str(int(round((np.log10((ne/1e20))*3-1)))).zfill(2)
-        if round(self.transition.wl,0) == 492:
+        if self.wl == 492:
             folder = data_folder492
             folder = os.path.join(folder,"He492")
             filename = "table"
@@ -187,42 +414,73 @@ class gigosos_he_loader():
             return high_x,high_y
 
 
-    def load_stark_profile(self,ne_, mu_, T_):
-        if round(self.transition.wl,0) == 447:
-            mu_stock = np.array([0.8, 2, 4])
-        if round(self.transition.wl,0) == 492:
-            mu_stock = np.array([0.8, 2, 4, 10])
+    def mix_derivative(self, low_x, high_x, low_y, high_y, low_val, high_val):
+        "Derivative of the interpolated profile with respect to val."
+        if high_val == low_val: # on a table point or outside of the table
+            return np.zeros(len(high_x))
+        return (np.array(high_y) - interpol(low_x, low_y, high_x))/(high_val - low_val)
+
+
+    def load_stark_profile(self,ne_, mu_, T_, derivatives=False):
+        """ Profile for <ne_>, <mu_> and <T_> (K), interpolated linearly 
+        between the table values. If <derivatives>, also returns the 
+        derivatives of the profile with respect to ne, mu and T. """
+        mu_stock = mu_stocks[self.wl]
+        store = table_store.open(self.wl) # memory mapped
 
         x = None
         profiles_ne = []
         vals_ne = []
         for ne in self.closest_ne(ne_):
-            table = self.load_file(ne)
+            if store is None:
+                table = self.load_file(ne)
             profiles_mu = []
             vals_mu = []
             for mu in self.closest_mu(mu_):
-                T_stock = self.get_T_stock(ne)
                 T_low,T_high = self.closest_T(T_,ne)
-                pos_low = (list(T_stock).index(T_low)+1) + (len(T_stock) * list(mu_stock).index(mu))
-                pos_high = (list(T_stock).index(T_high)+1) + (len(T_stock) * list(mu_stock).index(mu))
-                _,y_low = table[0], table[pos_low]
-                high_x,y_high = table[0], table[pos_high]
+                if store is not None:
+                    _,y_low = store.get(ne,mu,T_low)
+                    high_x,y_high = store.get(ne,mu,T_high)
+                else:
+                    T_stock = self.get_T_stock(ne)
+                    pos_low = (list(T_stock).index(T_low)+1) + (len(T_stock) * list(mu_stock).index(mu))
+                    pos_high = (list(T_stock).index(T_high)+1) + (len(T_stock) * list(mu_stock).index(mu))
+                    _,y_low = table[0], table[pos_low]
+                    high_x,y_high = table[0], table[pos_high]
                 x,y = self.interpolate_stark_profile(high_x,y_low,y_high,T_low,T_high,T_)
-                profiles_mu.append((x,y))
+                dy_dT = None
+                if derivatives:
+                    dy_dT = self.mix_derivative(high_x,high_x,y_low,y_high,T_low,T_high)
+                profiles_mu.append((x,y,dy_dT))
                 vals_mu.append(mu)
 
             x,y = self.interpolate_stark_profile(
                 profiles_mu[1][0],profiles_mu[0][1],
                 profiles_mu[1][1],vals_mu[0],vals_mu[1],mu_)
-
-            profiles_ne.append((x,y))
+            d = None
+            if derivatives:
+                dy_dmu = self.mix_derivative(
+                    profiles_mu[1][0],profiles_mu[1][0],profiles_mu[0][1],
+                    profiles_mu[1][1],vals_mu[0],vals_mu[1])
+                _,dy_dT = self.interpolate_stark_profile(
+                    profiles_mu[1][0],profiles_mu[0][2],
+                    profiles_mu[1][2],vals_mu[0],vals_mu[1],mu_)
+                d = (dy_dmu, dy_dT)
+
+            profiles_ne.append((x,y,d))
             vals_ne.append(ne)
 
         x,y = self.interpolate_stark_profile_ne(
             profiles_ne[0][0],profiles_ne[1][0],profiles_ne[0][1],
             profiles_ne[1][1],vals_ne[0],vals_ne[1],ne_)
-
-        return x,y
-
-
-
+        if not derivatives:
+            return x,y
+
+        dy = [self.mix_derivative(profiles_ne[0][0],profiles_ne[1][0],profiles_ne[0][1],
+                                  profiles_ne[1][1],vals_ne[0],vals_ne[1])]
+        for i in range(2): # mu, T
+            _,d = self.interpolate_stark_profile_ne(
+                profiles_ne[0][0],profiles_ne[1][0],profiles_ne[0][2][i],
+                profiles_ne[1][2][i],vals_ne[0],vals_ne[1],ne_)
+            dy.append(d)
+        return x,y,dy
@@ -3,6 +3,8 @@
 import numpy as np
 from scipy import constants as const
 from ..util import interpol
+from .interpolator import table_interpolator
+from .widths import width_table
 import os
 from platformdirs import user_data_dir
 import requests
@@ -11,11 +13,141 @@ from zipfile import ZipFile
 from io import BytesIO
 data_folder = os.path.join(user_data_dir("owl-OES", "owl-OES"), "Gigosos2003H")
 
+# Table values of the profiles (rho = r0/rD, the temperature of the files 
+# follows from rho and ne, see rho_to_T).
+ne_stock = 10**np.linspace(20,25,16)
+mu_stock = np.array([0.50, 0.80, 0.90, 1.00, 1.25, 1.5, 1.75, 2.00,
+    2.50, 3.00, 4.00, 5.00, 6.00, 7.00, 8.00, 9.00, 10.0])
+rho_stock = np.linspace(0.1,0.6,11)
+
+# rounded wavelength: archive name (without .zip), prefix of the file names
+tables = {656: ("HalphaProfiles", "BAn"), 486: ("HbetaProfiles", "BBn"),
+          434: ("HgammaProfiles", "BGn")}
+
+# The profiles of each archive are converted once to a binary array, which
+# is memory mapped (see profile_store). Increase if the format changes.
+store_version = 1
+_stores = {}
+
+
+class profile_store():
+    """ All profiles of one line in a single array of shape 
+    (ne, mu, rho, 2, points), x in [..., 0, :] and y in [..., 1, :], padded
+    with NaN. Axis metadata: the table values ne, mu, rho (see ne_stock...)
+    and the number of points of each profile (0 if it is not tabulated).
+    The array is memory mapped, so only the used profiles are read from
+    disk and processes share them. """
+
+    def __init__(self, name):
+        self.name = name
+        filename = profile_store.filename(name)
+        with np.load(filename + "_axes.npz") as axes:
+            if int(axes["version"]) != store_version:
+                raise ValueError("outdated profile store " + name)
+            self.ne, self.mu, self.rho = axes["ne"], axes["mu"], axes["rho"]
+            self.length = axes["length"]
+        self.profiles = np.load(filename + ".npy", mmap_mode="r")
+        self.interpolator = table_interpolator(self.ne, self.mu, self.rho, self.profile)
+
+    @staticmethod
+    def filename(name):
+        return os.path.join(data_folder, name)
+
+    def get(self, ne, mu, rho):
+        """ x and y of the tabulated profile (read only views). """
+        i = np.argmin(np.abs(np.log(self.ne/ne)))
+        j = np.argmin(np.abs(self.mu - mu))
+        k = np.argmin(np.abs(self.rho - rho))
+        return self.profile(i, j, k)
+
+    def profile(self, i, j, k):
+        "x and y of the profile with the table indices i, j, k"
+        n = self.length[i, j, k]
+        if n == 0:
+            raise FileNotFoundError('Error: Could not find Stark broadening data tables.')
+        return self.profiles[i, j, k, 0, :n], self.profiles[i, j, k, 1, :n]
+
+    def compute_widths(self, doppler=0, instrument=None):
+        """ Width table of the profiles, see width_table.compute. """
+        extent = [np.fmax.reduce(self.profiles[i, :, :, 0], axis=None) for i in range(len(self.ne))]
+        profiles = lambda x, ne, mu, rho: self.interpolator(np.abs(x)*1e-9, ne, mu, rho)/1e9
+        return width_table.compute(self.ne, self.mu, self.rho, profiles,
+                                   np.array(extent)*1e9, self.length > 0,
+                                   doppler, instrument)
+
+    def widths(self, doppler=0, instrument=None):
+        """ FWHM, shift and asymmetry of the profiles, see width_table. 
+        Saved next to the store. """
+        return width_table.open(profile_store.filename(self.name) + "_widths.npz",
+                                self.compute_widths, doppler, instrument)
+
+    @staticmethod
+    def open(name):
+        """ Return the store for the archive <name>, converting the archive
+        if needed. None if neither exists. """
+        if name in _stores:
+            return _stores[name]
+        try:
+            store = profile_store(name)
+        except (OSError, KeyError, ValueError):
+            if not os.path.exists(profile_store.filename(name) + ".zip"):
+                return None
+            store = profile_store.convert(name)
+        _stores[name] = store
+        return store
+
+    @staticmethod
+    def convert(name):
+        """ Read all profiles from the archive <name>.zip and save them as
+        profile store next to it. Returns the store, or None if it could 
+        not be saved. """
+        print("Converting Stark broadening data tables " + name + 
+              " (only needed once).")
+        prefix = [p for n, p in tables.values() if n == name][0]
+        loader = gigosos_loader(None)
+        profiles = {}
+        with ZipFile(profile_store.filename(name) + ".zip", 'r') as datazip:
+            members = set(datazip.namelist())
+            for i, ne in enumerate(ne_stock):
+                for j, mu in enumerate(mu_stock):
+                    for k, rho in enumerate(rho_stock):
+                        member = loader.member_name(ne, mu, rho, prefix)
+                        if member in members:
+                            with datazip.open(member) as datafile:
+                                profiles[i, j, k] = np.loadtxt(datafile).T
+        points = max([len(xy[0]) for xy in profiles.values()] + [1])
+        length = np.zeros((len(ne_stock), len(mu_stock), len(rho_stock)), dtype=int)
+        filename = profile_store.filename(name)
+        try:
+            # written to temporary files first, so that other processes
+            # never see a partial store
+            data = np.lib.format.open_memmap(filename + ".tmp.npy", mode="w+",
+                                             dtype=float, shape=length.shape + (2, points))
+            data[:] = np.nan
+            for index, xy in profiles.items():
+                length[index] = len(xy[0])
+                data[index][:, :len(xy[0])] = xy
+            data.flush()
+            del data
+            with open(filename + ".tmp_axes.npz", "wb") as f:
+                np.savez(f, version=store_version, ne=ne_stock, mu=mu_stock, 
+                         rho=rho_stock, length=length)
+            os.replace(filename + ".tmp.npy", filename + ".npy")
+            os.replace(filename + ".tmp_axes.npz", filename + "_axes.npz")
+        except OSError:
+            print("WARNING: could not save Stark broadening data tables " + name)
+            return None
+        store = profile_store(name)
+        width_table.clear(filename + "_widths.npz")
+        store.compute_widths().save(filename + "_widths.npz")
+        return store
+
 class gigosos_loader():
     def __init__(self, transition):
         self.transition = transition
         
         
+    @staticmethod
     def download_profiles(redownload = False):
         if os.path.exists(data_folder+"/HalphaProfiles.zip") and redownload==False:
             return
@@ -33,9 +165,24 @@ class gigosos_loader():
                 zip_ref.extractall(data_folder)
         except:
             print("ERROR: could now save hydrogen Stark broadening tables to disk")
+        gigosos_loader.convert_profiles()
+
+
+    @staticmethod
+    def convert_profiles():
+        """ Convert the downloaded archives to memory mapped profile stores,
+        see profile_store. """
+        for name, prefix in tables.values():
+            _stores.pop(name, None)
+            if os.path.exists(profile_store.filename(name) + ".zip"):
+                _stores[name] = profile_store.convert(name)
 
 
-    def load(self, ne, Te, pert):
+    def load(self, ne, Te, pert, derivatives=False):
+        """ Stark profile for <ne> and <Te>. If <derivatives>, also returns
+        the derivatives of the profile with respect to ne, Te and the 
+        perturber temperature, from the derivatives of the interpolation
+        weights. """
         r0 = (3/(4 * np.pi * ne))**(1/3)
         rD = ((const.epsilon_0 * const.k * Te)/(ne * const.e**2))**(1/2)
         rho = r0/rD
@@ -46,7 +193,101 @@ class gigosos_loader():
            mu = reduced_m * Te/pert.T
         else:
            mu = 1
-        return self.load_stark_profile(ne, mu, rho)
+        if not derivatives:
+            return self.load_stark_profile(ne, mu, rho)
+        x, y, (dy_dne, dy_dmu, dy_drho) = self.load_stark_profile(ne, mu, rho, True)
+        # rho ~ ne^(1/6) Te^(-1/2), mu ~ Te/T_pert
+        dy_dTe = dy_drho * (-rho/(2*Te)) + (dy_dmu * mu/Te if pert else 0)
+        dy_dT_pert = -dy_dmu * mu/pert.T if pert else 0*y
+        return x, y, dy_dne + dy_drho * rho/(6*ne), dy_dTe, dy_dT_pert
+
+
+    def get_profiles(self, x, ne, Te, pert=None, T_pert=None, derivatives=False):
+        """ Stark profiles for arrays of <ne> and <Te> on the axis <x> (nm,
+        relative to the line center), one row per value, interpolated in
+        one step from the profile store (see table_interpolator). 
+        <T_pert>: Perturber temperatures, defaults to pert.T. Rows with 
+                  T_pert = 0 are calculated without perturber (mu = 1).
+        If <derivatives>, also returns the derivatives of the profiles 
+        with respect to ne, Te and the perturber temperature.
+        None if the tables are not converted to a profile store. """
+        store = profile_store.open(tables[int(round(self.transition.wl,0))][0])
+        if store is None:
+            return None
+        ne, Te = [np.asarray(v, dtype=float).ravel() for v in 
+                  np.broadcast_arrays(np.atleast_1d(ne), np.atleast_1d(Te))]
+        rho = self.rho(ne, Te)
+        mu, T_pert = self.mass_ratio(Te, pert, T_pert)
+        # the tables hold half profiles, x in m
+        result = store.interpolator(np.abs(x)*1e-9, ne, mu, rho, derivatives)
+        if not derivatives:
+            return result/1e9
+        y, (dy_dne, dy_dmu, dy_drho) = result
+        tied = (T_pert > 0)[:,None] # mu ~ Te/T_pert
+        dy_dTe = dy_drho * (-rho/(2*Te))[:,None] + np.where(tied, dy_dmu * (mu/Te)[:,None], 0)
+        dy_dT_pert = np.where(tied, -dy_dmu * (mu/np.where(T_pert > 0, T_pert, 1))[:,None], 0)
+        return (y/1e9, (dy_dne + dy_drho * (rho/(6*ne))[:,None])/1e9, dy_dTe/1e9, 
+                dy_dT_pert/1e9)
+
+
+    def rho(self, ne, Te):
+        "rho = r0/rD, the table parameter, for <ne> and <Te> (arrays)"
+        r0 = (3/(4 * np.pi * ne))**(1/3)
+        rD = ((const.epsilon_0 * const.k * Te)/(ne * const.e**2))**(1/2)
+        return r0/rD
+
+
+    def mass_ratio(self, Te, pert=None, T_pert=None):
+        """ mu = reduced mass * Te/T_pert for the array <Te> and the 
+        temperatures <T_pert> of the perturber <pert> (default pert.T). 
+        Returns mu and T_pert, mu = 1 where there is no perturber or 
+        T_pert = 0. """
+        if not pert:
+            return np.ones(len(Te)), np.zeros(len(Te))
+        emitter_m = self.transition.particle.m
+        reduced_m = (emitter_m * pert.m)/(emitter_m + pert.m)
+        reduced_m = reduced_m/const.u
+        T_pert = np.broadcast_to(pert.T if T_pert is None else T_pert, Te.shape)
+        mu = np.where(T_pert > 0, reduced_m * Te/np.where(T_pert > 0, T_pert, 1), 1)
+        return mu, T_pert
+
+
+    def characteristics(self, ne, Te, pert=None, T_pert=None, doppler=0,
+                        instrument=None):
+        """ FWHM, shift and asymmetry (see widths.characteristics) of the
+        profiles for arrays of <ne> and <Te>, interpolated from the width
+        tables. Result dict with arrays "fwhm", "shift" (nm) and 
+        "asymmetry". NaN outside of the tables.
+        <doppler>: FWHM (nm) of a Gaussian (Doppler) profile and 
+        <instrument>: (w, mu) of a psd_voigt instrumental function the 
+                      profiles are convolved with.
+        None if the tables are not converted to a profile store. """
+        store = profile_store.open(tables[int(round(self.transition.wl,0))][0])
+        if store is None:
+            return None
+        ne, Te = [np.asarray(v, dtype=float).ravel() for v in 
+                  np.broadcast_arrays(np.atleast_1d(ne), np.atleast_1d(Te))]
+        mu, _ = self.mass_ratio(Te, pert, T_pert)
+        table = store.widths(doppler, instrument)
+        rho = self.rho(table.ne[None,:], Te[:,None]) # rho depends on ne
+        return dict(zip(("fwhm", "shift", "asymmetry"), table.at(ne, mu, rho)))
+
+
+    def ne_from_width(self, width, Te, pert=None, T_pert=None, doppler=0,
+                      instrument=None):
+        """ Electron densities for arrays of the measured FWHM <width> (nm)
+        and <Te>, interpolated from the width tables (see characteristics 
+        for the other parameters). NaN if the width is outside of the 
+        tables. None if the tables are not converted to a profile store. """
+        store = profile_store.open(tables[int(round(self.transition.wl,0))][0])
+        if store is None:
+            return None
+        width, Te = [np.asarray(v, dtype=float).ravel() for v in 
+                     np.broadcast_arrays(np.atleast_1d(width), np.atleast_1d(Te))]
+        mu, _ = self.mass_ratio(Te, pert, T_pert)
+        table = store.widths(doppler, instrument)
+        rho = self.rho(table.ne[None,:], Te[:,None]) # rho depends on ne
+        return table.invert(width, mu, rho)
 
 
     def closest(self,val,array):
@@ -72,7 +313,6 @@ class gigosos_loader():
 
 
     def closest_ne(self,ne):
-        ne_stock = 10**np.linspace(20,25,16)
         if ne in ne_stock:
             ne_low = ne_high = ne
         else:
@@ -82,8 +322,6 @@ class gigosos_loader():
 
 
     def closest_mu(self,mu):
-        mu_stock = np.array([0.50, 0.80, 0.90, 1.00, 1.25, 1.5, 1.75, 2.00,
-            2.50, 3.00, 4.00, 5.00, 6.00, 7.00, 8.00, 9.00, 10.0])
         if mu in mu_stock:
             mu_low = mu_high = mu
         elif mu < mu_stock[0]:
@@ -97,7 +335,6 @@ class gigosos_loader():
 
 
     def closest_rho(self,rho):
-        rho_stock = np.linspace(0.1,0.6,11)
         if rho in rho_stock:
             rho_low = rho_high = rho
         elif rho < rho_stock[0]:
@@ -117,12 +354,19 @@ class gigosos_loader():
         return T
 
 
-    def load_file(self,ne,mu,rho,prefix,datazip):        
+    def member_name(self,ne,mu,rho,prefix):
+        "Name of the file with the profile for ne, mu and rho in the archive"
         ne_name = str(int(round(np.log10(ne)*100,0)))
         T = str(int(round(self.rho_to_T(rho,ne),0)))
         T_name = str(T).zfill(7)
         mu_name = str(int(mu*100)).zfill(4)
-        filename = prefix + ne_name + "t" + T_name + "m" + mu_name + ".dlp"
+        return prefix + ne_name + "t" + T_name + "m" + mu_name + ".dlp"
+
+
+    def load_file(self,ne,mu,rho,prefix,datazip):        
+        if isinstance(datazip, profile_store):
+            return datazip.get(ne,mu,rho)
+        filename = self.member_name(ne,mu,rho,prefix)
         try:
             datafile = datazip.open(filename)
             x,y = np.loadtxt(datafile).T
@@ -143,6 +387,13 @@ class gigosos_loader():
             return high_x,high_y
 
 
+    def mix_derivative(self, low_x, high_x, low_y, high_y, low_val, high_val):
+        "Derivative of interpolate_stark_profile with respect to val."
+        if high_val == low_val: # on a table point or outside of the table
+            return np.zeros(len(high_x))
+        return (np.array(high_y) - interpol(low_x, low_y, high_x))/(high_val - low_val)
+
+
     def interpolate_stark_profile_ne(self,low_x, high_x, low_y, high_y, low_val, high_val, val):
         "Creates profile for arbitrary ne. Arrays must use same x!"
         low_y = interpol(low_x, low_y, high_x) # all to high_x
@@ -155,20 +406,15 @@ class gigosos_loader():
             return high_x,high_y
 
 
-    def load_stark_profile(self,ne_, mu_, rho_):
+    def load_stark_profile(self,ne_, mu_, rho_, derivatives=False):
+        """ Profile for <ne_>, <mu_> and <rho_>, interpolated linearly between
+        the table values. If <derivatives>, also returns the derivatives of
+        the profile with respect to ne, mu and rho. """
         
-        folder = data_folder
-        ele = self.transition.emitter.symbol
-        if ele == "H" and round(self.transition.wl,0) == 656.0:
-            datazip = os.path.join(folder,"HalphaProfiles.zip")
-            prefix = "BAn"
-        if ele == "H" and round(self.transition.wl,0) == 486.0:
-            datazip = os.path.join(folder,"HbetaProfiles.zip")
-            prefix = "BBn"
-        if ele == "H" and round(self.transition.wl,0) == 434.0:
-            datazip = os.path.join(folder,"HgammaProfiles.zip")
-            prefix = "BGn"
-        datazip = ZipFile(datazip, 'r')
+        name, prefix = tables[int(round(self.transition.wl,0))]
+        datazip = profile_store.open(name) # memory mapped
+        if datazip is None:
+            datazip = ZipFile(os.path.join(data_folder, name + ".zip"), 'r')
         
         x = None
         profiles_ne = []
@@ -181,13 +427,25 @@ class gigosos_loader():
                 low_x,y_low = self.load_file(ne,mu,rho_low,prefix,datazip)
                 high_x,y_high = self.load_file(ne,mu,rho_high,prefix,datazip)
                 x,y = self.interpolate_stark_profile(low_x,high_x,y_low,y_high,rho_low,rho_high,rho_)
-                profiles_mu.append((x,y))
+                dy_drho = None
+                if derivatives:
+                    dy_drho = self.mix_derivative(low_x,high_x,y_low,y_high,rho_low,rho_high)
+                profiles_mu.append((x,y,dy_drho))
                 vals_mu.append(mu)
             x,y = self.interpolate_stark_profile(
                 profiles_mu[0][0],profiles_mu[1][0],profiles_mu[0][1],
                 profiles_mu[1][1],vals_mu[0],vals_mu[1],mu_)
-
-            profiles_ne.append((x,y))
+            d = None
+            if derivatives:
+                dy_dmu = self.mix_derivative(
+                    profiles_mu[0][0],profiles_mu[1][0],profiles_mu[0][1],
+                    profiles_mu[1][1],vals_mu[0],vals_mu[1])
+                _,dy_drho = self.interpolate_stark_profile(
+                    profiles_mu[0][0],profiles_mu[1][0],profiles_mu[0][2],
+                    profiles_mu[1][2],vals_mu[0],vals_mu[1],mu_)
+                d = (dy_dmu, dy_drho)
+
+            profiles_ne.append((x,y,d))
             vals_ne.append(ne)
 
         x,y = self.interpolate_stark_profile_ne(
@@ -195,9 +453,17 @@ class gigosos_loader():
             profiles_ne[1][1],vals_ne[0],vals_ne[1],ne_)
 
         y = self.mirror_profile(y)/1e9
+        if not derivatives:
+            x = self.mirror_x(x)*1e9
+            return x,y
+
+        dy = [self.mix_derivative(profiles_ne[0][0],profiles_ne[1][0],profiles_ne[0][1],
+                                  profiles_ne[1][1],vals_ne[0],vals_ne[1])]
+        for i in range(2): # mu, rho
+            _,d = self.interpolate_stark_profile_ne(
+                profiles_ne[0][0],profiles_ne[1][0],profiles_ne[0][2][i],
+                profiles_ne[1][2][i],vals_ne[0],vals_ne[1],ne_)
+            dy.append(d)
+        dy = [self.mirror_profile(d)/1e9 for d in dy]
         x = self.mirror_x(x)*1e9
-
-        return x,y
-
-
-
+        return x,y,dy
@@ -3,32 +3,51 @@
 import numpy as np
 from scipy import constants as const
 from ..util import *
+from . import registry
 import os
 
 class griem():
-    def __init__(self, transition):
+    def __init__(self, transition, line=None):
+        """ <line>: The stark_line of the transition (see registry), looked
+        up if None. """
         self.transition = transition
+        self.line = line if line is not None else registry.find(transition)
+        if self.line is not None and self.line.model != "griem":
+            self.line = None
 
     def get_width_shift(self, ne, Te):
-        ele = self.transition.emitter.symbol
-        wl = self.transition.wl
-
-        if ele == "O" and round(wl, 0) == 777.:
-            A,B,we,de = self.params_O777(Te)
-            w = self.width(ne,Te,A,we)
-            d = self.shift(ne,Te,A,we,de)
-        if ele == "Ar" and (round(wl, 3) == 810.369 or round(wl, 3) == 738.398):
-            A,B,we,de = self.params_Ar8104(Te)
-            w = self.width(ne,Te,A,we)
-            d = self.shift(ne,Te,A,we,de)
-        else:
-            w = -1
-            d = -1
+        if self.line is None:
             print("Stark broadening not implemented for this line.")
-        
+            return -1, -1
+
+        A,B,we,de = self.params(Te)
+        w = self.width(ne,Te,A,we)
+        d = self.shift(ne,Te,A,we,de)
         return w,d
 
 
+    def params(self, Te):
+        """ A, B and we, de in Angstrom of the line at the electron 
+        temperature <Te> (eV), from the fits in the registry. """
+        # we need Te in K
+        T = Te * const.eV / const.k
+        return tuple(griem.evaluate(self.line.params[key], T) 
+                     for key in ("A", "B", "we", "de"))
+
+
+    @staticmethod
+    def evaluate(terms, T):
+        """ Sum of coefficient*T^exponent over the [coefficient, exponent]
+        <terms>. """
+        return sum(c * T**e for c, e in terms)
+
+
+    @staticmethod
+    def evaluate_derivative(terms, T):
+        """ Derivative of evaluate() with respect to T. """
+        return sum(c * e * T**(e-1) for c, e in terms)
+
+
     def width(self,ne,Te,A,we):
         """ Te in eV, ne in m^-3
         we, de in Angstrom @ 1e22/m^3 density
@@ -48,6 +67,25 @@ class griem():
         return w
 
 
+    def width_derivatives(self, ne, Te):
+        """ Derivatives of the width (nm) with respect to ne (m^-3) and
+        Te (eV), from the power laws of width() and the fits of A and we. """
+        T = Te * const.eV / const.k
+        n = ne * 1e-6
+        A, we = (griem.evaluate(self.line.params[key], T) for key in ("A", "we"))
+        dA, dwe = (griem.evaluate_derivative(self.line.params[key], T) 
+                   for key in ("A", "we"))
+
+        # w = 2e-17 * we * n * (1 + 1.75e-4 * A * g), g = n^(1/4) - 0.068*n^(5/12)*T^(-1/2)
+        g = n**(1/4) - 0.068 * n**(5/12) * T**(-1/2)
+        dg_dn = n**(-3/4)/4 - 0.068 * 5/12 * n**(-7/12) * T**(-1/2)
+        dg_dT = 0.034 * n**(5/12) * T**(-3/2)
+        dw_dn = 2e-17 * we * (1 + 1.75e-4 * A * (g + n*dg_dn))
+        dw_dT = 2e-17 * n * (dwe * (1 + 1.75e-4 * A * g) + 
+                             we * 1.75e-4 * (dA * g + A * dg_dT))
+        return dw_dn * 1e-6, dw_dT * const.eV / const.k
+
+
     def shift(self,ne,Te,A,we,de):
         """ Te in eV, ne in m^-3
         we, de in Angstrom @ 1e22/m^3 density """
@@ -70,19 +108,8 @@ class griem():
          returns A,B and we,de in Angstrom
          All values at ne = 10^16 /cm^3
          """
-
-        # we need Te in K
-        T = Te * const.eV / const.k
-
-        B = 0.00023718 * T # recommended by Griem
-        A = 0.27661461 * T**(-0.33635335) # Just fits okay.
-        we = 4.36767799e-04 * T**(0.465538767) # Fitted; in Angstrom
-
-        a0,a1,a2,a3,a4 = [1.39308003e-02,1.88771484e-07,-2.17304732e-11,
-        6.29115391e-16,-6.33972112e-21] # very much overdefined...
-        de = a0 + a1*T + a2*T**2 + a3*T**3 + a4*T**4
-
-        return A,B,we,de
+        line = registry.lookup("O", 0, 777.)
+        return griem(self.transition, line).params(Te)
 
 
     def params_Ar8104(self,Te):
@@ -91,14 +118,5 @@ class griem():
          returns A,B and we,de in Angstrom
          All values at ne = 10^16 /cm^3
          """
-
-        # we need Te in K
-        T = Te * const.eV / const.k
-
-        B = 5.25e-5 * T # recommended by Griem
-        A = 0.3248611802364256 * T**(-0.2795132945865003) # Just fits okay.
-        we = -0.001503172622523098 + 0.002098004523296234 * T**0.358775514451271
-        a0,a1,a2,a3 = [0.056, -6.4e-07, 4e-12, -48] # very much overdefined...
-        de =  a0 + a1*T + a2*T**2 +  a3*T**-1
-
-        return A,B,we,de
+        line = registry.lookup("Ar", 0, 810.369)
+        return griem(self.transition, line).params(Te)
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+""" Multilinear interpolation of tabulated Stark profiles between the table
+values of the electron density, the reduced mass mu and a third parameter
+(rho = r0/rD for the hydrogen tables, the temperature for helium).
+
+The cells of many parameter sets are located with searchsorted and the
+weights of all corners are calculated at once. Every tabulated profile
+that is needed is evaluated on the requested axis once, the results are
+the weighted sums of the corner profiles. """
+
+import numpy as np
+
+__all__ = ["table_interpolator"]
+
+
+class table_interpolator():
+    """ Interpolates between the profiles of a table store.
+    <ne>, <mu>, <p>: Table values (ascending) of the three axes.
+    <profile>: Function (i, j, k) that returns the x and y arrays of the
+               profile for ne[i], mu[j] and p[k].
+    <mask>: Optional boolean array (ne, p) of the p values that are
+            tabulated for each density. All by default.
+    Values of ne outside of the table raise a ValueError, mu and p are
+    limited to the table (the profiles at the edge are used). """
+
+    def __init__(self, ne, mu, p, profile, mask=None):
+        self.ne = np.asarray(ne, dtype=float)
+        self.mu = np.asarray(mu, dtype=float)
+        self.p = np.asarray(p, dtype=float)
+        self.profile = profile
+        if mask is None:
+            mask = np.ones((len(self.ne), len(self.p)), dtype=bool)
+        self.mask = np.asarray(mask, dtype=bool)
+
+    @staticmethod
+    def cell(stock, values, clip=True):
+        """ Indices of the lower and upper table values around <values>,
+        the weights of the upper values and their derivatives. """
+        values = np.asarray(values, dtype=float)
+        if clip:
+            inside = (values > stock[0]) & (values < stock[-1])
+            values = np.clip(values, stock[0], stock[-1])
+        if len(stock) == 1:
+            zero = np.zeros(values.shape, dtype=int)
+            return zero, zero, np.zeros(values.shape), np.zeros(values.shape)
+        high = np.clip(np.searchsorted(stock, values), 1, len(stock)-1)
+        low = high - 1
+        step = stock[high] - stock[low]
+        t = (values - stock[low])/step
+        dt = 1/step
+        if clip:
+            dt = np.where(inside, dt, 0)
+        return low, high, t, dt
+
+    def corners(self, ne, mu, p):
+        """ Table indices (N, 8, 3) of the corners of the cells around the
+        parameter sets, their weights (N, 8) and the derivatives of the
+        weights with respect to ne, mu and p (3, N, 8). """
+        ne, mu, p = [np.asarray(v, dtype=float).ravel() for v in np.broadcast_arrays(ne, mu, p)]
+        if np.any(ne < self.ne[0]) or np.any(ne > self.ne[-1]):
+            raise ValueError("Electron density outside of the Stark broadening tables (" +
+                             "{:.3g} to {:.3g} m^-3)".format(self.ne[0], self.ne[-1]))
+        n = len(ne)
+        ne_cell = table_interpolator.cell(self.ne, ne, clip=False)
+        mu_cell = table_interpolator.cell(self.mu, mu)
+
+        # the tabulated p can differ between the two densities of a cell
+        p_cells = []
+        for i in ne_cell[:2]:
+            low, high = np.zeros(n, dtype=int), np.zeros(n, dtype=int)
+            t, dt = np.zeros(n), np.zeros(n)
+            for u in np.unique(i):
+                rows = i == u
+                index = np.flatnonzero(self.mask[u])
+                l, h, t[rows], dt[rows] = table_interpolator.cell(self.p[index], p[rows])
+                low[rows], high[rows] = index[l], index[h]
+            p_cells.append((low, high, t, dt))
+
+        index = np.zeros((n, 8, 3), dtype=int)
+        weights = np.zeros((n, 8))
+        dweights = np.zeros((3, n, 8))
+        corner = 0
+        for a in (0, 1):
+            w_ne = ne_cell[2] if a else 1 - ne_cell[2]
+            d_ne = ne_cell[3] if a else -ne_cell[3]
+            p_cell = p_cells[a]
+            for b in (0, 1):
+                w_mu = mu_cell[2] if b else 1 - mu_cell[2]
+                d_mu = mu_cell[3] if b else -mu_cell[3]
+                for c in (0, 1):
+                    w_p = p_cell[2] if c else 1 - p_cell[2]
+                    d_p = p_cell[3] if c else -p_cell[3]
+                    index[:, corner] = np.stack([ne_cell[a], mu_cell[b], p_cell[c]], axis=1)
+                    weights[:, corner] = w_ne*w_mu*w_p
+                    dweights[:, :, corner] = d_ne*w_mu*w_p, w_ne*d_mu*w_p, w_ne*w_mu*d_p
+                    corner += 1
+        return index, weights, dweights
+
+    def __call__(self, x, ne, mu, p, derivatives=False):
+        """ Interpolated profiles on the axis <x> (in the units of the
+        tables), one row per parameter set (<ne>, <mu>, <p>, numbers or
+        arrays). The tabulated profiles are linearly interpolated on x and
+        are zero outside of their range. If <derivatives>, also returns the
+        derivatives of the profiles with respect to ne, mu and p. """
+        x = np.asarray(x, dtype=float)
+        index, weights, dweights = self.corners(ne, mu, p)
+        n = len(weights)
+        needed = (weights != 0) | (np.any(dweights != 0, axis=0) if derivatives else False)
+
+        # every needed corner profile is evaluated once, unneeded corners
+        # point to a row of zeros
+        shape = (len(self.ne), len(self.mu), len(self.p))
+        flat = np.ravel_multi_index(tuple(np.moveaxis(index, -1, 0)), shape)
+        unique, inverse = np.unique(flat[needed], return_inverse=True)
+        rows = np.full(flat.shape, len(unique))
+        rows[needed] = inverse.ravel()
+        profiles = np.zeros((len(unique) + 1, len(x)))
+        for r, corner in enumerate(unique):
+            table_x, table_y = self.profile(*np.unravel_index(corner, shape))
+            profiles[r] = np.interp(x, table_x, table_y, left=0, right=0)
+
+        y = np.zeros((n, len(x)))
+        for corner in range(8):
+            y += weights[:, corner, None] * profiles[rows[:, corner]]
+        if not derivatives:
+            return y
+        dy = np.zeros((3, n, len(x)))
+        for corner in range(8):
+            dy += dweights[:, :, corner, None] * profiles[rows[:, corner]]
+        return y, dy
@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+""" Registry of the lines with Stark broadening data.
+
+Each line is identified by the element, the ion charge (0 for neutral
+atoms) and a wavelength window, and names the model that calculates its
+profile (see models), the data source and the parameters of the model. The
+lines shipped with owlspec are read from data/stark_lines.json on the first
+lookup. More lines, e.g. further Griem parameter sets, can be added with
+load_lines() or register().
+
+The lines are indexed by element, charge and 1 nm wavelength bins, so a
+lookup only compares the few lines of one bin. """
+
+import os
+import json
+import threading
+
+__all__ = ["stark_line", "models", "lookup", "find", "register", "load_lines",
+           "lines"]
+
+lines_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          "data", "stark_lines.json")
+
+# model: description. Models with tabulated profiles are calculated by the
+# table loaders (gigosos_loader, gigosos_he_loader), "griem" is a Lorentzian.
+models = {"gigosos_hydrogen": "Tabulated profiles, Gigosos et al. (2003)",
+          "gigosos_helium": "Tabulated profiles, Gigosos et al. (2009), Lara et al. (2012)",
+          "griem": "Lorentzian with the width and shift fits to Griem's tables"}
+
+_index = {} # (element, charge, wavelength bin): [stark_line, ...]
+_loaded = []
+_lock = threading.Lock()
+
+
+class stark_line():
+    """ One line with Stark broadening data.
+    <element>: Element symbol, e.g. "Ar"
+    <charge>: Ion charge, 0 for neutral atoms.
+    <wl>: Wavelength in nm.
+    <tolerance>: Transitions within wl +- tolerance (nm) are this line.
+    <model>: Name of the model, a key of models.
+    <source>: Reference of the data.
+    <params>: Dictionary of the model parameters. For "griem": "A", "B",
+              "we" and "de" (Angstrom at 1e16 cm^-3), each a list of terms
+              [coefficient, exponent], the sum of coefficient*T^exponent
+              with T in K. For "gigosos_hydrogen": "w", "exponent" of the
+              Lorentzian width w*(ne/1e23)^exponent (nm) without Te. """
+
+    def __init__(self, element, charge, wl, tolerance, model, source="",
+                 params=None):
+        if model not in models:
+            raise ValueError("Unknown Stark broadening model " + str(model) +
+                             ", known: " + ", ".join(models))
+        self.element = element.strip().title()
+        self.charge = int(charge)
+        self.wl = float(wl)
+        self.tolerance = float(tolerance)
+        self.model = model
+        self.source = source
+        self.params = dict(params) if params else {}
+
+    def __repr__(self):
+        return "stark_line(" + self.element + " " + str(self.charge) + "+, " + \
+            str(self.wl) + " nm, " + self.model + ")"
+
+    @property
+    def tabulated(self):
+        """ True if the profiles are tabulated (no analytic width). """
+        return self.model.startswith("gigosos")
+
+    def matches(self, element, charge, wl):
+        return element == self.element and charge == self.charge and \
+            abs(wl - self.wl) <= self.tolerance
+
+    def to_dict(self):
+        return {"element": self.element, "charge": self.charge, "wl": self.wl,
+                "tolerance": self.tolerance, "model": self.model,
+                "source": self.source, "params": self.params}
+
+    @staticmethod
+    def from_dict(data):
+        return stark_line(data["element"], data.get("charge", 0), data["wl"],
+                          data["tolerance"], data["model"], data.get("source", ""),
+                          data.get("params"))
+
+
+def _bins(line):
+    return range(int(line.wl - line.tolerance), int(line.wl + line.tolerance) + 1)
+
+
+def _add(line):
+    for b in _bins(line):
+        _index.setdefault((line.element, line.charge, b), []).append(line)
+
+
+def _load_default():
+    if not _loaded:
+        try:
+            with open(lines_file, "r", encoding="utf-8") as f:
+                for data in json.load(f):
+                    _add(stark_line.from_dict(data))
+        except (OSError, ValueError, KeyError):
+            print("WARNING: could not read the Stark broadening line registry")
+        _loaded.append(lines_file)
+
+
+def register(line):
+    """ Add the stark_line <line>. It takes precedence over the lines
+    registered before if the wavelength windows overlap. """
+    with _lock:
+        _load_default()
+        _add(line)
+
+
+def load_lines(filename):
+    """ Register all lines of the json file <filename>, a list of
+    dictionaries with the keys of stark_line (see data/stark_lines.json).
+    Returns the number of lines. """
+    with open(filename, "r", encoding="utf-8") as f:
+        new = [stark_line.from_dict(data) for data in json.load(f)]
+    with _lock:
+        _load_default()
+        for line in new:
+            _add(line)
+    return len(new)
+
+
+def lookup(element, charge, wl):
+    """ The stark_line of the transition of <element> (symbol), with the
+    ion <charge> (0 for neutral atoms) at <wl> (nm). The closest line if
+    several match, the last registered one if they are equally close. None
+    if the line is not supported. """
+    if not _loaded:
+        with _lock:
+            _load_default()
+    element = element.strip().title()
+    found, distance = None, None
+    for line in _index.get((element, charge, int(wl)), ()):
+        if line.matches(element, charge, wl) and \
+            (distance is None or abs(wl - line.wl) <= distance):
+            found, distance = line, abs(wl - line.wl)
+    return found
+
+
+def find(transition):
+    """ The stark_line of an owlspec transition, None if not supported. """
+    if transition is None or transition.wl is None:
+        return None
+    emitter = transition.emitter
+    return lookup(emitter.symbol, emitter.charge - 1, transition.wl)
+
+
+def lines():
+    """ List of all registered lines. """
+    if not _loaded:
+        with _lock:
+            _load_default()
+    unique = {}
+    for bucket in _index.values():
+        for line in bucket:
+            unique[id(line)] = line
+    return list(unique.values())
@@ -1,103 +1,160 @@
 #!/usr/bin/python
 
 import numpy as np
-from ..util import interpol, lorentz_function
+from ..util import interpol, lorentz_function, lorentz_width_derivative
 from .gigosos_loader import gigosos_loader
 from .gigosos_he_loader import gigosos_he_loader
 from .griem import griem
+from . import registry
+from ..grid import grid
+
+# model of the registry: loader of the tabulated profiles
+loaders = {"gigosos_hydrogen": gigosos_loader, "gigosos_helium": gigosos_he_loader}
 
 class stark():
-    def __init__(self, transition, ion_pert = None):
+    def __init__(self, transition, ion_pert = None, line = None):
+        """ <line>: The registry.stark_line of the transition, looked up 
+        if None. """
         self.transition = transition
         self.fast = False
         self.pert = ion_pert
+        self.line = line if line is not None else registry.find(transition)
+        self.griem = None
+        if self.line is not None and self.line.model == "griem":
+            self.griem = griem(transition, self.line)
 
     def supported(self):
-        wl = self.transition.wl
-        x = np.linspace(wl-10, wl+10, 10000)
-        ne = 2e21
-        profile = None
-        try:
-            profile = self.get_profile(x, ne, Te=30000, pert=None)
-        except:
-            return False
-        if profile is not None:
-            return True
-        else:
-            return False
+        """ True if Stark broadening data is registered for this line. """
+        return self.line is not None
 
     def get_profile(self,x, ne, Te=None, pert=None):
-        middle_wl = x[int(len(x)/2)]
-        ele = self.transition.emitter.symbol
-
-        ################ Hydrogen ########
-        if ele == "H":
-            if round(self.transition.wl,0) == 656:
-                # Gigosos et al, Spectrochimica Acta Part B 58 (2003) 1489–1504
-                if self.fast or not Te:
-                    w = ((ne/1e23)**(0.67965)) * 1.098
-                    return lorentz_function(x,middle_wl,w)
-                else:
-                    this_loader = gigosos_loader(self.transition)
-                    gigosos_x,y = this_loader.load(ne, Te, pert)
-                    gigosos_x = gigosos_x + middle_wl # to nm
-                    y = interpol(gigosos_x,y,x)
-                    return y
-
-            if round(self.transition.wl, 0) == 486:
-                # Gigosos et al, Spectrochimica Acta Part B 58 (2003) 1489–1504
-                if self.fast or not Te:
-                    w = ((ne/1e23)**(0.68116)) * 4.8
-                    return lorentz_function(x,middle_wl,w)
-                else:
-                    this_loader = gigosos_loader(self.transition)
-                    gigosos_x,y = this_loader.load(ne, Te, pert)
-                    gigosos_x = gigosos_x + middle_wl # to nm
-                    y = interpol(gigosos_x,y,x)
-                    return y
-
-        ################ Helium ##########
-        if ele == "He":
-            if round(self.transition.wl,0) == 447:
-                # Gigosos et al, A&A 503, 293–299 (2009)
-                # doi: 10.1051/0004-6361/200912243
-                this_loader = gigosos_he_loader(self.transition)
-                gigosos_x,y = this_loader.load(ne, Te, pert)
-                gigosos_x = gigosos_x + middle_wl # to nm
-                y = interpol(gigosos_x,y,x)
-                return y
-
-            if round(self.transition.wl, 0) == 492:
-                # Lara et al, A&A 542, A75 (2012)
-                # doi: 10.1051/0004-6361/201219123
-                this_loader = gigosos_he_loader(self.transition)
-                gigosos_x,y = this_loader.load(ne, Te, pert)
-                gigosos_x = gigosos_x + middle_wl # to nm
-                y = interpol(gigosos_x,y,x)
-                return y
-
-        ################ Others: Griem ##########
-        if ele == "O" or ele == "Ar":
-            this_griem = griem(self.transition)
-            w,d = this_griem.get_width_shift(ne, Te)
-            # shift is ignored for now
-            if w>0:
-                return lorentz_function(x,middle_wl,w)
+        """ Stark profile on <x>, wavelength array or owlspec.grid.grid,
+        centered on the middle of the axis. None for unsupported lines. """
+        if isinstance(x, grid):
+            middle_wl, x = x.middle, x.x
+        else:
+            middle_wl = x[int((len(x)-1)/2)] # center of fftconvolve(mode='same')
+
+        loader = self.table_loader(Te)
+        if loader is not None:
+            profiles = loader.get_profiles(np.asarray(x) - middle_wl, ne, Te, pert)
+            if profiles is not None: # from the converted tables
+                return profiles[0]
+            gigosos_x,y = loader.load(ne, Te, pert)
+            gigosos_x = gigosos_x + middle_wl # to nm
+            return interpol(gigosos_x,y,x)
 
+        # Lorentzian: Griem, or hydrogen without Te (or fast)
+        # the shift is ignored for now
+        w = self.get_width(ne, Te, pert)
+        if w is not None:
+            return lorentz_function(x,middle_wl,w)
+
+
+    def table_loader(self, Te=None):
+        """ Loader of the tabulated profiles (Gigosos) of this line, None if
+        the profile is not tabulated. """
+        if self.line is None or self.line.model not in loaders:
+            return None
+        if self.line.model == "gigosos_hydrogen" and (self.fast or not np.all(Te)):
+            return None # Lorentzian fit, see get_width
+        return loaders[self.line.model](self.transition)
+
+    def get_profiles(self, x, ne, Te, pert=None, T_pert=None):
+        """ Tabulated Stark profiles for arrays of <ne> and <Te> on <x>, 
+        wavelength array or owlspec.grid.grid, centered on the middle of 
+        the axis. One row per value, all interpolated in one step between
+        the table values. <T_pert>: Optional perturber temperatures, see
+        gigosos_loader.get_profiles. None if the line has no tabulated 
+        profiles or the tables are not converted. """
+        if isinstance(x, grid):
+            middle_wl, x = x.middle, x.x
+        else:
+            middle_wl = x[int((len(x)-1)/2)]
+        loader = self.table_loader(Te)
+        if loader is None:
+            return None
+        return loader.get_profiles(np.asarray(x) - middle_wl, ne, Te, pert, T_pert)
 
+    def get_characteristics(self, ne, Te, pert=None, T_pert=None, doppler=0,
+                            instrument=None):
+        """ FWHM, shift (nm) and asymmetry of the tabulated profiles for
+        <ne> and <Te> (numbers or arrays), optionally convolved with a
+        Doppler profile (Gaussian FWHM <doppler> in nm) and a psd_voigt
+        <instrument> = (w, mu). <T_pert>: see get_profiles. Result dict 
+        of arrays ("fwhm", "shift", "asymmetry"), interpolated from
+        precalculated tables. None if the line has no tabulated profiles
+        or the tables are not converted. """
+        loader = self.table_loader(Te)
+        if loader is None:
+            return None
+        return loader.characteristics(ne, Te, pert, T_pert, doppler, instrument)
+
+    def ne_from_width(self, width, Te, pert=None, T_pert=None, doppler=0,
+                      instrument=None):
+        """ Electron density (m^-3) from the measured FWHM <width> (nm) of
+        the line, the inverse of get_characteristics() (same parameters).
+        <width> and <Te> can be arrays, e.g. a time series. NaN for widths
+        outside of the tables. None if the line has no tabulated profiles
+        or the tables are not converted. """
+        loader = self.table_loader(Te)
+        if loader is None:
+            return None
+        return loader.ne_from_width(width, Te, pert, T_pert, doppler, instrument)
 
     def get_width(self, ne, Te=None, pert=None):
-        ele = self.transition.element
-        if ele == "O" or ele == "Ar":
-            this_griem = griem(self.transition)
-            w,d = this_griem.get_width_shift(ne, Te)
-            return w
+        """ FWHM of the Stark profile in nm if the profile is a Lorentzian.
+        None for tabulated profiles (Gigosos) and unsupported lines. 
+        <ne> and <Te> can be arrays. """
+        line = self.line
+        if line is None:
+            return None
+        if line.model == "gigosos_hydrogen" and (self.fast or Te is None or not np.all(Te)):
+            # fit of the tabulated widths
+            return ((ne/1e23)**(line.params["exponent"])) * line.params["w"]
+        if self.griem is not None:
+            w,d = self.griem.get_width_shift(ne, Te)
+            if np.all(w > 0):
+                return w
+        return None
 
-    def get_shift(self, ne, Te=None, pert=None):
-        ele = self.transition.element
-        if ele == "O" or ele == "Ar" :
-            this_griem = griem(self.transition)
-            w,d = this_griem.get_width_shift(ne, Te)
-            return d
+    def get_width_derivatives(self, ne, Te=None, pert=None):
+        """ Derivatives of get_width() with respect to <ne> and <Te>, from
+        the power laws of the width fits. None if get_width() is None. """
+        w = self.get_width(ne, Te, pert)
+        if w is None:
+            return None
+        line = self.line
+        if line.model == "gigosos_hydrogen" and (self.fast or Te is None or not np.all(Te)):
+            # w ~ ne^exponent, independent of Te
+            return line.params["exponent"]*w/ne, 0*w
+        return self.griem.width_derivatives(ne, Te)
 
+    def get_profile_derivatives(self, x, ne, Te=None, pert=None):
+        """ Derivatives of get_profile() with respect to <ne>, <Te> and the
+        temperature of the perturbers, on the same axis. None for 
+        unsupported lines. """
+        if isinstance(x, grid):
+            middle_wl, x = x.middle, x.x
+        else:
+            middle_wl = x[int((len(x)-1)/2)]
+        loader = self.table_loader(Te)
+        if loader is not None:
+            result = loader.get_profiles(np.asarray(x) - middle_wl, ne, Te, pert, 
+                                         derivatives=True)
+            if result is not None: # from the converted tables
+                return tuple(dy[0] for dy in result[1:])
+            gigosos_x,_,*dy = loader.load(ne, Te, pert, derivatives=True)
+            gigosos_x = gigosos_x + middle_wl # to nm
+            return tuple(interpol(gigosos_x,d,x) for d in dy)
 
+        dw = self.get_width_derivatives(ne, Te, pert)
+        if dw is None:
+            return None
+        dy_dw = lorentz_width_derivative(x, middle_wl, self.get_width(ne, Te, pert))
+        return dy_dw*dw[0], dy_dw*dw[1], 0*dy_dw
+
+    def get_shift(self, ne, Te=None, pert=None):
+        if self.griem is not None:
+            w,d = self.griem.get_width_shift(ne, Te)
+            return d
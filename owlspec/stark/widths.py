@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+""" Characteristic widths of the tabulated Stark profiles (Gigosos) and the
+inverse, the electron density of a measured line width.
+
+The FWHM, the shift and the asymmetry of the profiles are calculated once
+per line, for all table values of mu and rho (or T) and for the table
+densities refined by ne_steps, from the same interpolation between the 
+tables as the profiles themselves. They are saved next to the converted 
+tables (see gigosos_loader.profile_store and gigosos_he_loader.table_store). Tables of
+the profiles convolved with a Doppler (Gaussian) and an instrumental
+(psd_voigt) profile are calculated when they are first requested (which
+takes seconds) and saved next to them, one file per combination of the 
+convolution widths, rounded to convolution_digits. Looking up a width or a
+density only interpolates these tables, no profile is calculated. """
+
+import os
+import glob
+import numpy as np
+from ..memo import lru, quantize
+from ..util import gauss_transform, lorentz_transform
+from .interpolator import table_interpolator
+
+__all__ = ["width_table", "characteristics"]
+
+# Increase if the saved width tables change.
+width_version = 1
+
+# Width tables in memory, keyed by their file.
+_tables = lru(8)
+
+# The widths are calculated at <ne_steps> densities per interval of the
+# table densities, from the interpolated profiles.
+ne_steps = 8
+
+# Points per FWHM of the narrowest profile on the axis the widths are
+# measured on (and convolved), and the maximum number of points.
+convolution_points = 50
+max_convolution_points = 2**16
+
+# Maximum number of profile points that are calculated at once.
+max_batch_points = 2**21
+
+# The Doppler and instrumental widths (and mu) of the convolved tables are
+# rounded to <convolution_digits> significant digits, so that close
+# temperatures share one saved table.
+convolution_digits = 4
+
+
+def characteristics(x, y):
+    """ FWHM, shift and asymmetry of the profiles <y> (one per row) on the
+    ascending axis <x>. The FWHM is the distance between the outermost 
+    points at half maximum, the shift is their center and the asymmetry is
+    the difference of their distances from the maximum (red - blue) 
+    relative to the FWHM. NaN for profiles that do not fall below half 
+    maximum within x. """
+    x, y = np.asarray(x, dtype=float), np.atleast_2d(np.asarray(y, dtype=float))
+    rows = np.arange(len(y))
+    peak = np.argmax(y, axis=1)
+    half = y[rows, peak]/2
+    above = y >= half[:, None]
+    first = np.argmax(above, axis=1)
+    last = y.shape[1]-1 - np.argmax(above[:, ::-1], axis=1)
+    valid = (first > 0) & (last < y.shape[1]-1) & (half > 0)
+    first, last = np.clip(first, 1, None), np.clip(last, None, y.shape[1]-2)
+    crossing = lambda a, b: x[a] + (half-y[rows, a])*(x[b]-x[a])/(y[rows, b]-y[rows, a])
+    left, right = crossing(first-1, first), crossing(last, last+1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # maximum of the parabola through the highest point and its neighbours
+        p = np.clip(peak, 1, y.shape[1]-2)
+        a, b, c = y[rows, p-1], y[rows, p], y[rows, p+1]
+        center = x[p] + np.nan_to_num(0.5*(a-c)/(a-2*b+c)) * (x[p+1]-x[p-1])/2
+        fwhm = right - left
+        result = (fwhm, (left+right)/2, ((right-center) - (center-left))/fwhm)
+    return tuple(np.where(valid, v, np.nan) for v in result)
+
+
+def convolve(x, y, doppler=0, instrument=None):
+    """ The profiles <y> (one per row) on the uniform axis <x> (nm) 
+    convolved with a Gaussian with the FWHM <doppler> (nm) and a psd_voigt
+    function with <instrument> = (w, mu). """
+    w, mu = instrument if instrument else (0, 0)
+    n = len(x)
+    # zero padded to the double length, the kernels are centered on 0 and
+    # their wings on the left wrap around into the padding
+    f = np.fft.rfftfreq(2*n, x[1]-x[0])
+    spectrum = np.fft.rfft(y, 2*n)
+    if doppler > 0:
+        spectrum *= gauss_transform(f, doppler)
+    if w > 0:
+        spectrum *= mu*lorentz_transform(f, w) + (1-mu)*gauss_transform(f, w)
+    return np.fft.irfft(spectrum, 2*n)[..., :n]
+
+
+class width_table():
+    """ FWHM, shift and asymmetry (nm) of the profiles of a Stark table,
+    arrays of shape (ne, mu, p) over the densities <ne> and the table 
+    values <mu> and <p> (rho for hydrogen, the temperature for helium).
+    Profiles that are not tabulated are filled in by linear interpolation along p and then mu
+    (the edge values outside of the tabulated range). """
+
+    def __init__(self, ne, mu, p, fwhm, shift, asymmetry):
+        self.ne, self.mu, self.p = ne, mu, p
+        self.fwhm, self.shift, self.asymmetry = fwhm, shift, asymmetry
+
+    @staticmethod
+    def compute(ne, mu, p, profiles, extent, tabulated=None, doppler=0,
+                instrument=None):
+        """ Width table of the interpolated profiles of a table store, on
+        the table densities refined by <ne_steps>. 
+        <profiles>: Function (x, ne, mu, p) that returns the interpolated 
+                    profiles (rows) on the axis x (nm relative to the line 
+                    center), see table_interpolator.
+        <extent>: Largest distance (nm) from the line center tabulated at
+                  each table density.
+        <tabulated>: Optional boolean array (ne, mu, p) of the existing
+                     profiles, all by default.
+        <doppler>, <instrument>: see convolve(). """
+        ne, mu, p = [np.asarray(v, dtype=float) for v in (ne, mu, p)]
+        if tabulated is None:
+            tabulated = np.ones((len(ne), len(mu), len(p)), dtype=bool)
+        steps = np.arange((len(ne)-1)*ne_steps + 1)/ne_steps
+        fine_ne = np.exp(np.interp(steps, np.arange(len(ne)), np.log(ne)))
+        fine_ne[::ne_steps] = ne
+        w, _ = instrument if instrument else (0, 0)
+        reach = 3*(doppler + w)
+        values = np.full((3, len(fine_ne), len(mu), len(p)), np.nan)
+        for f, step in enumerate(steps):
+            cell = sorted({int(np.floor(step)), int(np.ceil(step))})
+            known = np.all(tabulated[cell], axis=0).ravel()
+            if not np.any(known):
+                continue
+            M, P = [v.ravel()[known] for v in np.meshgrid(mu, p, indexing="ij")]
+            # estimated on the whole table, then sampled with 
+            # <convolution_points> per FWHM of the narrowest profile, up to
+            # a few FWHM of the widest profile from the center
+            x = np.linspace(-1, 1, 2001) * (np.max(extent[cell]) + reach)
+            fwhm = characteristics(x, profiles(x, fine_ne[f], M, P))[0]
+            if np.any(fwhm > 0):
+                half = min(x[-1], 4*np.nanmax(fwhm) + reach)
+                n = 2*half/np.nanmin(fwhm[fwhm > 0])*convolution_points + 1
+                n = min(max(n, 2001), max_convolution_points)
+                x = np.linspace(-half, half, 2*int(n/2) + 1) # odd, with the center
+            result = np.full((3, len(mu)*len(p)), np.nan)
+            rows = np.flatnonzero(known)
+            batch = max(1, max_batch_points//len(x))
+            for start in range(0, len(rows), batch):
+                part = slice(start, start + batch)
+                y = profiles(x, fine_ne[f], M[part], P[part])
+                if doppler > 0 or instrument:
+                    y = convolve(x, y, doppler, instrument)
+                result[:, rows[part]] = characteristics(x, y)
+            values[:, f] = result.reshape(3, len(mu), len(p))
+        for i, j in np.ndindex(values.shape[1:3]):
+            known = np.isfinite(values[0, i, j])
+            if np.any(known) and not np.all(known):
+                for v in values:
+                    v[i, j] = np.interp(p, p[known], v[i, j, known])
+        for i, k in np.ndindex(values.shape[1:4:2]): # then along mu
+            known = np.isfinite(values[0, i, :, k])
+            if np.any(known) and not np.all(known):
+                for v in values:
+                    v[i, :, k] = np.interp(mu, mu[known], v[i, known, k])
+        return width_table(fine_ne, mu, p, *values)
+
+    @staticmethod
+    def load(filename):
+        """ Width table saved by save(). Raises ValueError if it is 
+        outdated. """
+        with np.load(filename) as data:
+            if int(data["version"]) != width_version:
+                raise ValueError("outdated width table " + filename)
+            return width_table(data["ne"], data["mu"], data["p"], data["fwhm"],
+                               data["shift"], data["asymmetry"])
+
+    def save(self, filename):
+        """ Save the table to <filename> (.npz), False if not possible. """
+        try:
+            with open(filename + ".tmp", "wb") as f:
+                np.savez(f, version=width_version, ne=self.ne, mu=self.mu, p=self.p,
+                         fwhm=self.fwhm, shift=self.shift, asymmetry=self.asymmetry)
+            os.replace(filename + ".tmp", filename)
+        except OSError:
+            print("WARNING: could not save Stark width table " + filename)
+            return False
+        return True
+
+    @staticmethod
+    def open(filename, compute, doppler=0, instrument=None):
+        """ Width table for the <doppler> and <instrument> widths, from 
+        compute(doppler, instrument). The unconvolved table is read from
+        <filename>, or calculated and saved there, convolved tables are 
+        read from or saved to convolved_filename(). All tables are kept in
+        memory. """
+        w, mu = instrument if instrument else (0, 0)
+        doppler, w, mu = quantize(float(doppler), float(w), float(mu),
+                                  digits=convolution_digits)
+        instrument = (w, mu) if w > 0 else None
+        name = filename
+        if doppler > 0 or instrument:
+            name = width_table.convolved_filename(filename, doppler, instrument)
+        def table():
+            try:
+                return width_table.load(name)
+            except (OSError, KeyError, ValueError):
+                table = compute(doppler, instrument)
+                table.save(name)
+                return table
+        return _tables.get(name, table)
+
+    @staticmethod
+    def convolved_filename(filename, doppler=0, instrument=None):
+        """ File of the table for the <doppler> and <instrument> widths,
+        next to the unconvolved table <filename>. """
+        w, mu = instrument if instrument else (0, 0)
+        return filename[:-len(".npz")] + "_d{:g}_w{:g}_mu{:g}.npz".format(doppler, w, mu)
+
+    @staticmethod
+    def clear(filename=None):
+        """ Drop all width tables from memory, e.g. after a conversion, and
+        delete the saved convolved tables of the unconvolved table 
+        <filename>. """
+        _tables.clear(stats=False)
+        if filename is not None:
+            for name in glob.glob(glob.escape(filename[:-len(".npz")]) + "_d*_w*_mu*.npz"):
+                try:
+                    os.remove(name)
+                except OSError:
+                    pass
+
+    def curves(self, mu, p, values=("fwhm", "shift", "asymmetry")):
+        """ The <values> at the densities of the table, arrays of shape 
+        (N, ne), for <mu> (N values) and <p> (N values or (N, ne), if p 
+        depends on the density). Bilinear interpolation in mu and p, both
+        are limited to the table. """
+        mu = np.asarray(mu, dtype=float)[:, None]
+        p = np.broadcast_to(np.asarray(p, dtype=float).reshape(len(mu), -1),
+                            (len(mu), len(self.ne)))
+        j0, j1, s, _ = table_interpolator.cell(self.mu, mu)
+        k0, k1, t, _ = table_interpolator.cell(self.p, p)
+        i = np.arange(len(self.ne))
+        result = []
+        for name in values:
+            table = getattr(self, name)
+            result.append((1-s)*((1-t)*table[i, j0, k0] + t*table[i, j0, k1]) +
+                          s*((1-t)*table[i, j1, k0] + t*table[i, j1, k1]))
+        return result
+
+    def at(self, ne, mu, p):
+        """ FWHM, shift and asymmetry for the densities <ne> (N values),
+        see curves(). The FWHM is interpolated linearly in log(ne) and
+        log(FWHM), shift and asymmetry linearly in log(ne). NaN outside of
+        the table. """
+        ne = np.asarray(ne, dtype=float)
+        fwhm, shift, asymmetry = self.curves(mu, p)
+        log_ne = np.log(self.ne)
+        high = np.clip(np.searchsorted(log_ne, np.log(ne)), 1, len(log_ne)-1)
+        low = high - 1
+        t = (np.log(ne) - log_ne[low])/(log_ne[high] - log_ne[low])
+        t = np.where((ne >= self.ne[0]) & (ne <= self.ne[-1]), t, np.nan)
+        rows = np.arange(len(ne))
+        mix = lambda v: (1-t)*v[rows, low] + t*v[rows, high]
+        return np.exp(mix(np.log(fwhm))), mix(shift), mix(asymmetry)
+
+    def invert(self, width, mu, p):
+        """ Electron densities (N values) at which the FWHM is <width> (nm,
+        N values), see curves(). Interpolated linearly in log(ne) and
+        log(FWHM) between the table densities. NaN if the width is outside
+        of the table. """
+        width = np.asarray(width, dtype=float)
+        log_w = np.log(self.curves(mu, p, ("fwhm",))[0])
+        log_ne = np.log(self.ne)
+        # the width grows with the density, first table density above it
+        # (NaN at densities without tables, below and above the tables)
+        finite = np.isfinite(log_w)
+        below = np.cumsum(finite, axis=1) == 0
+        log_w = np.where(finite, log_w, np.where(below, -np.inf, np.inf))
+        high = np.sum(log_w < np.log(width)[:, None], axis=1)
+        rows = np.arange(len(width))
+        inside = (high > 0) & (high < len(log_ne))
+        high = np.clip(high, 1, len(log_ne)-1)
+        low = high - 1
+        inside &= finite[rows, low] & finite[rows, high]
+        t = (np.log(width) - log_w[rows, low])/(log_w[rows, high] - log_w[rows, low])
+        ne = np.exp(log_ne[low] + t*(log_ne[high] - log_ne[low]))
+        return np.where(inside, ne, np.nan)
@@ -0,0 +1,93 @@
+#!/bin/python3
+""" Fast synthesis of line spectra from many pseudo Voigt lines.
+
+Each line is only evaluated within a few widths of its center (found with
+searchsorted on the sorted wavelength axis) and the lines are added into
+one buffer in vectorized batches of neighbouring lines. Gaussian lines are
+always cut where they are negligible, lines with Lorentzian wings only 
+with a cutoff. """
+
+import numpy as np
+from .util import psd_voigt_function
+
+__all__ = ["render_lines"]
+
+gauss_cutoff = 5 # a Gaussian is < 1e-30 of its maximum at 5 FWHM
+
+
+def render_lines(x, centers, intensities, width, mu=0.0, cutoff=50,
+                 out=None, batch_size=2**20):
+    """ Return the sum of pseudo Voigt lines on the wavelength axis <x>.
+
+    <centers>: Line positions in nm.
+    <intensities>: Line intensities (= line areas).
+    <width>: FWHM in nm, scalar or one value per line.
+    <mu>: Shape parameter (0 = Gauss, 1 = Lorentz), scalar or per line.
+    <cutoff>: Lines are evaluated within +- cutoff*width of their center.
+              Pure Gaussians (mu = 0) are cut at 5 widths at most, where
+              they are < 1e-30 of their maximum. The Lorentzian wings 
+              beyond the cutoff are lost, which is ~mu/(pi*cutoff) of the
+              line area. None evaluates the lines with mu > 0 on the 
+              complete axis (exact, as used by spectrum by default).
+    <out>: Optional array of len(x) the spectrum is added to.
+    <batch_size>: Maximum number of points evaluated at once.
+    """
+    x = np.asarray(x, dtype=float)
+    centers = np.atleast_1d(np.asarray(centers, dtype=float))
+    intensities = np.broadcast_to(np.asarray(intensities, dtype=float), centers.shape)
+    width = np.broadcast_to(np.asarray(width, dtype=float), centers.shape)
+    mu = np.broadcast_to(np.asarray(mu, dtype=float), centers.shape)
+    if out is None:
+        out = np.zeros(len(x))
+    if len(centers) == 0 or len(x) == 0:
+        return out
+
+    # work on an ascending axis, the result is mapped back to the order of x
+    order = None
+    if len(x) > 1 and np.any(np.diff(x) < 0):
+        order = np.argsort(x, kind="stable")
+        x = x[order]
+        buffer = np.zeros(len(x))
+    else:
+        buffer = out
+
+    if cutoff is None:
+        # lines with Lorentzian wings cover the complete axis, one line at a
+        # time keeps the temporary arrays small. Gaussians are cut below.
+        wings = mu > 0
+        for args in zip(centers[wings], width[wings], mu[wings], intensities[wings]):
+            buffer += args[3]*psd_voigt_function(x, *args[:3])
+        centers, intensities = centers[~wings], intensities[~wings]
+        width, mu = width[~wings], mu[~wings]
+        cutoff = gauss_cutoff
+
+    half = np.where(mu > 0, cutoff, min(cutoff, gauss_cutoff)) * width
+    lo = np.searchsorted(x, centers - half, side="left")
+    hi = np.searchsorted(x, centers + half, side="right")
+
+    keep = hi > lo
+    # neighbouring lines in the same batch, so that each batch only covers
+    # a short section of the axis
+    sort = np.argsort(lo[keep], kind="stable")
+    centers, intensities = centers[keep][sort], intensities[keep][sort]
+    width, mu = width[keep][sort], mu[keep][sort]
+    lo, hi = lo[keep][sort], hi[keep][sort]
+
+    lines_per_batch = max(1, batch_size // int(np.max(hi - lo, initial=1)))
+    for start in range(0, len(centers), lines_per_batch):
+        batch = slice(start, start + lines_per_batch)
+        length = np.max(hi[batch] - lo[batch])
+        first, last = lo[batch][0], np.max(hi[batch])
+        idx = lo[batch, None] + np.arange(length)[None, :]
+        inside = idx < hi[batch, None]
+        idx = np.minimum(idx, last-1)
+        values = intensities[batch, None] * psd_voigt_function(
+            x[idx], centers[batch, None], width[batch, None], mu[batch, None])
+        values[~inside] = 0
+        # added into the section of the buffer the batch covers
+        buffer[first:last] += np.bincount((idx - first).ravel(), values.ravel(),
+                                          minlength=last-first)
+
+    if order is not None:
+        out[order] += buffer
+    return out
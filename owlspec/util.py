@@ -1,18 +1,15 @@
 #!/bin/python3
 import numpy as np
-from scipy.signal import fftconvolve as convolve
-from scipy import constants as const
-from scipy import interpolate
-from scipy.signal import filtfilt
 from numpy import fft
-import roman
+# scipy and roman are imported in the functions for startup performance,
+# importing owlspec.util must only need numpy.
 
 __all__ = [
     "interpol",
     "doppler_maxwell",
     "gauss_function","gauss",
     "m_j",
-    "zeeman",
+    "zeeman", "zeeman_components",
     "get_spectroscopic_name",
     "parse_spectroscopic_name",
     "running_mean",
@@ -20,15 +17,20 @@ __all__ = [
     "fft_clean",
     "lorentz_function","lorentz",
     "psd_voigt_function","psd_voigt",
+    "voigt_function","voigt",
+    "gauss_transform", "lorentz_transform",
+    "voigt_derivatives", "psd_voigt_derivatives", "lorentz_width_derivative",
     "fft_smooth",
     "deconv", "deconvolution"
     ]
 
 def interpol(new_x, y, old_x):
+    from scipy import interpolate
     f = interpolate.interp1d(new_x, y, fill_value=0.0, bounds_error=False)
     return f(old_x)
 
 def doppler_maxwell(x, xc, T, m):
+    from scipy import constants as const
     w = xc/const.c * np.sqrt(8 * const.k * T * np.log(2) / m)
     return gauss_function(x, xc, w)
 
@@ -44,9 +46,19 @@ def m_j(j):
         return np.append(-np.arange(j+0.5)[::-1][:-1],np.arange(j+1.5))-0.5
 
 def zeeman(x, cwl, B, upperJ, lowerJ, upperG, lowerG, side=False):
-    bm =  const.physical_constants['Bohr magneton'][0]
-    z_peaks = []
+    wls, intensities = zeeman_components(cwl, B, upperJ, lowerJ, upperG, lowerG, side)
     y = np.zeros(len(x))
+    for wl, intensity in zip(wls, intensities):
+        index = np.argmin(np.abs(x-wl)) # index of line component
+        y[index] = y[index] + intensity # in case two transitions hit the same pixel
+    return y
+
+def zeeman_components(cwl, B, upperJ, lowerJ, upperG, lowerG, side=False):
+    """ Wavelengths and relative intensities of the Zeeman components of
+    the line at <cwl>, as used by zeeman(). """
+    from scipy import constants as const
+    bm =  const.physical_constants['Bohr magneton'][0]
+    wls, intensities = [], []
     J_u = upperJ
     J_l = lowerJ
     counter = 0 # for intensity scaling
@@ -86,17 +98,18 @@ def zeeman(x, cwl, B, upperJ, lowerJ, upperG, lowerG, side=False):
                         intensity = 0.25 * (J_u + mu) * (J_u + mu - 1)
                     if mu == (ml - 1): # M -> M + 1
                         intensity = 0.25 * (J_u - mu) * (J_u - mu - 1)
-                index = np.argmin(np.abs(x-wl)) # index of line component
-                y[index] = y[index] + intensity # in case two transitions hit the same pixel
-    y = y/counter
-    return y
+                wls.append(wl)
+                intensities.append(intensity)
+    return np.array(wls), np.array(intensities)/counter
 
 def get_spectroscopic_name(element, charge):
+    import roman
     name = element.title() # ti -> Ti
     designation = roman.toRoman(round(charge+1))
     return name + " " + designation
 
 def parse_spectroscopic_name(name):
+    import roman
     name = name.strip()
     ele = name.split(' ')[0]
     num = name.split(' ')[-1]
@@ -117,6 +130,7 @@ def fft_clean(y, cutoff):
     return np.fft.irfft(Hn)
 
 def fft_smooth(y, smoothness):
+    from scipy.signal import filtfilt
     n = smoothness # the larger n is, the smoother curve will be
     b = [1.0 / n] * n
     a = 1.0
@@ -131,6 +145,50 @@ def psd_voigt_function(x, xc, w, mu):
         (1 - mu) * (np.sqrt(4*np.log(2)) / (np.sqrt(np.pi) * w)) *
         np.exp(-(4*np.log(2)/w**2)*(x-xc)**2) )) # pseudo voidt function copied from origin
 
+def voigt_function(x, xc, wg, wl):
+    """ Voigt profile (area 1) from the Faddeeva function.
+    wg and wl are the FWHM of the Gaussian and the Lorentzian part. """
+    from scipy.special import voigt_profile
+    return voigt_profile(x-xc, wg/np.sqrt(8*np.log(2)), wl/2)
+
+def gauss_transform(f, w):
+    "Fourier transform of a Gaussian with FWHM <w> and area 1"
+    return np.exp(-np.pi**2*w**2*f**2/(4*np.log(2)))
+
+def lorentz_transform(f, w):
+    "Fourier transform of a Lorentzian with FWHM <w> and area 1"
+    return np.exp(-np.pi*w*np.abs(f))
+
+def voigt_derivatives(x, xc, wg, wl):
+    """ Voigt profile (see voigt_function) and its derivatives with respect
+    to xc, wg and wl, from the derivative of the Faddeeva function. """
+    from scipy.special import wofz
+    if not wg:
+        return (lorentz_function(x, xc, wl), 
+                (2/np.pi)*8*wl*(x-xc)/(4*(x-xc)**2 + wl**2)**2,
+                np.zeros(np.shape(x)), lorentz_width_derivative(x, xc, wl))
+    sigma = wg/np.sqrt(8*np.log(2))
+    z = (x - xc + 0.5j*wl)/(sigma*np.sqrt(2))
+    W = wofz(z)
+    dW = -2*z*W + 2j/np.sqrt(np.pi) # dW/dz
+    norm = sigma*np.sqrt(2*np.pi)
+    V = W.real/norm
+    dV_dxc = -dW.real/(sigma*np.sqrt(2))/norm
+    dV_dsigma = (dW*(-z/sigma)).real/norm - V/sigma
+    dV_dgamma = -dW.imag/(sigma*np.sqrt(2))/norm
+    return V, dV_dxc, dV_dsigma/np.sqrt(8*np.log(2)), dV_dgamma/2
+
+def lorentz_width_derivative(x, xc, w):
+    "Derivative of lorentz_function with respect to the FWHM w"
+    return (2/np.pi)*(4*(x-xc)**2 - w**2)/(4*(x-xc)**2 + w**2)**2
+
+def psd_voigt_derivatives(x, xc, w, mu):
+    """ Derivatives of psd_voigt_function with respect to w and mu. """
+    g = gauss_function(x, xc, w)
+    dg_dw = g*(8*np.log(2)*(x-xc)**2/w**3 - 1/w)
+    l = lorentz_function(x, xc, w)
+    return mu*lorentz_width_derivative(x, xc, w) + (1-mu)*dg_dw, l - g
+
 def deconv(signal, instr, noise_level):
     """ Remove instrumental profile (or other profile) from measured signal.
     Wiener deconvolution found somewhere on the internet.
@@ -148,5 +206,6 @@ def deconv(signal, instr, noise_level):
 # alias
 lorentz = lorentz_function
 psd_voigt = psd_voigt_function
+voigt = voigt_function
 gauss = gauss_function
 deconvolution = deconv
@@ -3,6 +3,7 @@
 import numpy as np
 from ..util import *
 from scipy import constants as const
+from ..grid import grid
 
 class vdW():
     def __init__(self, transition, pert):
@@ -26,7 +27,12 @@ class vdW():
 
 
     def get_profile(self,x, n, T):
-        middle_wl = x[int(len(x)/2)] - 0.5*abs((x[-1]-x[0])/(len(x)-1))
+        """ van der Waals profile on <x>, wavelength array or
+        owlspec.grid.grid, centered on the middle of the axis. """
+        if isinstance(x, grid):
+            middle_wl, x = x.middle, x.x
+        else:
+            middle_wl = x[int((len(x)-1)/2)] # center of fftconvolve(mode='same')
         if not T:
             print("""Need to provide a gas temperture (in Kelvin).
             Assuming 300 K""")
@@ -37,7 +43,29 @@ class vdW():
         w = self.get_width(self.transition, n, T)
         y = lorentz_function(x,middle_wl,w)
 
-        return y/max(y)
+        return y/np.max(y)
+
+
+    def get_profile_derivatives(self, x, n, T):
+        """ Derivatives of get_profile() with respect to the perturber 
+        density <n> and temperature <T>. All widths are proportional to
+        n*T^0.3. """
+        if isinstance(x, grid):
+            middle_wl, x = x.middle, x.x
+        else:
+            middle_wl = x[int((len(x)-1)/2)]
+        if not T:
+            T = 300
+
+        if self.transition.emitter.symbol == "H":
+            _,dy_dlnw = self.hydrogen_profile(x,T,n,derivative=True)
+        else:
+            w = self.get_width(self.transition, n, T)
+            y = lorentz_function(x,middle_wl,w)
+            dy_dlnw = w*lorentz_width_derivative(x,middle_wl,w)
+            i = np.argmax(y)
+            dy_dlnw = dy_dlnw/y[i] - y*dy_dlnw[i]/y[i]**2 # of y/max(y)
+        return dy_dlnw/n, 0.3*dy_dlnw/T
 
 
     def get_width(self, transition, n, T):
@@ -91,9 +119,11 @@ class vdW():
         return w*1e7 # to nm
 
 
-    def hydrogen_profile(self,x,T,n):
-        """ Data from NIST: J. Phys. Chem. Ref. Data, Vol. 38, No. 3, 2009"""
-        middle_wl = x[int(len(x)/2)] - 0.5*abs((x[-1]-x[0])/(len(x)-1))
+    def hydrogen_profile(self,x,T,n,derivative=False):
+        """ Data from NIST: J. Phys. Chem. Ref. Data, Vol. 38, No. 3, 2009
+        If <derivative>, also returns the derivative with respect to the
+        logarithm of the widths (which all scale alike). """
+        middle_wl = x[int((len(x)-1)/2)] # center of fftconvolve(mode='same')
         xc = self.transition.wl
         m1 = self.transition.particle.m/const.u
         m2 = self.pert.m/const.u
@@ -115,11 +145,14 @@ class vdW():
             [1.0775e-01*4, 656.2868, 12.087507, 10.19885, 2, 1]]
 
             y = np.zeros(len(x))
+            dy = np.zeros(len(x))
             for comp in components:
                 Aik = comp[0]
                 wl = comp[1]     
                 w = self.get_width2(xc,m1,m2,T,n,Eion,*comp[2:],a)
                 y = y + Aik*lorentz_function(x,wl-656.280+middle_wl,w)
+                if derivative:
+                    dy = dy + Aik*w*lorentz_width_derivative(x,wl-656.280+middle_wl,w)
 
 
         if round(self.transition.wl, 0) == 486:
@@ -137,11 +170,17 @@ class vdW():
             [1.7190e+06*2, 486.1374864, 12.74853289, 10.19885143, 0, 1]]
 
             y = np.zeros(len(x))
+            dy = np.zeros(len(x))
             for comp in components:
                 Aik = comp[0]
                 wl = comp[1]
                 w = self.get_width2(xc,m1,m2,T,n,Eion,*comp[2:],a)
                 y = y + Aik*lorentz_function(x,wl-486.133+middle_wl,w)
+                if derivative:
+                    dy = dy + Aik*w*lorentz_width_derivative(x,wl-486.133+middle_wl,w)
 
 
-        return y/max(y)
+        if derivative:
+            i = np.argmax(y)
+            return y/y[i], dy/y[i] - y*dy[i]/y[i]**2
+        return y/np.max(y)
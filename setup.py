@@ -15,6 +15,7 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/mimurrayy/owl",
     packages=setuptools.find_packages(),
+    package_data={"owlspec": ["data/*.json"]},
     install_requires=[
           'numpy>=1.19.5', 'scipy>=1.6.0', 'mendeleev>=0.13.0', 'astroquery>=0.4.5', 'roman>=2.0', 'platformdirs>=2.6.0', 'pyplas>=0.2.1'
       ],